@@ -2,14 +2,765 @@
 
 # A minimal IR for transforming texinfo XML into rst
 
+import array
+import copy
+import difflib
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import operator
+import pickle
 import re
-from collections import OrderedDict
+import struct
+import sys
+import weakref
+from collections.abc import Mapping, MutableMapping
+from types import MappingProxyType
+from xml.etree import ElementTree
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
+
+
+class SymbolTable:
+    """
+    Interned strings with small integer codes, used for the kinds and
+    attribute keys of elements.
+
+    Every element of a kind shares the one string, which compares equal
+    to any other by identity first, and sets of kinds can be held as
+    bitsets of codes (see KindSet).
+    """
+    __slots__ = ('_codes', '_names')
+
+    def __init__(self):
+        self._codes = {}
+        self._names = []
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._codes
+
+    def intern(self, name):
+        """
+        Get the interned copy of name, adding it if need be.
+        """
+        code = self._codes.get(name)
+        if code is None:
+            code = self.code(name)
+        return self._names[code]
+
+    def code(self, name):
+        """
+        Get the code of name, adding it if need be.
+        """
+        code = self._codes.get(name)
+        if code is None:
+            name = sys.intern(name)
+            code = self._codes[name] = len(self._names)
+            self._names.append(name)
+        return code
+
+    def name(self, code):
+        return self._names[code]
+
+
+# The kinds and attribute keys of every element
+SYMBOLS = SymbolTable()
+
+
+class KindSet:
+    """
+    An immutable set of element kinds, held as a bitset of their codes
+    in SYMBOLS.  Test elements against it with Node.kind_in.
+    """
+    __slots__ = ('mask', )
+
+    def __init__(self, kinds=()):
+        mask = 0
+        for kind in kinds:
+            mask |= 1 << SYMBOLS.code(kind)
+        self.mask = mask
+
+    def __repr__(self):
+        return 'KindSet(%r)' % sorted(self)
+
+    def __contains__(self, kind):
+        code = SYMBOLS._codes.get(kind)
+        return code is not None and (self.mask >> code) & 1 == 1
+
+    def __iter__(self):
+        mask = self.mask
+        code = 0
+        while mask:
+            if mask & 1:
+                yield SYMBOLS.name(code)
+            mask >>= 1
+            code += 1
+
+    def __len__(self):
+        return bin(self.mask).count('1')
+
+    def __or__(self, other):
+        result = KindSet()
+        result.mask = self.mask | other.mask
+        return result
+
+
+def _interned_keys(attrs):
+    if isinstance(attrs, Mapping):
+        attrs = attrs.items()
+    intern = SYMBOLS.intern
+    return {intern(key): value for key, value in attrs}
+
+
+# Shared by every element that has no attributes yet; it is replaced
+# by a dict of the element's own on the first write.
+_NO_ATTRS = MappingProxyType({})
+
+
+class _EmptyAttrs(MutableMapping):
+    """
+    What Element.attrs hands out for an element without attributes:
+    reads see the element's current attributes, and the first write
+    gives the element a real dict.
+    """
+    __slots__ = ('_element', )
+
+    def __init__(self, element):
+        self._element = element
+
+    def __getitem__(self, key):
+        return self._element._attrs[key]
+
+    def __setitem__(self, key, value):
+        element = self._element
+        if element._attrs is _NO_ATTRS:
+            element._attrs = _Attrs(element)
+        element._attrs[key] = value
+
+    def __delitem__(self, key):
+        element = self._element
+        if element._attrs is _NO_ATTRS:
+            raise KeyError(key)
+        del element._attrs[key]
+
+    def __iter__(self):
+        return iter(self._element._attrs)
+
+    def __len__(self):
+        return len(self._element._attrs)
+
+    def __repr__(self):
+        return repr(dict(self._element._attrs))
+
+
+class _Attrs(dict):
+    """
+    The attributes of an Element, noting every change made to them.
+    """
+    __slots__ = ('_element', )
+
+    def __init__(self, element, attrs=()):
+        dict.__init__(self, _interned_keys(attrs))
+        self._element = element
+
+    def __setitem__(self, key, value):
+        _changed(self._element)
+        dict.__setitem__(self, SYMBOLS.intern(key), value)
+
+    def __delitem__(self, key):
+        _changed(self._element)
+        dict.__delitem__(self, key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        _changed(self._element)
+        dict.clear(self)
+
+    def pop(self, *args):
+        _changed(self._element)
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        _changed(self._element)
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            _changed(self._element)
+        return dict.setdefault(self, SYMBOLS.intern(key), default)
+
+    def update(self, *args, **kwargs):
+        _changed(self._element)
+        dict.update(self, _interned_keys(dict(*args, **kwargs)))
+
+
+def _element_hasher(element):
+    hasher = hashlib.blake2b(b'E', digest_size=16)
+    hasher.update(element._kind.encode('utf-8'))
+    for k, v in sorted(element._attrs.items()):
+        hasher.update(b'\0%s\0%s' % (k.encode('utf-8'), v.encode('utf-8')))
+    hasher.update(b'\0\0')
+    rst_kind = element.rst_kind
+    if rst_kind is not None:
+        hasher.update(_rst_kind_repr(rst_kind).encode('utf-8'))
+    hasher.update(b'\0')
+    return hasher
+
+
+def _rst_kind_repr(rst_kind):
+    if type(rst_kind).__repr__ is object.__repr__:
+        # Avoid the address of the object
+        return type(rst_kind).__qualname__
+    return repr(rst_kind)
+
+
+def _leaf_hasher(node):
+    if isinstance(node, Text):
+        return hashlib.blake2b(b'T' + node.data.encode('utf-8'), digest_size=16)
+    elif isinstance(node, Comment):
+        return hashlib.blake2b(b'C' + node.data.encode('utf-8'), digest_size=16)
+    else:
+        assert isinstance(node, Entity)
+        return hashlib.blake2b(b'N' + node.name.encode('utf-8'), digest_size=16)
+
+
+# Number of fragments Node.write_xml gathers before each write
+XML_CHUNK_PARTS = 4096
+
+
+def escape_xml_text(data):
+    data = data.replace('&', '&amp;')
+    # data = data.replace('"', '&quot;')
+    data = data.replace('>', '&gt;')
+    data = data.replace('<', '&lt;')
+    return data
+
+
+class _XMLWriter(XMLGenerator):
+    """
+    An XMLGenerator that also writes the comments and (skipped)
+    entities reported by Node.to_sax.
+    """
+    def comment(self, content):
+        self._finish_pending_start_element()
+        self._write('<!--%s-->' % content)
+
+    def skippedEntity(self, name):
+        self._finish_pending_start_element()
+        self._write('&%s;' % name)
+
+
+def _changed(element):
+    """
+    Note a change about to be made to the kind, attributes or children
+    of element, if it isn't None: this saves its state for any
+    snapshots, and forgets what is cached (see _forget_cached) for the
+    element and its ancestors.
+    """
+    if _live_snapshots and element is not None:
+        _save_state(element)
+    _forget_cached(element)
+
+
+def _leaf_changed(node):
+    """
+    As _changed, for a change to the data of a Text, Comment or Entity.
+    """
+    if _live_snapshots:
+        _save_state(node)
+    _forget_cached(node._parent)
+
+
+def _forget_cached(element):
+    """
+    Forget the structural hashes and texts (see Element.get_all_text)
+    cached for element and its ancestors.  Both are only cached for an
+    element once they are for all the elements below it, so the walk up
+    can stop at the first element with neither.
+    """
+    while element is not None and (element._hash is not None or element._text is not None):
+        element._hash = None
+        element._text = None
+        element = element._parent
+
+
+# Bumped by rst_kinds_changed; cached structural hashes are only valid
+# for the value they were computed with
+_rst_kinds_epoch = 0
+
+
+def rst_kinds_changed():
+    """
+    Note a change made in place to an rst_kind object, which might be
+    that of any element.
+    """
+    global _rst_kinds_epoch
+    _rst_kinds_epoch += 1
+
+
+def _changes_list(method):
+    """
+    Decorator for the ChildList methods which change the list.
+
+    A Visitor walks the live lists rather than copies of them, so a
+    list being walked is left as it is and its element given a copy to
+    change instead; the walk thus sees the children as they were when
+    it reached them.  Later changes made through the old list go to the
+    copy (see _OrphanedChildList).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._walkers and self._owner is not None:
+            self = self._unshared()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ChildList(list):
+    """
+    The children of an Element: a list which notes every change made
+    to it, keeping the parent of each node and any kind indexes of the
+    tree up to date.
+
+    Each node also remembers its position within the list; those of the
+    first _numbered nodes are known to be correct, and the rest are
+    renumbered on demand (see Node.position).
+    """
+    __slots__ = ('_owner', '_numbered', '_walkers')
+
+    def __init__(self, owner, nodes=()):
+        list.__init__(self, nodes)
+        self._owner = owner
+        self._numbered = 0
+        # The number of walks currently iterating over this list
+        self._walkers = 0
+
+    def _unshared(self):
+        owner = self._owner
+        copy = owner._children = ChildList(owner, self)
+        copy._numbered = self._numbered
+        self.__class__ = _OrphanedChildList
+        return copy
+
+    def _stale_from(self, index):
+        # The positions of the nodes from index onwards may have changed
+        if index < 0:
+            index = max(index + len(self), 0)
+        if index < self._numbered:
+            self._numbered = index
+
+    def _position_of(self, node):
+        i = node._position
+        if i < len(self) and self[i] is node:
+            return i
+        # Renumber the nodes up to this one
+        for i in range(self._numbered, len(self)):
+            other = self[i]
+            other._position = i
+            if other is node:
+                self._numbered = i + 1
+                return i
+        raise ValueError('%r is not a child of %r' % (node, self._owner))
+
+    def _removed_one(self, node):
+        # Detach a node taken out of this list; a node is only ever at
+        # one position, so there's no need to look for it elsewhere
+        if node._parent is self._owner:
+            _detach(self._owner, node)
+
+    def _removed(self, nodes):
+        # Detach the nodes that are no longer in this list
+        owner = self._owner
+        remaining = None
+        for node in nodes:
+            if node._parent is owner:
+                if remaining is None:
+                    remaining = set(map(id, self))
+                if id(node) not in remaining:
+                    _detach(owner, node)
+
+    def _added(self, nodes):
+        owner = self._owner
+        for node in nodes:
+            if node._parent is not owner:
+                _attach(owner, node)
+
+    @_changes_list
+    def __setitem__(self, index, value):
+        _changed(self._owner)
+        old = self[index]
+        if isinstance(index, slice):
+            self._stale_from((index.start or 0) if index.step in (None, 1) else 0)
+            value = list(value)
+            list.__setitem__(self, index, value)
+            self._removed(old)
+            self._added(value)
+        else:
+            list.__setitem__(self, index, value)
+            if index < 0:
+                index += len(self)
+            value._position = index
+            if old is not value:
+                self._removed_one(old)
+                self._added((value, ))
+
+    @_changes_list
+    def __delitem__(self, index):
+        _changed(self._owner)
+        old = self[index]
+        if isinstance(index, slice):
+            self._stale_from((index.start or 0) if index.step in (None, 1) else 0)
+        else:
+            self._stale_from(index)
+        list.__delitem__(self, index)
+        if isinstance(index, slice):
+            self._removed(old)
+        else:
+            self._removed_one(old)
+
+    @_changes_list
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    @_changes_list
+    def __imul__(self, n):
+        _changed(self._owner)
+        old = list(self) if n <= 0 else ()
+        self._stale_from(0)
+        list.__imul__(self, n)
+        self._removed(old)
+        return self
+
+    @_changes_list
+    def append(self, node):
+        _changed(self._owner)
+        node._position = len(self)
+        if self._numbered == node._position:
+            self._numbered += 1
+        list.append(self, node)
+        if node._parent is not self._owner:
+            _attach(self._owner, node)
+
+    @_changes_list
+    def extend(self, nodes):
+        _changed(self._owner)
+        nodes = list(nodes)
+        list.extend(self, nodes)
+        self._added(nodes)
+
+    @_changes_list
+    def insert(self, index, node):
+        _changed(self._owner)
+        self._stale_from(index)
+        list.insert(self, index, node)
+        if node._parent is not self._owner:
+            _attach(self._owner, node)
+
+    @_changes_list
+    def pop(self, index=-1):
+        _changed(self._owner)
+        self._stale_from(index)
+        node = list.pop(self, index)
+        self._removed_one(node)
+        return node
+
+    @_changes_list
+    def remove(self, node):
+        _changed(self._owner)
+        index = list.index(self, node)
+        self._stale_from(index)
+        list.__delitem__(self, index)
+        self._removed_one(node)
+
+    @_changes_list
+    def clear(self):
+        _changed(self._owner)
+        old = list(self)
+        self._numbered = 0
+        list.clear(self)
+        self._removed(old)
+
+    @_changes_list
+    def sort(self, *args, **kwargs):
+        _changed(self._owner)
+        self._numbered = 0
+        list.sort(self, *args, **kwargs)
+
+    @_changes_list
+    def reverse(self):
+        _changed(self._owner)
+        self._numbered = 0
+        list.reverse(self)
+
+
+def _forwarded(name):
+    def forward(self, *args, **kwargs):
+        return getattr(self._owner._children, name)(*args, **kwargs)
+    forward.__name__ = name
+    return forward
+
+
+class _OrphanedChildList(ChildList):
+    """
+    A ChildList whose element was given a copy of it to change while it
+    was being walked (see _changes_list).  Whatever still holds it can
+    go on changing the element's children through it, but reading it
+    gives the children as they were when it was copied.
+    """
+    __slots__ = ()
+
+    __setitem__ = _forwarded('__setitem__')
+    __delitem__ = _forwarded('__delitem__')
+    __iadd__ = _forwarded('__iadd__')
+    __imul__ = _forwarded('__imul__')
+    append = _forwarded('append')
+    extend = _forwarded('extend')
+    insert = _forwarded('insert')
+    pop = _forwarded('pop')
+    remove = _forwarded('remove')
+    clear = _forwarded('clear')
+    sort = _forwarded('sort')
+    reverse = _forwarded('reverse')
+
+
+def _attach(parent, node):
+    if parent is None:
+        # A list no longer used as an element's children
+        return
+    node._parent = parent
+    if _live_kind_indexes and isinstance(node, Element):
+        for index in _kind_indexes_above(parent):
+            index._add_subtree(node)
+
+
+def _detach(parent, node):
+    if parent is None:
+        return
+    node._parent = None
+    if _live_kind_indexes and isinstance(node, Element):
+        for index in _kind_indexes_above(parent):
+            index._remove_subtree(node)
+
+
+# Every KindIndex still in use; while there are none, changes to a tree
+# don't need to look for them
+_live_kind_indexes = weakref.WeakSet()
+
+
+def _kind_indexes_above(node):
+    """
+    Get the kind indexes covering node: those of node itself and of
+    its ancestors.
+    """
+    result = []
+    while node is not None:
+        if node._kind_index is not None:
+            result.append(node._kind_index)
+        node = node._parent
+    return result
+
+
+class KindIndex:
+    """
+    An index from element kind to the elements of that kind within
+    the tree below a root element (the root included).
+
+    It is kept up to date as elements are attached to and detached
+    from the tree, and as their kinds change; see Element.kind_index.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.elements_by_kind = {}
+        self._add_subtree(root)
+
+    def _add_subtree(self, element):
+        elements_by_kind = self.elements_by_kind
+        stack = [element]
+        while stack:
+            element = stack.pop()
+            bucket = elements_by_kind.get(element._kind)
+            if bucket is None:
+                bucket = elements_by_kind[element._kind] = {}
+            bucket[element] = None
+            for child in element._children:
+                if isinstance(child, Element) and child._parent is element:
+                    stack.append(child)
+
+    def _remove_subtree(self, element):
+        elements_by_kind = self.elements_by_kind
+        stack = [element]
+        while stack:
+            element = stack.pop()
+            bucket = elements_by_kind.get(element._kind)
+            if bucket:
+                bucket.pop(element, None)
+            for child in element._children:
+                if isinstance(child, Element) and child._parent is element:
+                    stack.append(child)
+
+    def _change_kind(self, element, old_kind, new_kind):
+        bucket = self.elements_by_kind.get(old_kind)
+        if bucket:
+            bucket.pop(element, None)
+        self.elements_by_kind.setdefault(new_kind, {})[element] = None
+
+    def count(self, kind):
+        """
+        Get the number of elements of the given kind.
+        """
+        return len(self.elements_by_kind.get(kind, ()))
+
+    def paths_to(self, kinds):
+        """
+        Get the set of elements of the given kinds, together with all
+        of their ancestors up to the root.
+        """
+        root = self.root
+        result = set()
+        for kind in kinds:
+            bucket = self.elements_by_kind.get(kind)
+            if not bucket:
+                continue
+            stale = []
+            for element in bucket:
+                chain = []
+                node = element
+                while node is not root and node not in result:
+                    if node is None:
+                        # Moved to another tree while still listed
+                        # under this one
+                        stale.append(element)
+                        break
+                    chain.append(node)
+                    node = node._parent
+                else:
+                    result.update(chain)
+            for element in stale:
+                del bucket[element]
+        if result:
+            result.add(root)
+        return result
+
+
+def _paths_to(root, kinds):
+    """
+    Get what KindIndex(root).paths_to(kinds) would, without decoding the
+    children of the LazyElements whose subtrees, as encoded in their
+    arenas, hold no elements of the given kinds.
+    """
+    arena_paths = {}
+    matches = []
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        if element._kind in kinds:
+            matches.append(element)
+        if type(element) is LazyElement:
+            arena, i, _ = _CHILDREN_SLOT.__get__(element)
+            paths = arena_paths.get(arena)
+            if paths is None:
+                paths = arena_paths[arena] = arena.paths_to(kinds)
+            if i not in paths:
+                continue
+        for child in element._children:
+            if isinstance(child, Element) and child._parent is element:
+                stack.append(child)
+    result = set()
+    for node in matches:
+        while node is not root and node not in result:
+            result.add(node)
+            node = node._parent
+    if result:
+        result.add(root)
+    return result
 
 
 class Node:
+    __slots__ = ('_parent', '_position')
+
     def __repr__(self):
         return 'Node()'
 
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def position(self):
+        """
+        The index of this node within its parent's children.
+        """
+        return self._siblings()._position_of(self)
+
+    def _siblings(self):
+        """
+        Get the children of this node's parent, for the methods which
+        need one.
+        """
+        parent = self._parent
+        if parent is None:
+            raise ValueError('%r has no parent' % (self, ))
+        return parent._children
+
+    @property
+    def next_sibling(self):
+        if self._parent is None:
+            return None
+        siblings = self._parent._children
+        i = siblings._position_of(self) + 1
+        if i < len(siblings):
+            return siblings[i]
+        return None
+
+    @property
+    def prev_sibling(self):
+        if self._parent is None:
+            return None
+        siblings = self._parent._children
+        i = siblings._position_of(self)
+        if i > 0:
+            return siblings[i - 1]
+        return None
+
+    def replace_with(self, *nodes):
+        """
+        Replace this node within its parent's children by the given
+        nodes.
+        """
+        siblings = self._siblings()
+        i = siblings._position_of(self)
+        siblings[i:i + 1] = nodes
+
+    def insert_before(self, *nodes):
+        siblings = self._siblings()
+        i = siblings._position_of(self)
+        siblings[i:i] = nodes
+
+    def insert_after(self, *nodes):
+        siblings = self._siblings()
+        i = siblings._position_of(self) + 1
+        if len(nodes) == 1 and i == len(siblings):
+            siblings.append(nodes[0])
+        else:
+            siblings[i:i] = nodes
+
+    def detach(self):
+        """
+        Remove this node from its parent's children, returning it.
+        """
+        siblings = self._siblings()
+        del siblings[siblings._position_of(self)]
+        return self
+
     def dump(self, f_out, depth=0):
         f_out.write('%s%r\n' % (' ' * depth, self))
 
@@ -18,19 +769,77 @@ class Node:
             if self.kind == kind:
                 return True
 
+    def kind_in(self, kinds):
+        """
+        Is this an element with one of the kinds in the KindSet?
+        """
+        return False
+
     def iter_depth_first(self):
         yield self
-        if isinstance(self, Element):
-            for child in self.children:
-                for item in child.iter_depth_first():
-                    yield item
+        for _, _, node in self.iter_nodes():
+            yield node
 
     def iter_depth_first_edges(self):
-        if isinstance(self, Element):
-            for child in self.children:
-                yield (self, child)
-                for src, dst in child.iter_depth_first_edges():
-                    yield (src, dst)
+        for parent, _, node in self.iter_nodes():
+            yield (parent, node)
+
+    def iter_elements(self, kinds=None, max_depth=None, prune=None):
+        """
+        Iterate over the elements below this node in document order, as
+        (parent, index, element) triples, using a stack rather than
+        nested generators.
+
+        If kinds (e.g. a KindSet) is given, only elements of those kinds
+        are yielded, although the others are still descended into.
+        Nothing is yielded below max_depth (children being at depth 1),
+        nor below an element for which prune(element) is true.  The tree
+        shouldn't be changed meanwhile.
+        """
+        return self._iter_below(True, kinds, max_depth, prune)
+
+    def iter_nodes(self, max_depth=None, prune=None):
+        """
+        As iter_elements, but for nodes of every type.
+        """
+        return self._iter_below(False, None, max_depth, prune)
+
+    def _iter_below(self, elements_only, kinds, max_depth, prune):
+        if not isinstance(self, Element):
+            return
+        if kinds is not None and self._kind_index is not None:
+            # Only descend into the paths leading to such elements
+            wanted = self._kind_index.paths_to(kinds)
+        else:
+            wanted = None
+        stack = [(self, enumerate(self._children))]
+        while stack:
+            parent, children = stack[-1]
+            for index, node in children:
+                if isinstance(node, Element):
+                    if wanted is not None and node not in wanted:
+                        continue
+                    if kinds is None or node._kind in kinds:
+                        yield parent, index, node
+                    if (max_depth is None or len(stack) < max_depth) and (prune is None or not prune(node)):
+                        stack.append((node, enumerate(node._children)))
+                        break
+                elif not elements_only:
+                    yield parent, index, node
+            else:
+                stack.pop()
+
+    def structural_hash(self):
+        """
+        Get a digest of this node and everything below it, as bytes.
+
+        It covers the kinds, attributes (in any order), rst_kinds (by
+        their repr), text, comments and entities of the tree, and is
+        the same from one run to the next.  Those of elements are cached
+        until the next change below them (changes made in place to
+        rst_kinds must be reported with rst_kinds_changed).
+        """
+        return _leaf_hasher(self).digest()
 
     def toxml(self, dtd_line=None):
         """
@@ -38,42 +847,113 @@ class Node:
         (minidom appears to sort the attribute names
         https://hg.python.org/cpython/file/2.7/Lib/xml/dom/minidom.py#l800)
         """
-        def escape(data):
-            data = data.replace('&', '&amp;')
-            # data = data.replace('"', '&quot;')
-            data = data.replace('>', '&gt;')
-            data = data.replace('<', '&lt;')
-            return data
+        f_out = io.StringIO()
+        self.write_xml(f_out, dtd_line)
+        return f_out.getvalue()
 
-        if isinstance(self, Element):
-            if dtd_line:
-                result = '<?xml version="1.0"?>\n'
-                result += '%s\n' % dtd_line
+    def write_xml(self, f_out, dtd_line=None):
+        """
+        Write the XML for this node and everything below it to f_out,
+        preserving attribute ordering, as for toxml.
+
+        The output is written in chunks as it is generated, rather than
+        being built up as one string first.
+        """
+        parts = []
+        append = parts.append
+        if dtd_line and isinstance(self, Element):
+            append('<?xml version="1.0"?>\n')
+            append('%s\n' % dtd_line)
+
+        # Closing tags are pushed as plain strings, ahead of the
+        # children of their element.
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Element):
+                append('<%s' % node.kind)
+                for k, v in node._attrs.items():
+                    append(' %s="%s"' % (k, v))
+                if node.children:
+                    append('>')
+                    stack.append('</%s>' % node.kind)
+                    stack.extend(reversed(node.children))
+                else:
+                    append('/>')
+            elif isinstance(node, str):
+                append(node)
+            elif isinstance(node, Text):
+                append(escape_xml_text(node.data))
+            elif isinstance(node, Comment):
+                append('<!--%s-->' % node.data)
             else:
-                result = ''
-            result += '<%s' % self.kind
-            for k, v in self.attrs.items():
-                result += ' %s="%s"' % (k, v)
-            if self.children:
-                result += '>'
-                for child in self.children:
-                    result += child.toxml()
-                result += '</%s>' % self.kind
+                assert isinstance(node, Entity)
+                append('&%s;' % node.name)
+
+            if len(parts) >= XML_CHUNK_PARTS:
+                f_out.write(''.join(parts))
+                parts.clear()
+        f_out.write(''.join(parts))
+
+    def iter_events(self):
+        """
+        Walk this node and everything below it in document order,
+        yielding (event, value) pairs:
+
+          ('start', element)   before the children of an element
+          ('end', element)     after them
+          ('text', data)
+          ('comment', data)
+          ('entity', name)
+
+        This is what to_sax and to_etree are built on, and lets other
+        XML tooling consume a tree without building a DOM for it.
+        """
+        # Ends of elements are pushed as tuples, ahead of their children
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Element):
+                yield 'start', node
+                stack.append(('end', node))
+                stack.extend(reversed(node._children))
+            elif isinstance(node, tuple):
+                yield node
+            elif isinstance(node, Text):
+                yield 'text', node.data
+            elif isinstance(node, Comment):
+                yield 'comment', node.data
             else:
-                result += '/>'
-            return result
-        elif isinstance(self, Comment):
-            return '<!--%s-->' % self.data
-        elif isinstance(self, Entity):
-            return '&%s;' % self.name
-        else:
-            assert isinstance(self, Text)
-            return escape(self.data)
+                assert isinstance(node, Entity)
+                yield 'entity', node.name
+
+    def to_sax(self, content_handler, lexical_handler=None):
+        """
+        Report this node and everything below it to a SAX
+        content_handler, as startElement, endElement and characters
+        calls.  Entities are reported with skippedEntity, and comments
+        with lexical_handler.comment, if there is a lexical_handler.
+
+        Neither startDocument nor endDocument are called, so that
+        trees can be reported within a larger document.
+        """
+        for event, value in self.iter_events():
+            if event == 'start':
+                content_handler.startElement(value.kind, AttributesImpl(dict(value._attrs.items())))
+            elif event == 'end':
+                content_handler.endElement(value.kind)
+            elif event == 'text':
+                content_handler.characters(value)
+            elif event == 'comment':
+                if lexical_handler is not None:
+                    lexical_handler.comment(value)
+            else:
+                content_handler.skippedEntity(value)
 
     def to_dom_node(self, dom_doc):
         if isinstance(self, Element):
             dom_node = dom_doc.createElement(self.kind)
-            for k, v in self.attrs.items():
+            for k, v in self._attrs.items():
                 dom_node.setAttribute(k, v)
             for child in self.children:
                 dom_node.appendChild(child.to_dom_node(dom_doc))
@@ -86,19 +966,192 @@ class Node:
 
 
 class Element(Node):
+    # _kind is interned in SYMBOLS, and _kind_code is its code there
+    # _hash and _text cache structural_hash and get_all_text
+    __slots__ = ('_kind', '_kind_code', '_attrs', '_children', '_rst_kind', '_kind_index', '_hash', '_text')
+
     def __init__(self, kind, attrs=None):
-        if not re.match('[a-zA-Z0-9-_]+', kind):
-            raise ValueError('bad name for element: %r' % kind)
-        self.kind = kind
+        code = SYMBOLS._codes.get(kind)
+        if code is None:
+            if not re.match('[a-zA-Z0-9-_]+', kind):
+                raise ValueError('bad name for element: %r' % kind)
+            code = SYMBOLS.code(kind)
+        self._parent = None
+        self._position = 0
+        self._kind = SYMBOLS._names[code]
+        self._kind_code = code
         if attrs:
-            self.attrs = OrderedDict(attrs)
+            self._attrs = _Attrs(self, attrs)
         else:
-            self.attrs = OrderedDict()
-        self.children = []
-        self.rst_kind = None
+            self._attrs = _NO_ATTRS
+        self._children = ChildList(self)
+        self._rst_kind = None
+        self._kind_index = None
+        self._hash = None
+        self._text = None
 
     def __repr__(self):
-        return 'Element(%r, %r, %r)' % (self.kind, self.attrs, self.rst_kind)
+        return 'Element(%r, %r, %r)' % (self.kind, dict(self._attrs), self.rst_kind)
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @kind.setter
+    def kind(self, kind):
+        kind = SYMBOLS.intern(kind)
+        if _live_kind_indexes:
+            for index in _kind_indexes_above(self):
+                index._change_kind(self, self._kind, kind)
+        _changed(self)
+        self._kind = kind
+        self._kind_code = SYMBOLS.code(kind)
+
+    @property
+    def kind_code(self):
+        """
+        The code of the kind in SYMBOLS.
+        """
+        return self._kind_code
+
+    def kind_in(self, kinds):
+        return (kinds.mask >> self._kind_code) & 1 == 1
+
+    @property
+    def rst_kind(self):
+        return self._rst_kind
+
+    @rst_kind.setter
+    def rst_kind(self, rst_kind):
+        if rst_kind is not self._rst_kind:
+            if _live_snapshots:
+                _save_state(self)
+            _forget_cached(self)
+            self._rst_kind = rst_kind
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        if _live_snapshots:
+            _save_state(self)
+        old = self._children
+        new = self._children = ChildList(self, children)
+        old._owner = None
+        if len(old) == len(new) and all(map(operator.is_, old, new)):
+            # Commonly, passes filter the children but find nothing to drop
+            return
+        _changed(self)
+        if _live_kind_indexes and _kind_indexes_above(self):
+            if old:
+                kept = set(map(id, new))
+                for node in old:
+                    if node._parent is self and id(node) not in kept:
+                        _detach(self, node)
+            for node in new:
+                if node._parent is not self:
+                    _attach(self, node)
+        else:
+            for node in old:
+                if node._parent is self:
+                    node._parent = None
+            for node in new:
+                node._parent = self
+
+    def structural_hash(self):
+        epoch = _rst_kinds_epoch
+        cached = self._hash
+        if cached is not None and cached[0] == epoch:
+            return cached[1]
+        # A post-order walk of the elements whose hashes aren't cached;
+        # each is cached as an (epoch, digest) pair
+        digest = None
+        stack = [(self, _element_hasher(self), iter(self._children))]
+        while stack:
+            element, hasher, children = stack[-1]
+            for child in children:
+                if isinstance(child, Element):
+                    cached = child._hash
+                    if cached is None or cached[0] != epoch:
+                        stack.append((child, _element_hasher(child), iter(child._children)))
+                        break
+                    hasher.update(cached[1])
+                else:
+                    hasher.update(_leaf_hasher(child).digest())
+            else:
+                stack.pop()
+                digest = hasher.digest()
+                element._hash = (epoch, digest)
+                if stack:
+                    stack[-1][1].update(digest)
+        return digest
+
+    def kind_index(self):
+        """
+        Get the KindIndex for the tree below this element, creating
+        it on first use.  It is kept up to date, at some cost to every
+        change to the tree, until release_kind_index is called.
+        """
+        if self._kind_index is None:
+            self._kind_index = KindIndex(self)
+            _live_kind_indexes.add(self._kind_index)
+        return self._kind_index
+
+    def release_kind_index(self):
+        """
+        Drop any KindIndex made by kind_index.
+        """
+        if self._kind_index is not None:
+            _live_kind_indexes.discard(self._kind_index)
+            self._kind_index = None
+
+    def dispose(self):
+        """
+        Break up the tree below this element once it is done with.  As
+        each node refers to its parent, a tree is otherwise only freed
+        by the cycle collector, some time after it is dropped.  Neither
+        the tree nor any snapshot of it can be used afterwards.
+        """
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if isinstance(element, (LazyElement, _ArenaView)):
+                # Not linked to its children
+                continue
+            element.release_kind_index()
+            # An rst_kind can refer back to its element
+            element._rst_kind = None
+            if isinstance(element._attrs, _Attrs):
+                element._attrs._element = None
+            children = element._children
+            children._owner = None
+            for node in children:
+                node._parent = None
+                if isinstance(node, Element):
+                    stack.append(node)
+
+    def snapshot(self):
+        """
+        Take a Snapshot of the tree below this element, in constant
+        time.
+        """
+        return Snapshot(self)
+
+    @property
+    def attrs(self):
+        if self._attrs is _NO_ATTRS:
+            return _EmptyAttrs(self)
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, attrs):
+        _changed(self)
+        if attrs:
+            self._attrs = _Attrs(self, attrs)
+        else:
+            self._attrs = _NO_ATTRS
 
     def dump(self, f_out, depth=0):
         f_out.write('%s%r\n' % (' ' * depth, self))
@@ -123,12 +1176,21 @@ class Element(Node):
                 return child
 
     def get_all_text(self):
-        result = ''
-        for child in self.children:
+        """
+        Get the concatenation of all text below this element.
+
+        The result is cached until the next change below the element.
+        """
+        result = self._text
+        if result is not None:
+            return result
+        parts = []
+        for child in self._children:
             if isinstance(child, Text):
-                result += child.data
+                parts.append(child.data)
             elif isinstance(child, Element):
-                result += child.get_all_text()
+                parts.append(child.get_all_text())
+        result = self._text = ''.join(parts)
         return result
 
     def collapse_to_text(self):
@@ -154,7 +1216,7 @@ class Element(Node):
         if self.children:
             last_child = self.children[-1]
             if isinstance(last_child, Text):
-                last_child.data += data
+                last_child.append(data)
                 return
         self.children.append(Text(data))
 
@@ -178,55 +1240,1872 @@ class Element(Node):
             top_element.appendChild(child.to_dom_node(dom_doc))
         return dom_doc
 
+    def to_etree(self, entities=None):
+        """
+        Convert the tree below this element to xml.etree.ElementTree
+        elements, without building a DOM first, returning the root.
+
+        ElementTree has nowhere to put entities, so entities maps the
+        name of each one in the tree to the text to replace it with;
+        ValueError is raised for any others.
+        """
+        builder = ElementTree.TreeBuilder(insert_comments=True)
+        for event, value in self.iter_events():
+            if event == 'start':
+                builder.start(value.kind, dict(value._attrs.items()))
+            elif event == 'end':
+                builder.end(value.kind)
+            elif event == 'text':
+                builder.data(value)
+            elif event == 'comment':
+                builder.comment(value)
+            elif entities is not None and value in entities:
+                builder.data(entities[value])
+            else:
+                raise ValueError('no replacement for entity: &%s;' % value)
+        return builder.close()
+
+    def write_sax(self, out, encoding='utf-8'):
+        """
+        Write the tree below this element as an XML document to out,
+        through xml.sax.saxutils.XMLGenerator, as it is walked.  out is
+        a text stream, or a binary one to be written in encoding.
+        """
+        writer = _XMLWriter(out, encoding, short_empty_elements=True)
+        writer.startDocument()
+        self.to_sax(writer, writer)
+        writer.endDocument()
+
     def get_all_elements(self, name):
-        result = []
-        for child in self.children:
-            if isinstance(child, Element):
-                if child.kind == name:
-                    result.append(child)
-                result += child.get_all_elements(name)
-        return result
+        """
+        Get all elements of the given kind below this element, in
+        document order.
+        """
+        return [element for _, _, element in self.iter_elements((name, ))]
+
+    def select(self, selector, indexed=False):
+        """
+        Get the elements matching selector (a string, or a Selector from
+        compile_selector) within the tree below this element, the element
+        itself included, in document order, as (element, parents) pairs
+        with parents holding its ancestors from this element down, as
+        a Visitor would.
+
+        If indexed, this element's KindIndex is made if need be, and kept
+        until release_kind_index; any index it has is used to only walk
+        the paths to elements of the kinds the selector is after.  In a
+        tree loaded lazily, making the index decodes the whole tree.
+        """
+        if isinstance(selector, str):
+            selector = compile_selector(selector)
+        if indexed:
+            self.kind_index()
+        return selector.select(self)
+
+    def select_first(self, selector, indexed=False):
+        """
+        As select, but only get the first match, or None.
+        """
+        if isinstance(selector, str):
+            selector = compile_selector(selector)
+        if indexed:
+            self.kind_index()
+        return next(selector.iter_select(self), None)
 
 
 class Comment(Node):
+    __slots__ = ('_data', )
+
     def __init__(self, data):
-        self.data = data
+        self._parent = None
+        self._position = 0
+        self._data = data
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        _leaf_changed(self)
+        self._data = data
 
     def __repr__(self):
         return 'Comment(%r)' % self.data
 
 
 class Text(Node):
+    # _pending is None, or a list of strings appended to _data but not
+    # yet joined to it
+    __slots__ = ('_data', '_pending')
+
     def __init__(self, data):
-        self.data = data
+        self._parent = None
+        self._position = 0
+        self._data = data
+        self._pending = None
 
-    def __repr__(self):
-        return 'Text(%r)' % self.data
+    @property
+    def data(self):
+        if self._pending is not None:
+            self._data += ''.join(self._pending)
+            self._pending = None
+        return self._data
 
+    @data.setter
+    def data(self, data):
+        _leaf_changed(self)
+        self._data = data
+        self._pending = None
+
+    def append(self, data):
+        """
+        Add data to the end of the text.  It is only joined to the rest
+        when .data is next read, so that building a long text a piece
+        at a time takes linear time.
+        """
+        _leaf_changed(self)
+        if self._pending is None:
+            self._pending = [data]
+        else:
+            self._pending.append(data)
+
+    def __repr__(self):
+        return 'Text(%r)' % self.data
+
+
+class Entity(Node):
+    __slots__ = ('_name', )
 
-class Entity(Node):
     def __init__(self, name):
-        self.name = name
+        self._parent = None
+        self._position = 0
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        _leaf_changed(self)
+        self._name = name
 
     def __repr__(self):
         return 'Entity(%r)' % self.name
 
 
+# Snapshots of trees: see Snapshot
+
+# Every Snapshot still in use; while there are none, changes to a tree
+# needn't be saved
+_live_snapshots = weakref.WeakSet()
+
+
+def _save_state(node):
+    for snapshot in _live_snapshots:
+        snapshot._save(node)
+
+
+def _state_of(node):
+    if isinstance(node, Element):
+        attrs = dict(node._attrs) if node._attrs else None
+        return (node._kind, attrs, list(node._children), node.rst_kind)
+    elif isinstance(node, Entity):
+        return node.name
+    else:
+        return node.data
+
+
+class Snapshot:
+    """
+    The state of a tree at some moment, taken in constant time with
+    Element.snapshot.
+
+    Rather than copying the tree, a snapshot notes the state of each
+    node just before its first change after the snapshot was taken, so
+    that it shares everything unchanged with the live tree and grows
+    only with the amount of change.  That covers the changes made
+    through this module, including which rst_kind an element has, but
+    not those made inside rst_kind objects.
+    """
+    __slots__ = ('root', '_states', '_known', '__weakref__')
+
+    def __init__(self, root):
+        self.root = root
+        # id(node) -> (node, state before its first change)
+        self._states = {}
+        # The ids of the children of the elements in _states, all of
+        # which were in the tree
+        self._known = set()
+        _live_snapshots.add(self)
+
+    def __len__(self):
+        """
+        Get the number of nodes changed since the snapshot was taken.
+        """
+        return len(self._states)
+
+    def _save(self, node):
+        if id(node) not in self._states and self._was_in_tree(node):
+            state = _state_of(node)
+            self._states[id(node)] = (node, state)
+            if isinstance(node, Element):
+                self._known.update(map(id, state[2]))
+
+    def _was_in_tree(self, node):
+        """
+        Was node in the tree when the snapshot was taken?  Nodes made
+        since then, or never in it, needn't be saved.
+        """
+        while node is not self.root:
+            if id(node) in self._known:
+                return True
+            parent = node._parent
+            if parent is None or id(parent) in self._states:
+                # It isn't among the children parent had then, since
+                # those are known
+                return False
+            # The parent hasn't changed, so still has it as a child
+            node = parent
+        return True
+
+    def _state(self, node):
+        saved = self._states.get(id(node))
+        if saved is not None:
+            return saved[1]
+        return _state_of(node)
+
+    def to_tree(self):
+        """
+        Make a new tree as the tree below root was when the snapshot was
+        taken.  Any references to nodes of it within the rst_kinds are
+        to the new nodes.
+        """
+        # The new node for every old one, by id, as the memo of the
+        # deepcopy of the rst_kinds
+        new_nodes = {}
+        rst_kinds = []
+        stack = [(self.root, None)]
+        while stack:
+            node, parent = stack.pop()
+            state = self._state(node)
+            if isinstance(node, Element):
+                kind, attrs, children, rst_kind = state
+                new_node = Element(kind, attrs)
+                if rst_kind is not None:
+                    rst_kinds.append((new_node, rst_kind))
+                stack.extend((child, new_node) for child in reversed(children))
+            else:
+                new_node = type(node)(state)
+            new_nodes[id(node)] = new_node
+            if parent is not None:
+                parent.children.append(new_node)
+        if rst_kinds:
+            copied = copy.deepcopy([rst_kind for _, rst_kind in rst_kinds], new_nodes)
+            for (new_node, _), rst_kind in zip(rst_kinds, copied):
+                new_node.rst_kind = rst_kind
+        return new_nodes[id(self.root)]
+
+    def restore(self):
+        """
+        Put every node changed since the snapshot was taken back as it
+        was then, in time proportional to the number of them.  The
+        snapshot can be restored again after further changes.
+        """
+        for node, state in list(self._states.values()):
+            if isinstance(node, Element):
+                kind, attrs, children, rst_kind = state
+                if node._kind != kind:
+                    node.kind = kind
+                _changed(node)
+                node._attrs = _Attrs(node, attrs) if attrs else _NO_ATTRS
+                node.rst_kind = rst_kind
+                node.children = children
+            elif isinstance(node, Entity):
+                node.name = state
+            else:
+                node.data = state
+
+
+# Compact storage for trees: see TreeArena
+
+ELEMENT, TEXT, COMMENT, ENTITY = range(4)
+
+
+class TreeArena:
+    """
+    A read-mostly copy of a tree, held as columns of numbers rather
+    than as one object per node.
+
+    The nodes are numbered in document order, the root being 0, and
+    for each node the arena has:
+
+      types:          ELEMENT, TEXT, COMMENT or ENTITY
+      names:          the kind of an element or the name of an entity,
+                      as an index into strings (-1 for other nodes)
+      parents:        the parent's number (-1 for the root)
+      next_siblings:  the number of the next sibling (-1 if none); the
+                      first child of a node, if any, is the node after
+                      it
+      text_starts:    the offset within text of the node's own text
+                      (for a Text node) or of that of the nodes below
+                      it, with one more entry giving the length of text
+
+    The data of all the Text nodes lives in the one string text, so
+    the text below any element is just a slice of it.  The attributes,
+    rst_kinds and comments are held in dicts keyed by node number, as
+    few nodes have them.
+
+    node(i) gives a view of a node with the API of Element, Text,
+    Comment or Entity, which can be walked by Visitors and written out
+    as before.  The kinds, attributes and rst_kinds of elements and
+    the data of Text nodes can be changed through these views, but
+    not the structure of the tree; passes which restructure the tree
+    should work on to_tree().
+    """
+    def __init__(self):
+        self.types = array.array('b')
+        self.names = array.array('i')
+        self.parents = array.array('i')
+        self.next_siblings = array.array('i')
+        self.text_starts = array.array('q', [0])
+        self.text = ''
+        self.strings = []
+        self.attrs = {}
+        self.comments = {}
+        self._rst_kinds = {}
+        # The rst_kinds as loaded, until they are first needed
+        self._rst_kinds_pickle = None
+        self._string_codes = {}
+        # Text.data changed through a view, by node number
+        self._text_changes = {}
+        self._views = weakref.WeakValueDictionary()
+
+    @classmethod
+    def from_tree(cls, root, node_numbers=None):
+        """
+        Make an arena holding a copy of the tree below root.
+
+        The rst_kinds are shared with the tree rather than copied.  If
+        node_numbers is given, it is filled in with the number of each
+        node, keyed by the node's id.
+        """
+        arena = cls()
+        types = arena.types
+        names = arena.names
+        parents = arena.parents
+        next_siblings = arena.next_siblings
+        text_starts = arena.text_starts
+        text_parts = []
+        text_len = 0
+        # The number of the last child added to each element so far
+        last_children = {}
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            i = len(types)
+            if node_numbers is not None:
+                node_numbers[id(node)] = i
+            text_starts[-1] = text_len
+            if parent != -1:
+                prev = last_children.get(parent)
+                if prev is not None:
+                    next_siblings[prev] = i
+                last_children[parent] = i
+            parents.append(parent)
+            next_siblings.append(-1)
+            if isinstance(node, Element):
+                types.append(ELEMENT)
+                names.append(arena.intern(node.kind))
+                if node._attrs:
+                    arena.attrs[i] = dict(node._attrs)
+                if node.rst_kind is not None:
+                    arena.rst_kinds[i] = node.rst_kind
+                stack.extend((child, i) for child in reversed(node.children))
+            elif isinstance(node, Text):
+                types.append(TEXT)
+                names.append(-1)
+                text_parts.append(node.data)
+                text_len += len(node.data)
+            elif isinstance(node, Comment):
+                types.append(COMMENT)
+                names.append(-1)
+                arena.comments[i] = node.data
+            else:
+                assert isinstance(node, Entity)
+                types.append(ENTITY)
+                names.append(arena.intern(node.name))
+            text_starts.append(text_len)
+        arena.text = ''.join(text_parts)
+        return arena
+
+    def __len__(self):
+        return len(self.types)
+
+    @property
+    def rst_kinds(self):
+        if self._rst_kinds_pickle is not None:
+            self._rst_kinds = self._load_rst_kinds(self.node)
+            self._rst_kinds_pickle = None
+        return self._rst_kinds
+
+    def _load_rst_kinds(self, get_node):
+        unpickler = _RstKindUnpickler(io.BytesIO(self._rst_kinds_pickle))
+        unpickler.persistent_load = get_node
+        return unpickler.load()
+
+    def dump(self, f_out, node_numbers=None):
+        """
+        Write the arena to the binary file f_out, in the format
+        described at DUMP_FORMAT_VERSION.
+
+        The rst_kinds are pickled, with any references to nodes written
+        as node numbers: either those of views of this arena, or those
+        given in node_numbers (as filled in by from_tree).
+        """
+        strings = list(self.strings)
+        codes = dict(self._string_codes)
+
+        def code_of(string):
+            code = codes.get(string)
+            if code is None:
+                code = codes[string] = len(strings)
+                strings.append(string)
+            return code
+
+        attrs = array.array('i')
+        for i, element_attrs in self.attrs.items():
+            attrs.append(i)
+            attrs.append(len(element_attrs))
+            for k, v in element_attrs.items():
+                attrs.append(code_of(k))
+                attrs.append(code_of(v))
+        comments = array.array('i')
+        for i, data in self.comments.items():
+            comments.append(i)
+            comments.append(code_of(data))
+        if any('\0' in string for string in strings):
+            raise ValueError('cannot dump a string containing NUL')
+
+        def persistent_id(obj):
+            if isinstance(obj, _ArenaView) and obj._arena is self:
+                return obj._index
+            if isinstance(obj, Node):
+                if node_numbers is not None and id(obj) in node_numbers:
+                    return node_numbers[id(obj)]
+                raise pickle.PicklingError('%r is not in the tree' % (obj, ))
+        rst_kinds = io.BytesIO()
+        if self._rst_kinds_pickle is not None:
+            rst_kinds.write(self._rst_kinds_pickle)
+        elif self._rst_kinds:
+            pickler = pickle.Pickler(rst_kinds, pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = persistent_id
+            pickler.dump(self._rst_kinds)
+
+        def write_bytes(data):
+            f_out.write(struct.pack('<Q', len(data)))
+            f_out.write(data)
+
+        def write_array(column):
+            if sys.byteorder == 'big':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            write_bytes(column.tobytes())
+
+        f_out.write(struct.pack('<8sHI', DUMP_MAGIC, DUMP_FORMAT_VERSION, len(self.types)))
+        write_bytes('\0'.join(strings).encode('utf-8'))
+        write_bytes(self.text.encode('utf-8'))
+        for column in (self.types, self.names, self.parents, self.next_siblings, self.text_starts,
+                       attrs, comments):
+            write_array(column)
+        write_bytes(rst_kinds.getvalue())
+
+    @classmethod
+    def load(cls, f_in):
+        """
+        Read an arena written by dump from the binary file f_in.
+
+        The rst_kinds can only be of builtin types or texi2rst's RstKind
+        classes; any others raise pickle.UnpicklingError when they are
+        first used.
+        """
+        data = memoryview(f_in.read())
+        header = struct.Struct('<8sHI')
+        if len(data) < header.size:
+            raise ValueError('truncated tree dump')
+        magic, version, count = header.unpack_from(data)
+        if magic != DUMP_MAGIC:
+            raise ValueError('not a tree dump')
+        if version != DUMP_FORMAT_VERSION:
+            raise ValueError('unsupported tree dump version: %i' % version)
+        offset = header.size
+
+        def read_bytes():
+            nonlocal offset
+            size, = struct.unpack_from('<Q', data, offset)
+            offset += 8 + size
+            if offset > len(data):
+                raise ValueError('truncated tree dump')
+            return data[offset - size:offset]
+
+        def read_array(typecode):
+            column = array.array(typecode)
+            column.frombytes(read_bytes())
+            if sys.byteorder == 'big':
+                column.byteswap()
+            return column
+
+        arena = cls()
+        strings = str(read_bytes(), 'utf-8').split('\0')
+        arena.text = str(read_bytes(), 'utf-8')
+        arena.types = read_array('b')
+        arena.names = read_array('i')
+        arena.parents = read_array('i')
+        arena.next_siblings = read_array('i')
+        arena.text_starts = read_array('q')
+        attrs = read_array('i')
+        comments = read_array('i')
+        rst_kinds = bytes(read_bytes())
+        if not (len(arena.types) == len(arena.names) == len(arena.parents)
+                == len(arena.next_siblings) == len(arena.text_starts) - 1 == count):
+            raise ValueError('corrupt tree dump')
+
+        # Kinds and attribute keys are compared by identity (see
+        # SymbolTable), so use the interned copies
+        for code in set(itertools.compress(arena.names, [t == ELEMENT for t in arena.types])):
+            strings[code] = SYMBOLS.intern(strings[code])
+        i = 0
+        while i < len(attrs):
+            node, n = attrs[i], attrs[i + 1]
+            i += 2
+            arena.attrs[node] = {SYMBOLS.intern(strings[attrs[j]]): strings[attrs[j + 1]]
+                                 for j in range(i, i + 2 * n, 2)}
+            i += 2 * n
+        for i in range(0, len(comments), 2):
+            arena.comments[comments[i]] = strings[comments[i + 1]]
+        arena.strings = strings
+        arena._string_codes = {string: code for code, string in enumerate(strings)}
+        if rst_kinds:
+            arena._rst_kinds_pickle = rst_kinds
+        return arena
+
+    def intern(self, string):
+        """
+        Get the index of string within strings, adding it if need be.
+        """
+        code = self._string_codes.get(string)
+        if code is None:
+            code = self._string_codes[string] = len(self.strings)
+            self.strings.append(string)
+        return code
+
+    @property
+    def root(self):
+        return self.node(0)
+
+    def node(self, i):
+        """
+        Get the view of node i.
+        """
+        view = self._views.get(i)
+        if view is None:
+            view = self._views[i] = _ARENA_VIEWS[self.types[i]](self, i)
+        return view
+
+    def subtree_end(self, i):
+        """
+        Get the number of the first node after the subtree of node i.
+        """
+        next_siblings = self.next_siblings
+        parents = self.parents
+        while i != -1:
+            if next_siblings[i] != -1:
+                return next_siblings[i]
+            i = parents[i]
+        return len(self.types)
+
+    def children_of(self, i):
+        """
+        Get the numbers of the children of node i.
+        """
+        result = []
+        if i + 1 < len(self.types) and self.parents[i + 1] == i:
+            child = i + 1
+            next_siblings = self.next_siblings
+            while child != -1:
+                result.append(child)
+                child = next_siblings[child]
+        return result
+
+    def text_of(self, i):
+        """
+        Get the concatenation of all text in the subtree of node i.
+        """
+        if self._text_changes:
+            return self.node(i).get_all_text()
+        return self.text[self.text_starts[i]:self.text_starts[self.subtree_end(i)]]
+
+    def paths_to(self, kinds):
+        """
+        Get the set of the numbers of the elements of the given kinds,
+        together with those of all their ancestors.
+        """
+        result = set()
+        parents = self.parents
+        for kind in kinds:
+            for i in self.iter_kind(kind):
+                while i != -1 and i not in result:
+                    result.add(i)
+                    i = parents[i]
+        return result
+
+    def iter_kind(self, kind, start=0, end=None):
+        """
+        Generate the numbers of the elements of the given kind among
+        nodes start to end.
+        """
+        code = self._string_codes.get(kind)
+        if code is None:
+            return
+        if end is None:
+            end = len(self.types)
+        names = self.names
+        types = self.types
+        i = start
+        while True:
+            try:
+                i = names.index(code, i, end)
+            except ValueError:
+                return
+            if types[i] == ELEMENT:
+                yield i
+            i += 1
+
+    def _new_node(self, i, element_class=Element):
+        """
+        Make a new node like node i, without any children or rst_kind.
+        """
+        node_type = self.types[i]
+        if node_type == ELEMENT:
+            # As Element(), but without checking the kind again
+            node = element_class.__new__(element_class)
+            node._kind_code = SYMBOLS.code(self.strings[self.names[i]])
+            node._kind = SYMBOLS._names[node._kind_code]
+            node._attrs = _Attrs(node, self.attrs[i]) if i in self.attrs else _NO_ATTRS
+            node._rst_kind = None
+            node._kind_index = None
+            node._hash = None
+            node._text = None
+            node._position = 0
+            node._parent = None
+        elif node_type == TEXT:
+            data = self._text_changes.get(i)
+            if data is None:
+                data = self.text[self.text_starts[i]:self.text_starts[i + 1]]
+            node = Text(data)
+        elif node_type == COMMENT:
+            node = Comment(self.comments[i])
+        else:
+            node = Entity(self.strings[self.names[i]])
+        return node
+
+    def to_tree(self, i=0):
+        """
+        Make a new tree of Element, Text, Comment and Entity nodes
+        from the subtree of node i.
+        """
+        parents = self.parents
+        start = i
+        nodes = [None] * (self.subtree_end(start) - start)
+        # Working backwards, the children of each element are made
+        # before it is; meanwhile they are held here, last first
+        children_of = {}
+        new_node = self._new_node
+        for i in range(start + len(nodes) - 1, start - 1, -1):
+            node = new_node(i)
+            if isinstance(node, Element):
+                children = children_of.pop(i, None)
+                if children:
+                    children.reverse()
+                    for child in children:
+                        child._parent = node
+                    node._children = ChildList(node, children)
+                else:
+                    node._children = ChildList(node)
+            nodes[i - start] = node
+            if i != start:
+                siblings = children_of.get(parents[i])
+                if siblings is None:
+                    children_of[parents[i]] = [node]
+                else:
+                    siblings.append(node)
+
+        if self._rst_kinds_pickle is not None and start == 0:
+            # Have the rst_kinds refer to the new nodes, rather than to
+            # views of the arena
+            rst_kinds = self._load_rst_kinds(nodes.__getitem__)
+        else:
+            rst_kinds = self.rst_kinds
+        for i, rst_kind in rst_kinds.items():
+            if start <= i < start + len(nodes):
+                nodes[i - start].rst_kind = rst_kind
+        return nodes[0]
+
+    def to_lazy_tree(self):
+        """
+        Make a new tree from the arena, as to_tree does, but only
+        decoding the children of each element when they are first
+        needed (see LazyElement).
+
+        Elements with rst_kinds, and their ancestors, are decoded up
+        front.  Changes made to the arena afterwards are seen by the
+        parts of the tree not yet decoded.
+        """
+        root = self._new_node(0, LazyElement)
+        _CHILDREN_SLOT.__set__(root, (self, 0, None))
+        if self._rst_kinds_pickle is None and not self._rst_kinds:
+            return root
+        # Number the nodes as they are decoded, to find those that the
+        # rst_kinds refer to
+        nodes = {0: root}
+        _CHILDREN_SLOT.__set__(root, (self, 0, nodes))
+        parents = self.parents
+
+        def get_node(i):
+            node = nodes.get(i)
+            if node is None:
+                get_node(parents[i])._children
+                node = nodes[i]
+            return node
+
+        if self._rst_kinds_pickle is not None:
+            rst_kinds = self._load_rst_kinds(get_node)
+        else:
+            rst_kinds = self.rst_kinds
+        for i, rst_kind in rst_kinds.items():
+            get_node(i).rst_kind = rst_kind
+        # Stop numbering the rest
+        nodes.clear()
+        return root
+
+    def _decode_children(self, element, i, nodes):
+        children = []
+        for j in self.children_of(i):
+            child = self._new_node(j, LazyElement)
+            child._parent = element
+            if isinstance(child, LazyElement):
+                _CHILDREN_SLOT.__set__(child, (self, j, nodes if nodes else None))
+            if nodes:
+                nodes[j] = child
+            children.append(child)
+        element._children = ChildList(element, children)
+        return element._children
+
+
+# The builtins which the rst_kinds of a tree dump can use
+_LOADABLE_BUILTINS = frozenset(('bool', 'bytes', 'complex', 'dict', 'float', 'frozenset', 'int', 'list',
+                                'set', 'slice', 'str', 'tuple'))
+
+
+class _RstKindUnpickler(pickle.Unpickler):
+    """
+    Unpickles the rst_kinds of a tree dump, only allowing the classes of
+    texi2rst's RstKind and plain builtin values, so that loading a
+    corrupt or hostile dump can't run arbitrary code.
+    """
+    def find_class(self, module, name):
+        if module == 'builtins' and name in _LOADABLE_BUILTINS:
+            return super().find_class(module, name)
+        # Only look at modules already imported, so that nothing is run
+        cls = getattr(sys.modules.get(module), name, None)
+        if isinstance(cls, type) and any(base.__name__ == 'RstKind' and base.__module__ in ('texi2rst', '__main__')
+                                         for base in cls.__mro__):
+            return cls
+        raise pickle.UnpicklingError('%s.%s is not allowed in a tree dump' % (module, name))
+
+
+# The start of every tree dump
+DUMP_MAGIC = b'T2R-TREE'
+
+# The version of the format written by TreeArena.dump, to be bumped on
+# any change to it.  After a header of the magic, this version (16 bits)
+# and the node count (32 bits) come these sections, each prefixed by its
+# length in bytes (64 bits), all little-endian:
+#   strings       UTF-8, NUL-separated: the arena's strings, followed by
+#                 the attribute keys and values and comments
+#   text          UTF-8
+#   types, names, parents, next_siblings, text_starts
+#                 the arena's columns, of 8, 32, 32, 32 and 64 bits
+#   attrs         32-bit integers: for each element with attributes, its
+#                 number, the number of attributes and a (key, value)
+#                 pair of string indices per attribute
+#   comments      32-bit (node, string index) pairs
+#   rst_kinds     a pickle of the rst_kinds, or nothing if there are none
+DUMP_FORMAT_VERSION = 1
+
+
+def dump_tree(tree, f_out):
+    """
+    Write the tree to the binary file f_out (see TreeArena.dump).
+    """
+    node_numbers = {}
+    TreeArena.from_tree(tree, node_numbers).dump(f_out, node_numbers)
+
+
+def load_tree(f_in, lazy=False):
+    """
+    Read a tree written by dump_tree from the binary file f_in: if lazy,
+    decoding the children of each element only when they are first
+    needed (see TreeArena.to_lazy_tree).  As with TreeArena.load, the
+    rst_kinds can only be of builtin types or texi2rst's RstKind classes.
+    """
+    arena = TreeArena.load(f_in)
+    if lazy:
+        return arena.to_lazy_tree()
+    return arena.to_tree()
+
+
+# The storage of Element._children, which LazyElement overrides
+_CHILDREN_SLOT = Element._children
+
+
+class LazyElement(Element):
+    """
+    An element of a tree loaded from a TreeArena whose children haven't
+    been decoded yet.  Until then, _children holds (arena, node number,
+    numbering of decoded nodes or None); the first use of them decodes
+    them, and makes this an ordinary Element.
+    """
+    __slots__ = ()
+
+    @property
+    def _children(self):
+        arena, i, nodes = _CHILDREN_SLOT.__get__(self)
+        self.__class__ = Element
+        return arena._decode_children(self, i, nodes)
+
+    @_children.setter
+    def _children(self, children):
+        self.__class__ = Element
+        self._children = children
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        if not _live_snapshots:
+            # There's no need to decode the children being replaced
+            self.__class__ = Element
+            _CHILDREN_SLOT.__set__(self, ChildList(self))
+        Element.children.fset(self, children)
+
+
+class _ArenaChildren(ChildList):
+    """
+    The children of a view of an arena node, which can't be changed.
+    """
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('the structure of a TreeArena cannot be changed')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+
+class _ArenaView:
+    """
+    Mixin for the views of arena nodes.
+    """
+    __slots__ = ()
+
+    @property
+    def _parent(self):
+        parent = self._arena.parents[self._index]
+        if parent == -1:
+            return None
+        return self._arena.node(parent)
+
+    @property
+    def _position(self):
+        arena = self._arena
+        return arena.children_of(arena.parents[self._index]).index(self._index)
+
+
+class ArenaElement(_ArenaView, Element):
+    """
+    A view of an element held in a TreeArena.
+    """
+    __slots__ = ('_arena', '_index', '__weakref__')
+
+    def __init__(self, arena, index):
+        self._arena = arena
+        self._index = index
+        self._kind_index = None
+
+    # Changes to the attributes held in the arena aren't tracked, so
+    # structural hashes of views aren't cached
+    @property
+    def _hash(self):
+        return None
+
+    @_hash.setter
+    def _hash(self, digest):
+        pass
+
+    # Nor are their texts
+    @property
+    def _text(self):
+        return None
+
+    @_text.setter
+    def _text(self, text):
+        pass
+
+    @property
+    def _kind(self):
+        arena = self._arena
+        return arena.strings[arena.names[self._index]]
+
+    @_kind.setter
+    def _kind(self, kind):
+        self._arena.names[self._index] = self._arena.intern(kind)
+
+    @property
+    def _kind_code(self):
+        return SYMBOLS.code(self._kind)
+
+    @_kind_code.setter
+    def _kind_code(self, code):
+        pass
+
+    @property
+    def _attrs(self):
+        return self._arena.attrs.get(self._index, _NO_ATTRS)
+
+    @_attrs.setter
+    def _attrs(self, attrs):
+        if attrs is _NO_ATTRS:
+            self._arena.attrs.pop(self._index, None)
+        else:
+            self._arena.attrs[self._index] = attrs
+
+    @property
+    def rst_kind(self):
+        return self._arena.rst_kinds.get(self._index)
+
+    @rst_kind.setter
+    def rst_kind(self, rst_kind):
+        if rst_kind is None:
+            self._arena.rst_kinds.pop(self._index, None)
+        else:
+            self._arena.rst_kinds[self._index] = rst_kind
+
+    @property
+    def _children(self):
+        arena = self._arena
+        return _ArenaChildren(self, map(arena.node, arena.children_of(self._index)))
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        raise TypeError('the structure of a TreeArena cannot be changed')
+
+    def get_all_text(self):
+        if self._arena._text_changes:
+            return Element.get_all_text(self)
+        return self._arena.text_of(self._index)
+
+    def get_all_elements(self, name):
+        arena = self._arena
+        start = self._index + 1
+        return [arena.node(i) for i in arena.iter_kind(name, start, arena.subtree_end(self._index))]
+
+
+class ArenaText(_ArenaView, Text):
+    """
+    A view of a Text node held in a TreeArena.
+    """
+    __slots__ = ('_arena', '_index', '__weakref__')
+
+    def __init__(self, arena, index):
+        self._arena = arena
+        self._index = index
+
+    @property
+    def data(self):
+        arena = self._arena
+        i = self._index
+        if arena._text_changes and i in arena._text_changes:
+            return arena._text_changes[i]
+        return arena.text[arena.text_starts[i]:arena.text_starts[i + 1]]
+
+    @data.setter
+    def data(self, data):
+        self._arena._text_changes[self._index] = data
+
+    def append(self, data):
+        self.data += data
+
+
+class ArenaComment(_ArenaView, Comment):
+    """
+    A view of a Comment held in a TreeArena.
+    """
+    __slots__ = ('_arena', '_index', '__weakref__')
+
+    def __init__(self, arena, index):
+        self._arena = arena
+        self._index = index
+
+    @property
+    def data(self):
+        return self._arena.comments[self._index]
+
+    @data.setter
+    def data(self, data):
+        self._arena.comments[self._index] = data
+
+
+class ArenaEntity(_ArenaView, Entity):
+    """
+    A view of an Entity held in a TreeArena.
+    """
+    __slots__ = ('_arena', '_index', '__weakref__')
+
+    def __init__(self, arena, index):
+        self._arena = arena
+        self._index = index
+
+    @property
+    def name(self):
+        arena = self._arena
+        return arena.strings[arena.names[self._index]]
+
+
+_ARENA_VIEWS = (ArenaElement, ArenaText, ArenaComment, ArenaEntity)
+
+
+class EditJournal:
+    """
+    Changes to the children of elements, recorded during a walk and
+    applied later with one splice per parent.
+
+    Edits are made relative to an anchor node, which must still be
+    among its parent's children when they are applied.  Insertions
+    next to the same anchor keep the order in which they were recorded;
+    if a node is both deleted and replaced, the last of these wins.
+    """
+    def __init__(self):
+        # parent -> (before, after, replaced), each a dict from anchor
+        # to a list of nodes
+        self._edits = {}
+
+    def __bool__(self):
+        return bool(self._edits)
+
+    def _edits_for(self, anchor):
+        parent = anchor._parent
+        if parent is None:
+            raise ValueError('%r has no parent' % (anchor, ))
+        edits = self._edits.get(parent)
+        if edits is None:
+            edits = self._edits[parent] = ({}, {}, {})
+        return edits
+
+    def insert_before(self, anchor, *nodes):
+        self._edits_for(anchor)[0].setdefault(anchor, []).extend(nodes)
+
+    def insert_after(self, anchor, *nodes):
+        self._edits_for(anchor)[1].setdefault(anchor, []).extend(nodes)
+
+    def replace(self, anchor, *nodes):
+        self._edits_for(anchor)[2][anchor] = list(nodes)
+
+    def delete(self, node):
+        self.replace(node)
+
+    def move(self, node, before=None, after=None):
+        """
+        Move node to be just before or after another node (possibly
+        with a different parent).
+        """
+        self.delete(node)
+        if before is not None:
+            self.insert_before(before, node)
+        else:
+            self.insert_after(after, node)
+
+    def apply(self, parent=None):
+        """
+        Apply the edits to the children of parent, or to those of every
+        element if parent is None.
+        """
+        if parent is None:
+            while self._edits:
+                self.apply(next(iter(self._edits)))
+            return
+        edits = self._edits.pop(parent, None)
+        if edits is None:
+            return
+        before, after, replaced = edits
+        children = []
+        found = 0
+        for child in parent._children:
+            if child in before:
+                children += before[child]
+                found += 1
+            if child in replaced:
+                children += replaced[child]
+                found += 1
+            else:
+                children.append(child)
+            if child in after:
+                children += after[child]
+                found += 1
+        if found != len(before) + len(after) + len(replaced):
+            raise ValueError('edit relative to a node no longer in %r' % (parent, ))
+        parent.children = children
+
+
+# Differences between trees: see diff_trees
+class TreeEdit:
+    """
+    One difference between two trees.
+
+    op is one of:
+      'insert'   new was added
+      'delete'   old was removed
+      'replace'  old was replaced by new, a node of another kind, or
+                 with other text, comment or entity name
+      'change'   the element old became new, which has other attributes
+                 or another rst_kind; differences in their children are
+                 given by other edits
+
+    parents are the ancestors of the node concerned, outermost first:
+    in the new tree, except for deletions.
+    """
+    __slots__ = ('op', 'old', 'new', 'parents')
+
+    def __init__(self, op, old, new, parents):
+        self.op = op
+        self.old = old
+        self.new = new
+        self.parents = parents
+
+    def __repr__(self):
+        return 'TreeEdit(%r, %r, %r)' % (self.op, self.old, self.new)
+
+
+def diff_trees(old, new):
+    """
+    Get a list of TreeEdit for the differences between the trees old and
+    new, in document order.
+
+    Subtrees with the same structural hash are skipped without looking
+    inside them, so once the hashes are known (they are cached) this
+    takes time proportional to the size of the changes.
+    """
+    edits = []
+    # Edits, and (old, new, parents) for nodes of the same kind with
+    # different hashes still to be compared, next first
+    stack = [(old, new, ())]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, TreeEdit):
+            edits.append(item)
+            continue
+        old_node, new_node, parents = item
+        if old_node.structural_hash() == new_node.structural_hash():
+            continue
+        if not isinstance(old_node, Element) or _node_kind(old_node) != _node_kind(new_node):
+            edits.append(TreeEdit('replace', old_node, new_node, parents))
+            continue
+        if (old_node.attrs != new_node.attrs
+                or _rst_kind_repr(old_node.rst_kind) != _rst_kind_repr(new_node.rst_kind)):
+            edits.append(TreeEdit('change', old_node, new_node, parents))
+        stack += reversed(_diff_children(old_node, new_node, parents))
+    return edits
+
+
+def _diff_children(old, new, parents):
+    old_children = old.children
+    new_children = new.children
+    old_hashes = [child.structural_hash() for child in old_children]
+    new_hashes = [child.structural_hash() for child in new_children]
+    # Most changes are local, so skip the common prefix and suffix
+    # before using the (quadratic) SequenceMatcher on the rest
+    start = 0
+    old_end = len(old_hashes)
+    new_end = len(new_hashes)
+    while start < old_end and start < new_end and old_hashes[start] == new_hashes[start]:
+        start += 1
+    while old_end > start and new_end > start and old_hashes[old_end - 1] == new_hashes[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    old_parents = parents + (old, )
+    new_parents = parents + (new, )
+    items = []
+    matcher = difflib.SequenceMatcher(None, old_hashes[start:old_end],
+                                      new_hashes[start:new_end], autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        old_run = old_children[start + i1:start + i2]
+        new_run = new_children[start + j1:start + j2]
+        # Pair up nodes of the same kind within the changed run, to
+        # look for the differences inside them
+        kinds = difflib.SequenceMatcher(None, [_node_kind(node) for node in old_run],
+                                        [_node_kind(node) for node in new_run], autojunk=False)
+        for kind_op, k1, k2, l1, l2 in kinds.get_opcodes():
+            if kind_op == 'equal':
+                items += [(a, b, new_parents) for a, b in zip(old_run[k1:k2], new_run[l1:l2])]
+                continue
+            if kind_op == 'replace' and k2 - k1 == l2 - l1:
+                items += [TreeEdit('replace', a, b, new_parents)
+                          for a, b in zip(old_run[k1:k2], new_run[l1:l2])]
+                continue
+            items += [TreeEdit('delete', node, None, old_parents) for node in old_run[k1:k2]]
+            items += [TreeEdit('insert', None, node, new_parents) for node in new_run[l1:l2]]
+    return items
+
+
+def _node_kind(node):
+    if isinstance(node, Element):
+        return node.kind
+    return type(node)
+
+
+# Selectors: see compile_selector
+
+# A token of the selector language, and whether whitespace came first
+# (since that is the descendant combinator)
+_SELECTOR_TOKEN = re.compile(r"""(?P<space>\s*)(?:
+    (?P<name>[\w*-]+)
+    | "(?P<dq>[^"]*)" | '(?P<sq>[^']*)'
+    | (?P<punct>[>,()\[\]=:])
+    | (?P<end>$)
+    )""", re.VERBOSE)
+
+_TEXT_TESTS = {
+    'text': lambda text, values: text in values,
+    'text-starts': lambda text, values: text.startswith(values),
+    'text-ends': lambda text, values: text.endswith(values),
+    'text-contains': lambda text, values: any(value in text for value in values),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def compile_selector(source):
+    """
+    Compile a selector, in a small language like that of CSS, into a
+    Selector.  For example:
+
+      tableentry > tableterm itemformat[command=code]
+      section:has(> sectiontitle:text("Intrinsic Procedures")) > table
+
+    A selector is a list of alternatives separated by commas, each a
+    sequence of steps, and each step a kind (or "*" for any) followed
+    by any number of predicates:
+
+      [NAME]              has the attribute
+      [NAME=VALUE]        has the attribute, with that value
+      :text(VALUE, ...)   get_all_text() is one of the values
+      :text-starts(...)   ...starts with one of them
+      :text-ends(...)     ...ends with one of them
+      :text-contains(...) ...contains one of them
+      :has(SELECTOR)      some element below matches SELECTOR, which
+                          can start with ">" to only look at children
+
+    Steps separated by ">" are those of a child, and by whitespace of a
+    descendant.  A selector starting with ">" only matches children of
+    the element searched from.  Values are names or quoted strings.
+    """
+    parser = _SelectorParser(source)
+    alternatives = parser.parse_list(None)
+    parser.take('end')
+    return Selector(source, alternatives)
+
+
+class Selector:
+    """
+    A compiled selector (see compile_selector), matching elements as
+    a list of alternatives.
+    """
+    def __init__(self, source, alternatives):
+        self.source = source
+        self._alternatives = alternatives
+        subject_kinds = {steps[-1][1][0] for steps in alternatives}
+        # The kinds of the elements that can match, if known
+        self._kinds = None if None in subject_kinds else frozenset(subject_kinds)
+        # How far below the start matches can be, if known
+        if all(combinator == '>' for steps in alternatives for combinator, _ in steps):
+            self._max_depth = max(len(steps) for steps in alternatives)
+        else:
+            self._max_depth = None
+
+    def __repr__(self):
+        return 'Selector(%r)' % self.source
+
+    def matches(self, element, parents):
+        """
+        Does element match, given its ancestors from the element
+        searched from down (as a Visitor would pass them)?
+        """
+        for steps in self._alternatives:
+            if _match_steps(steps, len(steps) - 1, element, parents):
+                return True
+        return False
+
+    def select(self, root):
+        """
+        See Element.select.
+        """
+        return list(self.iter_select(root))
+
+    def iter_select(self, root):
+        """
+        As select, but generating the matches as they are found.
+        """
+        if self.matches(root, []):
+            yield root, []
+        yield from self._iter_below(root)
+
+    def _iter_below(self, root):
+        for _, _, element in root.iter_elements(kinds=self._kinds, max_depth=self._max_depth):
+            parents = []
+            node = element._parent
+            while node is not root:
+                parents.append(node)
+                node = node._parent
+            parents.append(root)
+            parents.reverse()
+            if self.matches(element, parents):
+                yield element, parents
+
+
+def _match_steps(steps, i, element, parents):
+    """
+    Does element, with the given ancestors, match steps[:i + 1]?
+    """
+    combinator, compound = steps[i]
+    kind, tests = compound
+    if kind is not None and element._kind is not kind:
+        return False
+    for test in tests:
+        if not test(element):
+            return False
+    if i == 0:
+        # How the first step relates to the element searched from
+        if combinator == '>':
+            return len(parents) == 1
+        elif combinator == ' ':
+            return len(parents) >= 1
+        return True
+    if combinator == '>':
+        return bool(parents) and _match_steps(steps, i - 1, parents[-1], parents[:-1])
+    for depth in range(len(parents) - 1, -1, -1):
+        if _match_steps(steps, i - 1, parents[depth], parents[:depth]):
+            return True
+    return False
+
+
+class _SelectorParser:
+    """
+    Parser for compile_selector, making each alternative a list of
+    (combinator, (kind, tests)) steps.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.tokens = []
+        pos = 0
+        while True:
+            m = _SELECTOR_TOKEN.match(source, pos)
+            if m is None:
+                self.error(pos)
+            group = m.lastgroup
+            self.tokens.append((group, m.group(group), bool(m.group('space')), m.start(group)))
+            if group == 'end':
+                break
+            pos = m.end()
+        self.i = 0
+
+    def error(self, pos):
+        raise ValueError('bad selector %r at position %i' % (self.source, pos))
+
+    def peek(self):
+        return self.tokens[self.i]
+
+    def peek_punct(self, value):
+        group, token, _, _ = self.tokens[self.i]
+        return group == 'punct' and token == value
+
+    def take(self, group, value=None):
+        token = self.tokens[self.i]
+        if token[0] != group or (value is not None and token[1] != value):
+            self.error(token[3])
+        self.i += 1
+        return token[1]
+
+    def parse_list(self, relation):
+        alternatives = [self.parse_steps(relation)]
+        while self.peek_punct(','):
+            self.take('punct')
+            alternatives.append(self.parse_steps(relation))
+        return alternatives
+
+    def parse_steps(self, relation):
+        if self.peek_punct('>'):
+            self.take('punct')
+            relation = '>'
+        steps = [(relation, self.parse_compound())]
+        while True:
+            group, value, spaced, _ = self.peek()
+            if self.peek_punct('>'):
+                self.take('punct')
+                steps.append(('>', self.parse_compound()))
+            elif spaced and (group == 'name' or self.peek_punct('[') or self.peek_punct(':')):
+                steps.append((' ', self.parse_compound()))
+            else:
+                return steps
+
+    def parse_compound(self):
+        kind = None
+        tests = []
+        group, value, _, pos = self.peek()
+        if group == 'name':
+            self.take('name')
+            if value != '*':
+                kind = SYMBOLS.intern(value)
+        elif not (self.peek_punct('[') or self.peek_punct(':')):
+            self.error(pos)
+        # Predicates follow without whitespace, except perhaps for the
+        # first when there is no kind
+        first = group != 'name'
+        while first or not self.peek()[2]:
+            first = False
+            if self.peek_punct('['):
+                self.take('punct')
+                tests.append(self.parse_attribute())
+            elif self.peek_punct(':'):
+                self.take('punct')
+                tests.append(self.parse_pseudo())
+            else:
+                break
+        return (kind, tests)
+
+    def parse_attribute(self):
+        name = self.take('name')
+        # Allow for names like "xml:space"
+        while self.peek_punct(':'):
+            self.take('punct')
+            name += ':' + self.take('name')
+        if self.peek_punct('='):
+            self.take('punct')
+            expected = self.parse_value()
+            self.take('punct', ']')
+            return lambda element: element._attrs.get(name) == expected
+        self.take('punct', ']')
+        return lambda element: name in element._attrs
+
+    def parse_value(self):
+        group, value, _, pos = self.peek()
+        if group not in ('name', 'dq', 'sq'):
+            self.error(pos)
+        self.i += 1
+        return value
+
+    def parse_pseudo(self):
+        _, name, _, pos = self.peek()
+        self.take('name')
+        self.take('punct', '(')
+        if name == 'has':
+            inner = Selector(self.source, self.parse_list(' '))
+            self.take('punct', ')')
+            return lambda element: any(True for _ in inner._iter_below(element))
+        if name not in _TEXT_TESTS:
+            self.error(pos)
+        test = _TEXT_TESTS[name]
+        values = [self.parse_value()]
+        while self.peek_punct(','):
+            self.take('punct')
+            values.append(self.parse_value())
+        self.take('punct', ')')
+        values = tuple(values)
+        return lambda element: test(element.get_all_text(), values)
+
+
+# Memory accounting: see memory_usage
+class KindUsage:
+    """
+    The memory used by the elements of one kind, in bytes as given by
+    sys.getsizeof:
+
+      elements        the number of them
+      element_bytes   the elements themselves, with their lists of
+                      children
+      text_bytes      the Text, Comment and Entity nodes directly within
+                      them, with their strings
+      attr_bytes      their own attribute dicts, with the values (the
+                      keys being shared)
+      rst_kind_bytes  their rst_kinds, with the rst_kinds' own __dict__s
+    """
+    __slots__ = ('elements', 'element_bytes', 'text_bytes', 'attr_bytes', 'rst_kind_bytes')
+
+    def __init__(self):
+        self.elements = 0
+        self.element_bytes = 0
+        self.text_bytes = 0
+        self.attr_bytes = 0
+        self.rst_kind_bytes = 0
+
+    @property
+    def total_bytes(self):
+        return self.element_bytes + self.text_bytes + self.attr_bytes + self.rst_kind_bytes
+
+
+class MemoryUsage:
+    """
+    Where the memory of a tree goes, as found by memory_usage.
+
+    kinds maps each kind of element to its KindUsage, and largest is a
+    list of (bytes, element) pairs for the elements with the largest
+    trees below them, largest first.
+    """
+    __slots__ = ('kinds', 'largest')
+
+    def __init__(self, kinds, largest):
+        self.kinds = kinds
+        self.largest = largest
+
+    @property
+    def elements(self):
+        return sum(usage.elements for usage in self.kinds.values())
+
+    @property
+    def total_bytes(self):
+        return sum(usage.total_bytes for usage in self.kinds.values())
+
+    def write(self, f_out):
+        """
+        Write a table of the usage to f_out, largest kinds first.
+        """
+        f_out.write('%i bytes in %i elements\n' % (self.total_bytes, self.elements))
+        f_out.write('%-24s %9s %12s %12s %12s %12s\n'
+                    % ('kind', 'elements', 'element', 'text', 'attrs', 'rst_kind'))
+        for kind, usage in sorted(self.kinds.items(), key=lambda item: -item[1].total_bytes):
+            f_out.write('%-24s %9i %12i %12i %12i %12i\n'
+                        % (kind, usage.elements, usage.element_bytes, usage.text_bytes,
+                           usage.attr_bytes, usage.rst_kind_bytes))
+        f_out.write('attribute dicts: %i bytes\n' % sum(usage.attr_bytes for usage in self.kinds.values()))
+        f_out.write('largest subtrees:\n')
+        for size, element in self.largest:
+            f_out.write('%12i  %s\n' % (size, _element_path(element)))
+
+
+def _element_path(element):
+    """
+    Describe where an element is, as the kinds and positions of it and
+    its ancestors, e.g. "texinfo/chapter[3]/section[0]".
+    """
+    steps = []
+    while element.parent is not None:
+        steps.append('%s[%i]' % (element.kind, element.position))
+        element = element.parent
+    steps.append(element.kind)
+    return '/'.join(reversed(steps))
+
+
+def _leaf_bytes(node):
+    if type(node) is Text:
+        size = sys.getsizeof(node) + sys.getsizeof(node._data)
+        if node._pending is not None:
+            size += sys.getsizeof(node._pending) + sum(map(sys.getsizeof, node._pending))
+        return size
+    elif isinstance(node, Entity):
+        return sys.getsizeof(node) + sys.getsizeof(node.name)
+    else:
+        return sys.getsizeof(node) + sys.getsizeof(node.data)
+
+
+def memory_usage(root, largest=10):
+    """
+    Walk the tree below root (an Element), accounting for the memory
+    used by each kind of element, as a MemoryUsage, noting the largest
+    subtrees (up to the number given by largest).
+
+    Strings and rst_kinds shared between nodes are counted once for
+    each.  A lazily loaded tree is decoded in full by the walk.
+    """
+    kinds = {}
+    # The smallest of the largest subtrees found so far is at the top:
+    # (bytes, count, element), the count breaking ties
+    heap = []
+    count = 0
+
+    def start(element):
+        usage = kinds.get(element.kind)
+        if usage is None:
+            usage = kinds[element.kind] = KindUsage()
+        children = element.children
+        usage.elements += 1
+        size = sys.getsizeof(element) + sys.getsizeof(children)
+        usage.element_bytes += size
+        attrs = element._attrs
+        if attrs is not _NO_ATTRS and isinstance(attrs, dict):
+            attr_bytes = sys.getsizeof(attrs) + sum(map(sys.getsizeof, attrs.values()))
+            usage.attr_bytes += attr_bytes
+            size += attr_bytes
+        rst_kind = element.rst_kind
+        if rst_kind is not None:
+            rst_kind_bytes = sys.getsizeof(rst_kind)
+            if hasattr(rst_kind, '__dict__'):
+                rst_kind_bytes += sys.getsizeof(rst_kind.__dict__)
+            usage.rst_kind_bytes += rst_kind_bytes
+            size += rst_kind_bytes
+        return [element, usage, iter(children), size]
+
+    stack = [start(root)]
+    while stack:
+        entry = stack[-1]
+        element, usage, children, size = entry
+        for node in children:
+            if isinstance(node, Element):
+                stack.append(start(node))
+                break
+            leaf_bytes = _leaf_bytes(node)
+            usage.text_bytes += leaf_bytes
+            entry[3] += leaf_bytes
+        else:
+            stack.pop()
+            size = entry[3]
+            if stack:
+                stack[-1][3] += size
+            count += 1
+            if len(heap) < largest:
+                heapq.heappush(heap, (size, count, element))
+            elif largest and size > heap[0][0]:
+                heapq.heapreplace(heap, (size, count, element))
+    return MemoryUsage(kinds, [(size, element) for size, _, element in sorted(heap, reverse=True)])
+
+
 # Visitor base class
 class Visitor:
+    """
+    Subclasses can handle elements of a particular kind with methods
+    named previsit_KIND and postvisit_KIND (with any "-" in KIND
+    written as "_", so that previsit_foo_bar handles both "foo_bar"
+    and "foo-bar"), alongside previsit_element and postvisit_element,
+    which handle all elements.  Where both apply, the per-kind method
+    is called first; a true value from either previsit method skips the
+    element's children.  Any other method whose name starts with
+    previsit_ or postvisit_ is taken for a per-kind hook, so helpers
+    need other names.
+    """
+    # The EditJournal of the current walk
+    journal = None
+
+    @classmethod
+    def _dispatch_tables(cls):
+        """
+        Get the (previsit, postvisit) dispatch tables of this class,
+        each a pair of a dict from element kind to the function to call
+        for it, and the function for other kinds (or None).
+        """
+        tables = cls.__dict__.get('_tables')
+        if tables is None:
+            tables = cls._tables = (cls._dispatch_table('previsit_'),
+                                    cls._dispatch_table('postvisit_'))
+        return tables
+
+    @classmethod
+    def _dispatch_table(cls, prefix):
+        generic = getattr(cls, prefix + 'element')
+        if generic in _NOOP_HOOKS:
+            generic = None
+        by_kind = {}
+        for name in dir(cls):
+            if not name.startswith(prefix) or name == prefix + 'element':
+                continue
+            handler = getattr(cls, name)
+            if not callable(handler):
+                continue
+            if generic is not None:
+                handler = _both_hooks(handler, generic)
+            # Kinds can contain "_" as well as "-", so register the kind
+            # spelled as in the name and with each "_" read as "-"
+            kind = name[len(prefix):]
+            by_kind[kind] = by_kind[kind.replace('_', '-')] = handler
+        return by_kind, generic
+
+    def previsit(self, element, parents):
+        """
+        Call the previsit hooks for element.
+        """
+        by_kind, generic = self._dispatch_tables()[0]
+        handler = by_kind.get(element._kind, generic)
+        if handler is not None:
+            return handler(self, element, parents)
+
+    def postvisit(self, element, parents):
+        """
+        Call the postvisit hooks for element.
+        """
+        by_kind, generic = self._dispatch_tables()[1]
+        handler = by_kind.get(element._kind, generic)
+        if handler is not None:
+            handler(self, element, parents)
+
     def visit(self, node, parents=()):
-        if isinstance(node, Element):
-            early_exit = self.previsit_element(node, parents)
-            if early_exit:
+        """
+        Walk the tree below node in depth-first order, calling the
+        previsit and postvisit hooks around the children of each
+        element, and visit_comment, visit_text or visit_entity for the
+        other nodes.  If the previsit hooks return a true value, the
+        element's children and its postvisit hooks are skipped.
+
+        The walk uses an explicit stack rather than recursion.  The
+        "parents" passed to the element hooks is one list shared by the
+        whole walk and updated in place as it descends and returns, so
+        it is only valid during the call; hooks wanting to keep it
+        must take a copy.
+
+        Each element's children are walked as they were after its
+        previsit hooks: changes made to them later only take effect
+        after the walk moves on.  Rather than changing the children of
+        the elements being walked, hooks can record the changes in
+        self.journal; those for an element's children are applied just
+        before its postvisit hooks, and any others at the end.
+        """
+        if not isinstance(node, Element):
+            self._visit_leaf(node)
+            return
+        parents = list(parents)
+        outer_journal = self.journal
+        journal = self.journal = EditJournal()
+        edits = journal._edits
+        (previsit_by_kind, previsit_other), (postvisit_by_kind, postvisit_other) = self._dispatch_tables()
+        previsit_for_kind = previsit_by_kind.get
+        postvisit_for_kind = postvisit_by_kind.get
+        # The children of each element in "parents" (as they were after
+        # its previsit hooks), and an iterator over them
+        walked = []
+        stack = []
+        try:
+            if self.previsit(node, parents):
+                journal.apply()
                 return
-            newparents = parents + (node,)
-            for child in list(node.children):
-                self.visit(child, newparents)
-            self.postvisit_element(node, parents)
+            parents.append(node)
+            children = node._children
+            children._walkers += 1
+            walked.append(children)
+            stack.append(iter(children))
+            while stack:
+                for child in stack[-1]:
+                    if isinstance(child, Element):
+                        handler = previsit_for_kind(child._kind, previsit_other)
+                        if handler is not None and handler(self, child, parents):
+                            continue
+                        parents.append(child)
+                        children = child._children
+                        children._walkers += 1
+                        walked.append(children)
+                        stack.append(iter(children))
+                        break
+                    elif isinstance(child, Text):
+                        self.visit_text(child)
+                    else:
+                        self._visit_leaf(child)
+                else:
+                    stack.pop()
+                    walked.pop()._walkers -= 1
+                    element = parents.pop()
+                    if edits and element in edits:
+                        journal.apply(element)
+                    handler = postvisit_for_kind(element._kind, postvisit_other)
+                    if handler is not None:
+                        handler(self, element, parents)
+            journal.apply()
+        finally:
+            for children in walked:
+                children._walkers -= 1
+            self.journal = outer_journal
+
+    def visit_kinds(self, tree, kinds):
+        """
+        Like visit, but only call the previsit and postvisit hooks for
+        the elements of the given kinds (with "parents" holding all
+        of their ancestors, as before), and don't visit other nodes.
+
+        Rather than visiting the whole tree, this only follows the paths
+        leading to such elements, found via the tree's KindIndex if it
+        has one, or else by a walk of the tree which, in a tree loaded
+        lazily, only decodes the elements on those paths.
+        """
+        kinds = frozenset(kinds)
+        index = tree._kind_index
+        if index is not None:
+            wanted = index.paths_to(kinds)
+        else:
+            wanted = _paths_to(tree, kinds)
+        if not wanted:
+            return
+        parents = []
+        outer_journal = self.journal
+        journal = self.journal = EditJournal()
+        edits = journal._edits
+        previsit = self.previsit
+        walked = []
+        stack = []
+        try:
+            is_target = tree._kind in kinds
+            if is_target and previsit(tree, parents):
+                journal.apply()
+                return
+            parents.append(tree)
+            # As in visit, but also noting which elements were visited
+            children = tree._children
+            children._walkers += 1
+            walked.append(children)
+            stack.append((iter(children), is_target))
+            while stack:
+                for child in stack[-1][0]:
+                    if child not in wanted:
+                        continue
+                    is_target = child._kind in kinds
+                    if is_target and previsit(child, parents):
+                        continue
+                    parents.append(child)
+                    children = child._children
+                    children._walkers += 1
+                    walked.append(children)
+                    stack.append((iter(children), is_target))
+                    break
+                else:
+                    _, is_target = stack.pop()
+                    walked.pop()._walkers -= 1
+                    element = parents.pop()
+                    if edits and element in edits:
+                        journal.apply(element)
+                    if is_target:
+                        self.postvisit(element, parents)
+            journal.apply()
+        finally:
+            for children in walked:
+                children._walkers -= 1
+            self.journal = outer_journal
+
+    def _visit_leaf(self, node):
+        if isinstance(node, Text):
+            self.visit_text(node)
         elif isinstance(node, Comment):
             self.visit_comment(node)
-        elif isinstance(node, Text):
-            self.visit_text(node)
         elif isinstance(node, Entity):
             self.visit_entity(node)
         else:
@@ -263,3 +3142,14 @@ class NoopVisitor(Visitor):
 
     def visit_entity(self, entity):
         pass
+
+
+# The hooks of NoopVisitor, which the walks needn't call
+_NOOP_HOOKS = (NoopVisitor.previsit_element, NoopVisitor.postvisit_element)
+
+
+def _both_hooks(handler, generic):
+    def both(self, element, parents):
+        skip = handler(self, element, parents)
+        return generic(self, element, parents) or skip
+    return both
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Compare the XML backends of texi2rst on the XML snippets of
+# test_texi2rst.py, on a synthetic large manual, and on any XML files
+# given on the command line, checking that they all give the same tree.
+
+import argparse
+import ast
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import texi2rst  # noqa: E402
+
+parser = argparse.ArgumentParser(description='Benchmark the XML backends of texi2rst')
+parser.add_argument('xml_files', nargs='*', help='XML files to parse, besides the built-in inputs')
+parser.add_argument('--chapters', type=int, default=200, help='Chapters of the synthetic manual')
+parser.add_argument('--repeat', type=int, default=3, help='Times to parse each input, keeping the best')
+args = parser.parse_args()
+
+
+def backends():
+    return [backend for backend in texi2rst.XML_BACKENDS
+            if backend != 'lxml' or texi2rst.lxml_etree is not None]
+
+
+def test_inputs():
+    """
+    The XML snippets in test_texi2rst.py which every backend parses.
+    """
+    path = os.path.join(os.path.dirname(texi2rst.__file__), 'test_texi2rst.py')
+    with open(path) as f:
+        module = ast.parse(f.read())
+    for node in ast.walk(module):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and node.value.lstrip().startswith('<'):
+            try:
+                for backend in backends():
+                    texi2rst.from_xml_string(node.value, backend=backend)
+            except Exception:
+                continue
+            yield node.value.encode('utf-8')
+
+
+WORDS = ('the compiler option warning function attribute section code generation '
+         'target machine register value pointer').split()
+
+
+def sentence(rng):
+    words = ' '.join(rng.choice(WORDS) for _ in range(12))
+    return rng.choice((
+        words,
+        f'{words} <code>{rng.choice(WORDS)}</code>',
+        f'{words} <var>n</var> &dots;',
+        f'{words} &textldquo;<samp>{rng.choice(WORDS)}</samp>&textrdquo;',
+        f'{words} <option>-f{rng.choice(WORDS)}</option>',
+    )) + '.'
+
+
+def synthetic_manual(chapters):
+    """
+    A manual shaped like gcc.xml, of the given number of chapters.
+    """
+    rng = random.Random(chapters)
+    out = ['<?xml version="1.0"?>\n'
+           '<!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN" '
+           '"http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">\n'
+           '<texinfo xml:lang="en">\n<setfilename>synthetic.info</setfilename>\n']
+    for c in range(chapters):
+        out.append(f'<node name="Chapter-{c}" spaces=" "><nodename>Chapter {c}</nodename></node>\n'
+                   f'<chapter spaces=" "><sectiontitle>Chapter {c}</sectiontitle>\n')
+        for s in range(4):
+            out.append(f'<!-- c Section {c}.{s} -->\n'
+                       f'<section spaces=" "><sectiontitle>Section {c}.{s}</sectiontitle>\n')
+            out.append(f'<para>{sentence(rng)}\n{sentence(rng)}\n</para>\n')
+            out.append('<table commandarg="code" spaces=" " endspaces=" ">\n')
+            for i in range(6):
+                name = f'{rng.choice(WORDS)}-{c}-{s}-{i}'
+                out.append(f'<tableentry><tableterm><item spaces=" "><itemformat command="code">-f{name}'
+                           f'</itemformat></item>\n</tableterm><tableitem>'
+                           f'<indexcommand command="opindex" index="op" spaces=" ">'
+                           f'<indexterm index="op" number="{i}" incode="1">f{name}</indexterm></indexcommand>\n'
+                           f'<para>{sentence(rng)}\n</para></tableitem></tableentry>\n')
+            out.append('</table>\n<smallexample endspaces=" ">\n<pre xml:space="preserve">int\nmain (void)\n'
+                       '&lbrace;\n  return 0; /* <r>&dots;</r> */\n&rbrace;\n</pre></smallexample>\n</section>\n')
+        out.append('</chapter>\n')
+    out.append('</texinfo>\n')
+    return ''.join(out).encode('utf-8')
+
+
+def bench(name, data):
+    hashes = {}
+    for backend in backends():
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            trees = [texi2rst.from_xml_file(io.BytesIO(chunk), backend=backend) for chunk in data]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        hashes[backend] = [tree.structural_hash() for tree in trees]
+        print(f'{name:30} {backend:8} {best:8.3f}s')
+    if texi2rst.lxml_etree is None:
+        print(f'{name:30} {"lxml":8} (not installed)')
+    if len({tuple(h) for h in hashes.values()}) != 1:
+        print(f'{name}: the backends gave different trees')
+        sys.exit(1)
+
+
+bench('test_texi2rst.py snippets', list(test_inputs()))
+bench(f'synthetic ({args.chapters} chapters)', [synthetic_manual(args.chapters)])
+for path in args.xml_files:
+    with open(path, 'rb') as f:
+        bench(os.path.basename(path), [f.read()])
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
 from node import *
+import gc
+import io
+import pickle
+import time
+from xml.etree import ElementTree
 import unittest
 
 class NodeTests(unittest.TestCase):
@@ -31,6 +36,30 @@ class NodeTests(unittest.TestCase):
 </A>
 '''))
 
+    def test_export(self):
+        a = self.make_tree()
+        a.attrs['x'] = '1'
+        a.children[2].add_entity('dots')
+
+        self.assertEqual(list(a.children[0].iter_events()),
+                         [('start', a.children[0]), ('text', 'within b'), ('comment', 'ignore'),
+                          ('text', 'also within b'), ('end', a.children[0])])
+
+        root = a.to_etree(entities={'dots': '...'})
+        self.assertEqual(ElementTree.tostring(root, encoding='unicode'),
+                         '<A x="1"><B>within b<!--ignore-->also within b</B>foo<C>...</C></A>')
+        with self.assertRaises(ValueError):
+            a.to_etree()
+
+        out = io.StringIO()
+        a.write_sax(out)
+        self.assertEqual(out.getvalue(),
+                         '<?xml version="1.0" encoding="utf-8"?>\n'
+                         '<A x="1"><B>within b<!--ignore-->also within b</B>foo<C>&dots;</C></A>')
+        out = io.BytesIO()
+        Element('A').write_sax(out, 'iso-8859-1')
+        self.assertEqual(out.getvalue(), b'<?xml version="1.0" encoding="iso-8859-1"?>\n<A/>')
+
     def test_node_to_xmlstr(self):
         a = self.make_tree()
         xmlstr = a.toxml()
@@ -46,3 +75,857 @@ class NodeTests(unittest.TestCase):
             '''<?xml version="1.0"?>
 <!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN" "http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">
 <A/>''')
+
+    def test_slots(self):
+        a = self.make_tree()
+        for node in a.iter_depth_first():
+            self.assertFalse(hasattr(node, '__dict__'))
+
+    def test_text_append(self):
+        a = Element('A')
+        a.add_text('foo')
+        a.add_text('bar')
+        h = a.structural_hash()
+        a.add_text('baz')
+        self.assertNotEqual(a.structural_hash(), h)
+        self.assertEqual(a.children, [a.children[0]])
+        text = a.children[0]
+        self.assertEqual(text.data, 'foobarbaz')
+        text.append('!')
+        text.data = 'x'
+        self.assertEqual(text.data, 'x')
+        text.append('y')
+        self.assertEqual(a.get_all_text(), 'xy')
+        self.assertEqual(a.toxml(), '<A>xy</A>')
+
+    def test_symbols(self):
+        kind = ''.join(['sym', 'bol'])
+        a = Element(kind, {''.join(['k', 'ey']): '1'})
+        b = Element('symbol')
+        self.assertIs(a.kind, b.kind)
+        self.assertIs(a.kind, SYMBOLS.intern('symbol'))
+        self.assertEqual(SYMBOLS.name(a.kind_code), 'symbol')
+        self.assertIs(list(a.attrs)[0], SYMBOLS.intern('key'))
+        b.attrs[''.join(['k', 'ey'])] = '2'
+        self.assertIs(list(b.attrs)[0], SYMBOLS.intern('key'))
+
+        kinds = KindSet(['symbol', 'other'])
+        self.assertEqual(len(kinds), 2)
+        self.assertEqual(set(kinds), {'symbol', 'other'})
+        self.assertIn('symbol', kinds)
+        self.assertNotIn('unknown-kind', kinds)
+        self.assertTrue(a.kind_in(kinds))
+        self.assertFalse(Text('symbol').kind_in(kinds))
+        b.kind = 'third'
+        self.assertFalse(b.kind_in(kinds))
+        self.assertTrue(b.kind_in(kinds | KindSet(['third'])))
+        arena = TreeArena.from_tree(a)
+        self.assertTrue(arena.root.kind_in(kinds))
+        self.assertIs(arena.to_tree().kind, a.kind)
+
+    def test_iter_elements(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        d = Element('D')
+        b.children = [d, Text('bar')]
+        e = Element('E')
+        d.children.append(e)
+        self.assertEqual(list(a.iter_elements()),
+                         [(a, 0, b), (b, 0, d), (d, 0, e), (a, 2, c)])
+        self.assertEqual(list(a.iter_elements(kinds=KindSet(['C', 'E']))),
+                         [(d, 0, e), (a, 2, c)])
+        self.assertEqual(list(a.iter_elements(max_depth=2)),
+                         [(a, 0, b), (b, 0, d), (a, 2, c)])
+        self.assertEqual(list(a.iter_elements(prune=lambda element: element.kind == 'D')),
+                         [(a, 0, b), (b, 0, d), (a, 2, c)])
+        self.assertEqual([node for _, _, node in a.iter_nodes(max_depth=1)], [b, foo, c])
+        self.assertEqual(list(foo.iter_elements()), [])
+
+        # Deep trees don't need deep stacks
+        deep = Element('A')
+        element = deep
+        for _ in range(5000):
+            element.children.append(Element('A'))
+            element = element.children[0]
+        self.assertEqual(len(list(deep.iter_depth_first())), 5001)
+
+        # With a kind index, only the paths to the kinds are walked
+        a.kind_index()
+        self.assertEqual(list(a.iter_elements(kinds=('E', ))), [(d, 0, e)])
+
+    def test_select(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        d = Element('D', {'x': '1'})
+        e = Element('E')
+        e.add_text('hello world')
+        d.children = [e]
+        b.children = [d]
+        f = Element('D')
+        c.children = [f]
+
+        self.assertEqual(list(a.select('E')), [(e, [a, b, d])])
+        self.assertEqual([m for m, _ in a.select('D')], [d, f])
+        self.assertEqual([m for m, _ in a.select('> D')], [])
+        self.assertEqual([m for m, _ in a.select('B > D')], [d])
+        self.assertEqual([m for m, _ in a.select('A E')], [e])
+        self.assertEqual([m for m, _ in a.select('A > E')], [])
+        self.assertEqual([m for m, _ in a.select('D[x]')], [d])
+        self.assertEqual([m for m, _ in a.select('D[x="2"]')], [])
+        self.assertEqual([m for m, _ in a.select('*:text("hello world")')], [b, d, e])
+        self.assertEqual([m for m, _ in a.select('E:text-starts(bye, hello)')], [e])
+        self.assertEqual([m for m, _ in a.select('E:text-contains("o w")')], [e])
+        self.assertEqual([m for m, _ in a.select('D:has(> E), C > D')], [d, f])
+        self.assertEqual([m for m, _ in a.select('*:has(E) > D')], [d])
+        self.assertEqual(a.select_first('C D'), (f, [a, c]))
+        self.assertIsNone(a.select_first('F'))
+        matches = compile_selector('D').iter_select(a)
+        self.assertEqual(next(matches), (d, [a, b]))
+        self.assertEqual(list(matches), [(f, [a, c])])
+
+        # Queries over the kind index see changes to the tree
+        self.assertEqual([m for m, _ in a.select('D', indexed=True)], [d, f])
+        c.children = []
+        self.assertEqual([m for m, _ in a.select('D', indexed=True)], [d])
+        a.release_kind_index()
+        self.assertIsNone(a._kind_index)
+
+        for bad in ('', 'A >', 'A[x', ':text(', 'A:nosuch(x)', 'A,'):
+            with self.assertRaises(ValueError):
+                compile_selector(bad)
+
+    def test_memory_usage(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        c.attrs['x'] = 'y'
+        c.rst_kind = ('rst', )
+        usage = memory_usage(a, largest=2)
+        self.assertEqual(set(usage.kinds), {'A', 'B', 'C'})
+        self.assertEqual(usage.elements, 3)
+        self.assertEqual(usage.kinds['A'].elements, 1)
+        self.assertGreater(usage.kinds['B'].text_bytes, usage.kinds['A'].text_bytes)
+        self.assertEqual(usage.kinds['B'].attr_bytes, 0)
+        self.assertGreater(usage.kinds['C'].attr_bytes, 0)
+        self.assertGreater(usage.kinds['C'].rst_kind_bytes, 0)
+        self.assertEqual([element for _, element in usage.largest], [a, b])
+        self.assertEqual(usage.largest[0][0], usage.total_bytes)
+
+        out = io.StringIO()
+        usage.write(out)
+        self.assertIn('\n%12i  A/B[0]\n' % usage.largest[1][0], out.getvalue())
+
+    def test_snapshot(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        xml = a.toxml()
+        snapshot = a.snapshot()
+        self.assertEqual(len(snapshot), 0)
+
+        b.kind = 'X'
+        b.attrs['x'] = '1'
+        b.add_text('bar')
+        foo.data = 'baz'
+        c.rst_kind = ('rst', c)
+        d = Element('D')
+        a.children.append(d)
+        c.detach()
+        d.children.append(c)
+        self.assertEqual(len(snapshot), 5)
+        changed_xml = a.toxml()
+
+        copy = snapshot.to_tree()
+        self.assertEqual(copy.toxml(), xml)
+        self.assertIsNone(copy.children[2].rst_kind)
+        self.assertEqual(a.toxml(), changed_xml)
+
+        # Snapshots can be taken of snapshots
+        c.rst_kind = ('rst', c)
+        later = a.snapshot()
+        copy = later.to_tree()
+        self.assertEqual(copy.toxml(), changed_xml)
+        self.assertEqual(copy.children[2].children[0].rst_kind, ('rst', copy.children[2].children[0]))
+
+        # Trees made meanwhile are left alone
+        copy = snapshot.to_tree()
+        snapshot.restore()
+        self.assertEqual(copy.toxml(), xml)
+        self.assertEqual(d.children, [c])
+        self.assertEqual(len(snapshot), 5)
+        self.assertEqual(a.toxml(), xml)
+        self.assertEqual(a.children, [b, foo, c])
+        self.assertIs(c.parent, a)
+        self.assertIsNone(d.parent)
+        self.assertEqual(a.structural_hash(), self.make_tree().structural_hash())
+        self.assertEqual(later.to_tree().toxml(), changed_xml)
+        later.restore()
+        self.assertEqual(a.toxml(), changed_xml)
+
+    def test_empty_attrs(self):
+        a = Element('A')
+        b = Element('B')
+        self.assertEqual(a.attrs, {})
+        self.assertIs(a._attrs, b._attrs)
+        attrs = a.attrs
+        attrs['x'] = '1'
+        attrs['y'] = '2'
+        self.assertEqual(a.attrs, {'x': '1', 'y': '2'})
+        self.assertEqual(attrs['x'], '1')
+        self.assertEqual(b.attrs, {})
+        self.assertIsNot(a._attrs, b._attrs)
+        self.assertEqual(a.toxml(), '<A x="1" y="2"/>')
+
+    def test_write_xml(self):
+        a = self.make_tree()
+        a.attrs['z'] = '1'
+        a.attrs['a'] = '2'
+        a.children.append(Entity('lbrace'))
+        a.children.append(Text('x < y & z'))
+        f_out = io.StringIO()
+        a.write_xml(f_out)
+        self.assertEqual(
+            f_out.getvalue(),
+            '<A z="1" a="2"><B>within b<!--ignore-->also within b</B>foo<C/>'
+            '&lbrace;x &lt; y &amp; z</A>')
+        self.assertEqual(a.toxml(), f_out.getvalue())
+
+    def test_write_xml_deep(self):
+        root = elem = Element('A')
+        for i in range(5000):
+            elem = elem.add_element('B')
+        elem.add_text('leaf')
+        xmlstr = root.toxml()
+        self.assertTrue(xmlstr.startswith('<A><B><B>'))
+        self.assertTrue(xmlstr.endswith('leaf' + '</B>' * 5000 + '</A>'))
+
+    def test_visitor(self):
+        class RecordingVisitor(Visitor):
+            def __init__(self):
+                self.events = []
+                self.parents_seen = set()
+
+            def previsit_element(self, element, parents):
+                self.parents_seen.add(id(parents))
+                self.events.append(('pre', element.kind,
+                                    tuple(p.kind for p in parents)))
+                return element.kind == 'C'
+
+            def postvisit_element(self, element, parents):
+                self.events.append(('post', element.kind,
+                                    tuple(p.kind for p in parents)))
+
+            def visit_comment(self, comment):
+                self.events.append(('comment', comment.data))
+
+            def visit_text(self, text):
+                self.events.append(('text', text.data))
+
+            def visit_entity(self, entity):
+                self.events.append(('entity', entity.name))
+
+        a = self.make_tree()
+        a.children[2].add_text('skipped')
+        a.add_entity('dots')
+        v = RecordingVisitor()
+        v.visit(a)
+        self.assertEqual(v.events,
+                         [('pre', 'A', ()),
+                          ('pre', 'B', ('A',)),
+                          ('text', 'within b'),
+                          ('comment', 'ignore'),
+                          ('text', 'also within b'),
+                          ('post', 'B', ('A',)),
+                          ('text', 'foo'),
+                          ('pre', 'C', ('A',)),
+                          ('entity', 'dots'),
+                          ('post', 'A', ())])
+        # The same parents list is used throughout the walk
+        self.assertEqual(len(v.parents_seen), 1)
+
+    def test_visitor_deep(self):
+        root = elem = Element('A')
+        for i in range(5000):
+            elem = elem.add_element('B')
+        elem.add_text('leaf')
+
+        class DepthVisitor(NoopVisitor):
+            max_depth = 0
+
+            def previsit_element(self, element, parents):
+                self.max_depth = max(self.max_depth, len(parents))
+
+        v = DepthVisitor()
+        v.visit(root)
+        self.assertEqual(v.max_depth, 5000)
+
+    def test_get_all_text_cache(self):
+        a = self.make_tree()
+        b = a.children[0]
+        self.assertEqual(a.get_all_text(), 'within balso within bfoo')
+        self.assertIs(a.get_all_text(), a.get_all_text())
+
+        b.children[0].data = 'WITHIN B'
+        self.assertEqual(a.get_all_text(), 'WITHIN Balso within bfoo')
+        b.add_text('!')
+        self.assertEqual(a.get_all_text(), 'WITHIN Balso within b!foo')
+        a.children.append(Text('bar'))
+        self.assertEqual(a.get_all_text(), 'WITHIN Balso within b!foobar')
+        a.children[1] = Element('D')
+        self.assertEqual(a.get_all_text(), 'WITHIN Balso within b!bar')
+        del b.children[:]
+        self.assertEqual(a.get_all_text(), 'bar')
+        b.children = [Text('new')]
+        self.assertEqual(a.get_all_text(), 'newbar')
+        b.prepend_text('>')
+        self.assertEqual(b.get_all_text(), '>new')
+        b.collapse_to_text()
+        self.assertEqual(a.get_all_text(), '>newbar')
+
+        # Changes elsewhere, in this tree or another, keep the cache
+        text = b.get_all_text()
+        a.children.append(Text('!'))
+        self.make_tree().children[0].add_text('?')
+        self.assertIs(b.get_all_text(), text)
+        self.assertEqual(a.get_all_text(), '>newbar!')
+
+    def test_dispose(self):
+        gc.collect()
+        gc.disable()
+        try:
+            a = self.make_tree()
+            b, foo, c = a.children
+            c.attrs['x'] = '1'
+            c.rst_kind = ('rst', c)
+            a.kind_index()
+            a.dispose()
+            self.assertIsNone(b.parent)
+            self.assertIsNone(foo.parent)
+            self.assertIsNone(b.children[0].parent)
+            self.assertIsNone(a._kind_index)
+            # Nothing is left for the cycle collector
+            del a, b, foo, c
+            self.assertEqual(gc.collect(), 0)
+        finally:
+            gc.enable()
+
+    def test_kind_index(self):
+        a = self.make_tree()
+        b = a.children[0]
+        index = a.kind_index()
+        self.assertIs(a.kind_index(), index)
+        self.assertEqual(index.count('A'), 1)
+        self.assertEqual(index.count('B'), 1)
+        self.assertEqual(index.count('C'), 1)
+        self.assertEqual(index.count('D'), 0)
+
+        d = Element('D')
+        d.add_element('E')
+        b.children.append(d)
+        self.assertEqual(index.count('D'), 1)
+        self.assertEqual(index.count('E'), 1)
+        self.assertEqual(a.get_all_elements('E'), [d.children[0]])
+
+        d.kind = 'F'
+        self.assertEqual(index.count('D'), 0)
+        self.assertEqual(a.get_all_elements('F'), [d])
+
+        b.children.remove(d)
+        self.assertIsNone(d.parent)
+        self.assertEqual(index.count('F'), 0)
+        self.assertEqual(index.count('E'), 0)
+
+        b.children = [d]
+        self.assertIs(d.parent, b)
+        self.assertEqual(index.count('E'), 1)
+        b.children = []
+        self.assertEqual(index.count('E'), 0)
+        self.assertEqual(a.get_all_elements('C'), [a.children[2]])
+
+        a.release_kind_index()
+        b.children = [d]
+        self.assertEqual(index.count('E'), 0)
+        self.assertIsNot(a.kind_index(), index)
+
+    def test_visit_kinds(self):
+        a = Element('A')
+        b = a.add_element('B')
+        c1 = b.add_element('C')
+        b.add_element('D')
+        c2 = c1.add_element('C')
+        c3 = a.add_element('C')
+
+        class Recorder(NoopVisitor):
+            def __init__(self):
+                self.events = []
+
+            def previsit_element(self, element, parents):
+                self.events.append(('pre', element, len(parents)))
+
+            def postvisit_element(self, element, parents):
+                self.events.append(('post', element, len(parents)))
+
+        v = Recorder()
+        v.visit_kinds(a, ('C', ))
+        self.assertEqual(v.events,
+                         [('pre', c1, 2), ('pre', c2, 3), ('post', c2, 3),
+                          ('post', c1, 2), ('pre', c3, 1), ('post', c3, 1)])
+        self.assertEqual(a.get_all_elements('C'), [c1, c2, c3])
+
+        v = Recorder()
+        v.visit_kinds(a, ('E', ))
+        self.assertEqual(v.events, [])
+        # No index is left behind for later changes to keep up to date
+        self.assertIsNone(a._kind_index)
+
+    def test_siblings(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        self.assertIs(b.parent, a)
+        self.assertIsNone(a.parent)
+        self.assertEqual(c.position, 2)
+        self.assertIs(b.next_sibling, foo)
+        self.assertIs(c.prev_sibling, foo)
+        self.assertIsNone(b.prev_sibling)
+        self.assertIsNone(c.next_sibling)
+        self.assertIsNone(a.next_sibling)
+
+        d = Element('D')
+        foo.insert_before(d)
+        self.assertEqual(a.children, [b, d, foo, c])
+        self.assertEqual(c.position, 3)
+        e = Element('E')
+        c.insert_after(e, Text('bar'))
+        self.assertEqual(e.position, 4)
+        self.assertIs(e.parent, a)
+
+        self.assertIs(foo.detach(), foo)
+        self.assertIsNone(foo.parent)
+        self.assertIs(d.next_sibling, c)
+
+        f = Element('F')
+        d.replace_with(f, foo)
+        self.assertEqual(a.children, [b, f, foo, c, e, a.children[-1]])
+        self.assertIsNone(d.parent)
+        self.assertEqual(a.get_all_text(), 'within balso within bfoobar')
+
+        # Positions survive arbitrary list operations
+        a.children.reverse()
+        self.assertEqual(b.position, 5)
+        del a.children[0]
+        self.assertEqual(b.position, 4)
+        a.children.insert(0, d)
+        self.assertIs(b.prev_sibling, f)
+        self.assertEqual([node.position for node in a.children], list(range(6)))
+
+        # Operations relative to siblings need a parent
+        for node in (a, Element('G'), Text('baz')):
+            with self.assertRaises(ValueError):
+                node.position
+            with self.assertRaises(ValueError):
+                node.detach()
+            with self.assertRaises(ValueError):
+                node.replace_with(Element('H'))
+            with self.assertRaises(ValueError):
+                node.insert_before(Element('H'))
+            with self.assertRaises(ValueError):
+                node.insert_after(Element('H'))
+
+    def test_detach_is_linear(self):
+        def detach_every_other(n):
+            a = Element('A')
+            a.children = [Element('B') for _ in range(n)]
+            start = time.perf_counter()
+            for b in a.children[::2]:
+                b.detach()
+            elapsed = time.perf_counter() - start
+            self.assertEqual(len(a.children), n // 2)
+            return elapsed
+
+        # Quadratic time would take 16 times as long for 4 times the
+        # children; allow plenty for noise
+        small = min(detach_every_other(2000) for _ in range(3))
+        large = min(detach_every_other(8000) for _ in range(3))
+        self.assertLess(large, small * 8)
+
+    def test_edit_journal(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        d = b.add_element('D')
+
+        class Editor(NoopVisitor):
+            def __init__(self):
+                self.seen = []
+
+            def previsit_element(self, element, parents):
+                self.seen.append(element.kind)
+                if element.kind == 'B':
+                    self.journal.insert_before(element, Text('<'))
+                    self.journal.insert_after(element, Text('>'))
+                    self.journal.insert_after(element, Text('>>'))
+                elif element.kind == 'D':
+                    # Takes effect before the postvisit of B
+                    self.journal.move(element, after=c)
+                elif element.kind == 'C':
+                    self.journal.delete(element)
+
+            def postvisit_element(self, element, parents):
+                if element.kind == 'B':
+                    self.seen.append(list(element.children))
+
+        v = Editor()
+        v.visit(a)
+        self.assertEqual(v.seen[:3], ['A', 'B', 'D'])
+        self.assertNotIn(d, v.seen[3])
+        self.assertEqual(v.seen[4:], ['C'])
+        self.assertIsNone(v.journal)
+        self.assertEqual([child.data if isinstance(child, Text) else child for child in a.children],
+                         ['<', b, '>', '>>', 'foo', d])
+        self.assertIs(d.parent, a)
+        self.assertIsNone(c.parent)
+
+    def test_visitor_changes_during_walk(self):
+        # Changing the children being walked doesn't affect the walk
+        a = self.make_tree()
+        b, foo, c = a.children
+
+        class Remover(NoopVisitor):
+            def __init__(self):
+                self.seen = []
+
+            def previsit_element(self, element, parents):
+                self.seen.append(element)
+                if element is b:
+                    element.detach()
+                    c.insert_before(Element('E'))
+
+        v = Remover()
+        v.visit(a)
+        self.assertEqual(v.seen, [a, b, c])
+        self.assertEqual([child.kind for child in a.children if isinstance(child, Element)], ['E', 'C'])
+        self.assertEqual(a.children[0].data, 'foo')
+        self.assertEqual(c.position, 2)
+
+        # Changes made through a list held from before the walk copied
+        # it aren't lost
+        a = Element('A')
+        a.children = [Element(kind) for kind in 'abcd']
+        b, c = a.children[1:3]
+
+        class HeldRemover(NoopVisitor):
+            def previsit_element(self, element, parents):
+                if element is b:
+                    siblings = parents[-1].children
+                    siblings.remove(b)
+                    siblings.remove(c)
+
+        HeldRemover().visit(a)
+        self.assertEqual([child.kind for child in a.children], ['a', 'd'])
+        self.assertIsNone(b.parent)
+        self.assertIsNone(c.parent)
+
+    def test_visitor_dispatch(self):
+        a = self.make_tree()
+        b = a.children[0]
+        b.add_element('negative-option')
+        a.add_element('C').add_element('D')
+
+        class KindVisitor(NoopVisitor):
+            def __init__(self):
+                self.events = []
+
+            def previsit_B(self, element, parents):
+                self.events.append(('pre B', len(parents)))
+
+            def previsit_negative_option(self, element, parents):
+                self.events.append(('pre negative-option', len(parents)))
+
+            def previsit_C(self, element, parents):
+                self.events.append(('pre C', len(parents)))
+                # Skip the children
+                return True
+
+            def postvisit_B(self, element, parents):
+                self.events.append(('post B', len(parents)))
+
+        v = KindVisitor()
+        v.visit(a)
+        self.assertEqual(v.events,
+                         [('pre B', 1), ('pre negative-option', 2), ('post B', 1),
+                          ('pre C', 1), ('pre C', 1)])
+
+        class MixedVisitor(KindVisitor):
+            def previsit_element(self, element, parents):
+                self.events.append(element.kind)
+
+        v = MixedVisitor()
+        v.visit(a)
+        self.assertEqual(v.events,
+                         ['A', ('pre B', 1), 'B', ('pre negative-option', 2), 'negative-option', ('post B', 1),
+                          ('pre C', 1), 'C', ('pre C', 1), 'C'])
+
+        # Kinds containing "_" can be handled too
+        a.add_element('foo_bar')
+        a.add_element('foo-bar')
+
+        class UnderscoreVisitor(NoopVisitor):
+            # Not a hook
+            previsit_count = 0
+
+            def __init__(self):
+                self.events = []
+
+            def previsit_foo_bar(self, element, parents):
+                self.events.append(element.kind)
+
+        v = UnderscoreVisitor()
+        v.visit(a)
+        self.assertEqual(v.events, ['foo_bar', 'foo-bar'])
+
+    def test_tree_arena(self):
+        a = self.make_tree()
+        a.attrs['x'] = '1'
+        c = a.children[2]
+        c.add_element('B').add_text('inner')
+        c.add_entity('dots')
+        a.children[0].rst_kind = 'rst'
+        arena = TreeArena.from_tree(a)
+        self.assertEqual(len(arena), 10)
+        root = arena.root
+        self.assertIsInstance(root, Element)
+        self.assertIs(arena.node(0), root)
+        self.assertEqual(root.toxml(), a.toxml())
+        self.assertEqual(root.get_all_text(), a.get_all_text())
+        self.assertEqual(root.children[2].get_all_text(), 'inner')
+        self.assertEqual([e.get_all_text() for e in root.get_all_elements('B')],
+                         ['within balso within b', 'inner'])
+        self.assertEqual(list(arena.iter_kind('B')), [1, 7])
+        self.assertEqual(root.children[0].rst_kind, 'rst')
+        self.assertEqual(root.attrs, {'x': '1'})
+        b = root.children[0]
+        self.assertIs(b.parent, root)
+        self.assertIs(b.next_sibling, root.children[1])
+        self.assertEqual(root.children[2].position, 2)
+
+        # Views can be walked
+        class Recorder(NoopVisitor):
+            def __init__(self):
+                self.events = []
+
+            def previsit_element(self, element, parents):
+                self.events.append((element.kind, len(parents)))
+
+            def visit_text(self, text):
+                self.events.append(text.data)
+
+        v1, v2 = Recorder(), Recorder()
+        v1.visit(a)
+        v2.visit(root)
+        self.assertEqual(v1.events, v2.events)
+
+        # Everything but the structure can be changed
+        b.kind = 'D'
+        b.attrs['y'] = '2'
+        b.rst_kind = None
+        b.children[0].data = 'WITHIN B'
+        self.assertEqual(root.get_all_text(), 'WITHIN Balso within bfooinner')
+        with self.assertRaises(TypeError):
+            b.children = []
+        with self.assertRaises(TypeError):
+            b.children.append(Text('x'))
+
+        copy = arena.to_tree()
+        self.assertIsInstance(copy, Element)
+        self.assertNotIsInstance(copy, ArenaElement)
+        self.assertEqual(copy.toxml(), root.toxml())
+        self.assertEqual(copy.children[0].attrs, {'y': '2'})
+        self.assertIn('<D y="2">WITHIN B', copy.toxml())
+
+    def test_dump_load(self):
+        a = self.make_tree()
+        a.attrs['x'] = 'café'
+        a.children[2].add_entity('dots')
+        b = a.children[0]
+        b.rst_kind = ('title', b)
+        f = io.BytesIO()
+        dump_tree(a, f)
+        data = f.getvalue()
+        self.assertTrue(data.startswith(DUMP_MAGIC))
+
+        copy = load_tree(io.BytesIO(data))
+        self.assertEqual(copy.toxml(), a.toxml())
+        self.assertEqual(copy.attrs, {'x': 'café'})
+        # References to nodes within rst_kinds are to the new nodes
+        self.assertEqual(copy.children[0].rst_kind, ('title', copy.children[0]))
+        self.assertIs(copy.children[0].parent, copy)
+        self.assertEqual(copy.children[2].position, 2)
+
+        arena = TreeArena.load(io.BytesIO(data))
+        self.assertEqual(arena.root.toxml(), a.toxml())
+        self.assertIs(arena.root.children[0].rst_kind[1], arena.node(1))
+        self.assertEqual([m for m, _ in arena.root.select('A[x] > B')], [arena.node(1)])
+        self.assertEqual(list(arena.root.attrs), ['x'])
+
+        # A view can be dumped in turn
+        f = io.BytesIO()
+        arena.dump(f)
+        self.assertEqual(load_tree(io.BytesIO(f.getvalue())).toxml(), a.toxml())
+
+        # Loading rst_kinds can't run arbitrary code
+        b.rst_kind = ElementTree.Element('title')
+        f = io.BytesIO()
+        dump_tree(a, f)
+        with self.assertRaises(pickle.UnpicklingError):
+            load_tree(io.BytesIO(f.getvalue()))
+
+        with self.assertRaises(ValueError):
+            load_tree(io.BytesIO(b'<texinfo/>'))
+        with self.assertRaises(ValueError):
+            load_tree(io.BytesIO(data[:8] + b'\xff\xff' + data[10:]))
+        with self.assertRaises(ValueError):
+            load_tree(io.BytesIO(data[:-10]))
+
+    def test_lazy_load(self):
+        a = self.make_tree()
+        a.children[0].add_text('in b')
+        a.children[2].children = [Element('D'), Element('E')]
+        a.children[2].children[1].add_text('in e')
+        f = io.BytesIO()
+        dump_tree(a, f)
+        data = f.getvalue()
+
+        copy = load_tree(io.BytesIO(data), lazy=True)
+        self.assertIsInstance(copy, LazyElement)
+        c = copy.children[2]
+        self.assertIs(type(copy), Element)
+        self.assertIsInstance(c, LazyElement)
+        self.assertIsInstance(copy.children[0], LazyElement)
+        self.assertEqual(c.kind, 'C')
+        self.assertEqual(c.children[1].get_all_text(), 'in e')
+        self.assertIs(c.children[1].parent, c)
+        self.assertIsInstance(copy.children[0], LazyElement)
+        self.assertEqual(copy.toxml(), a.toxml())
+        self.assertEqual(copy.structural_hash(), a.structural_hash())
+
+        # Replacing the children of a stub needn't decode them
+        copy = load_tree(io.BytesIO(data), lazy=True)
+        stub = copy.children[0]
+        stub.children = [Text('x')]
+        self.assertIs(type(stub), Element)
+        self.assertEqual(stub.toxml(), '<B>x</B>')
+
+        # visit_kinds only decodes the paths to the elements it visits
+        copy = load_tree(io.BytesIO(data), lazy=True)
+
+        class KindVisitor(NoopVisitor):
+            def __init__(self):
+                self.seen = []
+
+            def previsit_element(self, element, parents):
+                self.seen.append(element.get_all_text())
+
+        v = KindVisitor()
+        v.visit_kinds(copy, ('E', ))
+        self.assertEqual(v.seen, ['in e'])
+        self.assertIsInstance(copy.children[0], LazyElement)
+        self.assertIsInstance(copy.children[2].children[0], LazyElement)
+
+        # Elements with rst_kinds are decoded up front, so that they can
+        # be referred to
+        e = a.children[2].children[1]
+        e.rst_kind = ('rst', e)
+        f = io.BytesIO()
+        dump_tree(a, f)
+        copy = load_tree(io.BytesIO(f.getvalue()), lazy=True)
+        self.assertIsInstance(copy.children[0], LazyElement)
+        e = copy.children[2].children[1]
+        self.assertEqual(e.rst_kind, ('rst', e))
+
+    def test_structural_hash(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        h = a.structural_hash()
+        self.assertEqual(len(h), 16)
+        self.assertEqual(h, self.make_tree().structural_hash())
+        self.assertIs(a.structural_hash(), h)
+        hc = c.structural_hash()
+
+        # Every kind of change below a node changes its hash, but not
+        # those of unchanged siblings
+        changes = [lambda: b.children[0].__setattr__('data', 'x'),
+                   lambda: b.children[1].__setattr__('data', 'x'),
+                   lambda: b.__setattr__('kind', 'D'),
+                   lambda: b.attrs.__setitem__('x', '1'),
+                   lambda: b.add_entity('dots'),
+                   lambda: b.children.pop(0),
+                   lambda: b.__setattr__('children', []),
+                   lambda: foo.__setattr__('data', 'bar')]
+        seen = {h}
+        for change in changes:
+            change()
+            new = a.structural_hash()
+            self.assertNotIn(new, seen)
+            seen.add(new)
+            self.assertIs(c.structural_hash(), hc)
+
+        # Attribute order doesn't matter
+        d1 = Element('D', {'x': '1', 'y': '2'})
+        d2 = Element('D', {'y': '2', 'x': '1'})
+        d1.rst_kind = d2.rst_kind = ('rst', 1)
+        self.assertEqual(d1.structural_hash(), d2.structural_hash())
+        self.assertNotEqual(d1.structural_hash(), Element('D').structural_hash())
+        self.assertNotEqual(Text('x').structural_hash(), Comment('x').structural_hash())
+
+        arena = TreeArena.from_tree(a)
+        self.assertEqual(arena.root.structural_hash(), a.structural_hash())
+
+        # rst_kinds are covered by their repr, including changes made
+        # to them in place once reported
+        class Kind:
+            def __init__(self, name):
+                self.name = name
+
+            def __repr__(self):
+                return 'Kind(%r)' % self.name
+
+        kind = Kind('x')
+        h = a.structural_hash()
+        c.rst_kind = kind
+        self.assertNotEqual(a.structural_hash(), h)
+        h = a.structural_hash()
+        kind.name = 'y'
+        self.assertEqual(a.structural_hash(), h)
+        rst_kinds_changed()
+        self.assertNotEqual(a.structural_hash(), h)
+
+    def test_diff_trees(self):
+        def make_tree():
+            a = Element('A')
+            for i in range(20):
+                b = Element('B', {'n': str(i)})
+                b.add_text('text %i' % i)
+                a.children.append(b)
+            return a
+
+        old = make_tree()
+        new = make_tree()
+        self.assertEqual(diff_trees(old, new), [])
+
+        new.children[3].children[0].data = 'changed'
+        new.children[5].attrs['x'] = '1'
+        new.children[9].rst_kind = 'rst'
+        del new.children[12]
+        new.children.insert(16, Comment('new'))
+        new.children[17].children.append(Element('C'))
+        edits = diff_trees(old, new)
+        self.assertEqual([(e.op, e.old, e.new) for e in edits],
+                         [('replace', old.children[3].children[0], new.children[3].children[0]),
+                          ('change', old.children[5], new.children[5]),
+                          ('change', old.children[9], new.children[9]),
+                          ('delete', old.children[12], None),
+                          ('insert', None, new.children[16]),
+                          ('insert', None, new.children[17].children[1])])
+        self.assertEqual(edits[0].parents, (new, new.children[3]))
+        self.assertEqual(edits[3].parents, (old, ))
+
+        # Whole trees of other kinds are replaced
+        edits = diff_trees(old, Element('X'))
+        self.assertEqual([(e.op, e.old) for e in edits], [('replace', old)])
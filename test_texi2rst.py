@@ -2,7 +2,10 @@
 
 from texi2rst import *
 
+import mmap
+import tempfile
 import unittest
+from unittest import mock
 
 class Texi2RstTests(unittest.TestCase):
     def setUp(self):
@@ -14,7 +17,7 @@ class Texi2RstTests(unittest.TestCase):
         w.finish()
         return w.f_out.getvalue()
 
-    def make_rst_strings(self, doc):
+    def make_rst_strings(self, *docs):
         class StringOpener(RstOpener):
             def __init__(self):
                 self.dict_ = OrderedDict()
@@ -27,7 +30,8 @@ class Texi2RstTests(unittest.TestCase):
 
         opener = StringOpener()
         w = RstWriter(None, opener)
-        w.visit(doc)
+        for doc in docs:
+            w.visit(doc)
         w.finish()
         result = OrderedDict()
         for k in opener.dict_:
@@ -90,6 +94,98 @@ class PruningTests(Texi2RstTests):
         out = self.make_rst_string(doc)
         self.assertEqual(u'', out)
 
+class XmlFileTests(Texi2RstTests):
+    xml_src = (
+'''<?xml version="1.0"?>
+<!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN" "http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">
+<texinfo xml:lang="en">
+<!-- c foo&dots;   -->
+<node name="a&textrsquo;b" spaces=" "><nodename>x</nodename></node>
+<para>int main &lbrace;&rbrace;&noeos; @dots{} \\u2018q\\u2019   </para>
+<pre xml:space="preserve">  a&amp;b&lt;   </pre>
+<para><![CDATA[dropped]]> <code>x</code> </para>
+</texinfo>''')
+
+    def test_same_tree(self):
+        expected = from_xml_string(self.xml_src, backend='minidom')
+        doc = from_xml_file(io.BytesIO(self.xml_src.encode('utf-8')))
+        self.assertEqual(doc.toxml(), expected.toxml())
+        self.assertEqual(doc.structural_hash(), expected.structural_hash())
+
+        # However the input is split up
+        parser = make_xml_parser()
+        data = self.xml_src.encode('utf-8')
+        for i in range(len(data)):
+            parser.feed(data[i:i + 1])
+        self.assertEqual(parser.close().structural_hash(), expected.structural_hash())
+
+    @unittest.skipIf(lxml_etree is None, 'lxml is not installed')
+    def test_lxml(self):
+        xml_src = self.xml_src.replace('<![CDATA[dropped]]>', '')
+        expected = from_xml_string(xml_src)
+        parser = make_xml_parser('lxml')
+        data = xml_src.encode('utf-8')
+        for i in range(0, len(data), 7):
+            parser.feed(data[i:i + 7])
+        self.assertEqual(parser.close().structural_hash(), expected.structural_hash())
+        doc = from_xml_string('<texinfo><para>&dots;</para></texinfo>', backend='lxml')
+        self.assertEqual(doc.toxml(), '<document><texinfo><para>...</para></texinfo></document>')
+
+        with self.assertRaisesRegex(ValueError, "Unhandled entity: '&nosuch;'"):
+            from_xml_string(xml_src.replace('&dots;', '&nosuch;'), backend='lxml')
+        with self.assertRaisesRegex(ValueError, 'CDATA'):
+            from_xml_string(self.xml_src, backend='lxml')
+
+    def test_unhandled_entity(self):
+        with self.assertRaisesRegex(ValueError, "Unhandled entity: '&nosuch;'"):
+            from_xml_file(io.BytesIO(b'<texinfo><para>&nosuch;</para></texinfo>'))
+
+    def test_open_xml_file(self):
+        # With a character split between chunks of the mapping
+        xml_src = self.xml_src.replace('<![CDATA[dropped]]>', '\u2018')
+        expected = from_xml_string(xml_src)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.xml')
+            with open(path, 'wb') as f_out:
+                f_out.write(xml_src.encode('utf-8'))
+            with mock.patch('texi2rst.XML_READ_SIZE', 3):
+                for backend in XML_BACKENDS:
+                    with open_xml_file(path) as f_in:
+                        self.assertIsInstance(f_in, mmap.mmap)
+                        doc = from_xml_file(f_in, backend=backend)
+                        self.assertEqual(doc.structural_hash(), expected.structural_hash())
+
+            # The mapping can still be closed after an error
+            with open(path, 'wb') as f_out:
+                f_out.write(b'<texinfo><para>&nosuch;</para></texinfo>')
+            with open_xml_file(path) as f_in:
+                with self.assertRaises(ValueError):
+                    from_xml_file(f_in)
+
+            # An empty file can't be mapped
+            open(path, 'wb').close()
+            with open_xml_file(path) as f_in:
+                self.assertNotIsInstance(f_in, mmap.mmap)
+                self.assertEqual(f_in.read(), b'')
+
+    def test_entities(self):
+        self.assertEqual(translate_entities('&lt;a&dots;&#123;&amp;'), '&lt;a...&#123;&amp;')
+        with self.assertRaisesRegex(ValueError, "Unhandled entity: '&nosuch;'"):
+            translate_entities('&lbrace;&nosuch;')
+
+        args = parser.parse_args(['gcc.xml', '--entity', 'nosuch=<&">', '--entity', 'dots=…'])
+        entities = OrderedDict(ENTITIES)
+        entities.update(args.entity)
+        xml_src = '<texinfo x="&nosuch;"><para>&nosuch;&dots;</para><!-- &nosuch; --></texinfo>'
+        for backend in XML_BACKENDS:
+            doc = from_xml_file(io.BytesIO(xml_src.encode('utf-8')), entities, backend)
+            texinfo = doc.children[0]
+            self.assertEqual(texinfo.attrs['x'], '<&">')
+            self.assertEqual(texinfo.get_all_text(), '<&">…')
+            self.assertEqual(texinfo.children[1].data, ' <&">')
+        with self.assertRaises(SystemExit):
+            parser.parse_args(['gcc.xml', '--entity', 'amp=&'])
+
 class MenuTests(Texi2RstTests):
     def test_menu(self):
         xml_src = u'''
@@ -129,6 +225,92 @@ class MenuTests(Texi2RstTests):
         self.assertEqual(u'.. _c-implementation:\n',
                          out)
 
+class StreamingTests(Texi2RstTests):
+    xml_src = (
+'''<texinfo>
+<top>
+   <sectiontitle>Top-level title</sectiontitle>
+   <para>Top-level text.</para>
+</top>
+<node name="Chapter-1" spaces=" "><nodename>Chapter 1</nodename></node>
+<chapter>
+  <sectiontitle>Chapter 1 title</sectiontitle>
+  <para>Chapter 1 uses <code>frobnicate</code>.</para>
+  <section spaces=" ">
+     <sectiontitle>Chapter 1 Section 1 title</sectiontitle>
+     <para>Chapter 1 Section 1 text.</para>
+     <anchor name="End-of-1">End of 1</anchor>
+  </section>
+</chapter>
+<node name="Chapter-2" spaces=" "><nodename>Chapter 2</nodename></node>
+<chapter>
+  <sectiontitle>Common Function Attributes</sectiontitle>
+  <table commandarg="code" spaces=" " endspaces=" ">
+<tableentry><tableterm><item spaces=" "><itemformat command="code">frobnicate</itemformat></item>
+</tableterm><tableitem><para>Frobnicate it.
+</para></tableitem></tableentry>
+</table>
+</chapter>
+<unnumbered><sectiontitle>Index</sectiontitle><para>The end.</para></unnumbered>
+</texinfo>
+''')
+
+    def test_iter_chapters(self):
+        trees = list(iter_chapters(io.BytesIO(self.xml_src.encode('utf-8'))))
+        self.assertEqual([[child.kind for child in tree.children[0].children] for tree in trees],
+                         [['top', 'node', 'chapter'], ['node', 'chapter'], ['unnumbered']])
+        with self.assertRaises(ValueError):
+            next(iter_chapters(io.BytesIO(b'<texinfo/>'), backend='minidom'))
+
+    def test_convert_chapters(self):
+        # The same output as when converting the whole tree, with the
+        # option directive of chapter 2 and the toctree of both chapters
+        # known from the start, and the anchor at the end of chapter 1
+        # moved into chapter 2
+        f_in = io.BytesIO(self.xml_src.encode('utf-8'))
+        out = self.make_rst_strings(*convert_chapters(f_in, self.ctxt))
+        self.assertEqual(out, self.make_rst_strings(convert_to_rst(from_xml_string(self.xml_src), self.ctxt)))
+        self.assertEqual(list(out), ['gcc', 'chapter-1-title', 'chapter-1-section-1-title',
+                                     'common-function-attributes'])
+        self.assertIn('chapter-1-title\n  common-function-attributes\n', out['gcc'])
+        self.assertIn('Chapter 1 uses :gcc-attr:`frobnicate`.', out['chapter-1-title'])
+        self.assertTrue(out['common-function-attributes'].startswith('.. _chapter-2:\n.. _end-of-1:\n'))
+
+    def test_scan_chapter(self):
+        # The pre-scan finds what the conversion would
+        xml_src = self.xml_src.replace('<unnumbered>', '''<chapter>
+  <sectiontitle>Configuration</sectiontitle>
+  <section spaces=" ">
+    <sectiontitle>Options</sectiontitle>
+    <table commandarg="code" spaces=" " endspaces=" ">
+<tableentry><tableterm><item spaces=" "><itemformat command="code">--enable-foo</itemformat></item>
+</tableterm><tableitem><para>Enable foo.</para></tableitem></tableentry>
+<tableentry><tableterm><item spaces=" "><itemformat command="code">--with-bar <r>(deprecated)</r></itemformat></item>
+</tableterm><tableitem><para>With bar.</para></tableitem></tableentry>
+<tableentry><tableterm><item spaces=" "><itemformat command="code">--disable-baz</itemformat></item>
+</tableterm><tableitem><indexcommand command="opindex" index="op" spaces=" "><indexterm index="op" number="1">-disable-baz</indexterm></indexcommand>
+<para>Disable baz.</para></tableitem></tableentry>
+<tableentry><tableterm><item spaces=" "><itemformat command="code">TMPDIR</itemformat></item>
+</tableterm><tableitem><para>Where to put files.</para></tableitem></tableentry>
+    </table>
+  </section>
+</chapter>
+<unnumbered><sectiontitle>Contributors to GCC</sectiontitle><para>Thanks.</para></unnumbered>
+<unnumbered>''').replace('frobnicate</itemformat>', '''frobnicate</itemformat></item>
+</tableterm><tableitem><para>Frobnicate it.</para></tableitem></tableentry>
+<tableentry><tableterm><item spaces=" "><itemformat command="code">vector</itemformat>''')
+        scan = ConversionState()
+        for tree in iter_chapters(io.BytesIO(xml_src.encode('utf-8'))):
+            scan_chapter(tree, scan)
+        state = ConversionState()
+        convert_to_rst(from_xml_string(xml_src), self.ctxt, state)
+        self.assertEqual(scan.output_files, ['chapter-1-title', 'common-function-attributes', 'configuration',
+                                             'contributors-to-gcc'])
+        self.assertEqual(scan.output_files, state.output_files)
+        self.assertEqual(scan.option_directives, {'frobnicate': 'gcc-attr', '--enable-foo': 'option',
+                                                  '--with-bar ': 'option'})
+        self.assertEqual(scan.option_directives, state.option_directives)
+
 class InlineMarkupTests(Texi2RstTests):
     def test_command(self):
         xml_src = '<texinfo>Before <command>gcc</command> after</texinfo>'
@@ -655,6 +837,16 @@ diff /tmp/O2-opts /tmp/O3-opts | grep enabled
 '''),
             out)
 
+    def test_default_language(self):
+        xml_src = ('''<texinfo><chapter><sectiontitle>GNU Objective-C Features</sectiontitle>
+<smallexample endspaces=" "><pre xml:space="preserve">int x;</pre></smallexample>
+</chapter><smallexample endspaces=" "><pre xml:space="preserve">int y;</pre></smallexample></texinfo>''')
+        doc = from_xml_string(xml_src)
+        doc = fixup_examples(doc, GccContext())
+        out = self.make_rst_string(doc)
+        self.assertIn('.. code-block:: objective-c\n\n  int x;', out)
+        self.assertIn('.. code-block:: c++\n\n  int y;', out)
+
     def test_group_and_ellipsis(self):
         # Example of a <group> wrapping the <pre>, with "&dots;"
         # entity and embedded markup.
@@ -1125,6 +1317,62 @@ First para of attributes
 
 ''')
 
+    def test_diff_conversions(self):
+        xml_src = u'''
+<texinfo>
+  <para>Top level para.</para>
+  <node name="Standards" spaces=" "><nodename>Standards</nodename></node>
+  <chapter spaces=" ">
+    <sectiontitle>Language Standards Supported by GCC</sectiontitle>
+    <para>First para of standards</para>
+  </chapter>
+  <node name="Function-Attributes" spaces=" "><nodename>Function Attributes</nodename></node>
+  <chapter spaces=" ">
+    <sectiontitle>Declaring Attributes of Functions</sectiontitle>
+    <para>First para of attributes</para>
+    <para>Second para of <code>attributes</code></para>
+  </chapter>
+</texinfo>
+'''
+        old = convert_to_rst(from_xml_string(xml_src), self.ctxt)
+        new = convert_to_rst(from_xml_string(xml_src), self.ctxt)
+        self.assertEqual(diff_conversions(old, new), {})
+
+        new = convert_to_rst(from_xml_string(xml_src.replace('Second para', 'Changed para')), self.ctxt)
+        diffs = diff_conversions(old, new)
+        self.assertEqual(list(diffs), [('declaring-attributes-of-functions.rst', 'function-attributes')])
+        [edit] = diffs[('declaring-attributes-of-functions.rst', 'function-attributes')]
+        self.assertEqual(edit.op, 'replace')
+        self.assertEqual(edit.new.data, 'Changed para of ')
+
+    def test_dump_rst_kinds(self):
+        import node
+        para = Element('para')
+        para.rst_kind = Directive('note')
+        code = para.add_element('code')
+        code.rst_kind = InlineMarkup('option')
+        f = io.BytesIO()
+        node.dump_tree(para, f)
+        copy = node.load_tree(io.BytesIO(f.getvalue()))
+        self.assertEqual(repr(copy.rst_kind), repr(para.rst_kind))
+        self.assertEqual(repr(copy.children[0].rst_kind), "InlineMarkup('option')")
+
+    def test_rst_kind_hashes(self):
+        import node
+        para = Element('para')
+        para.add_text('text')
+        epoch = node._rst_kinds_epoch
+        para.rst_kind = InlineMarkup('code')
+        table = Element('table')
+        table.rst_kind = Table(table, self.ctxt)
+        # Making rst_kinds doesn't affect the hashes of existing trees
+        self.assertEqual(node._rst_kinds_epoch, epoch)
+        h = para.structural_hash()
+        para.rst_kind.name = 'var'
+        self.assertNotEqual(node._rst_kinds_epoch, epoch)
+        self.assertNotEqual(para.structural_hash(), h)
+        self.assertEqual(repr(table.rst_kind), "Table(<table>, debug=False)")
+
 class TestIter(Texi2RstTests):
     def test_traversal(self):
         xml_src = u'''<A>
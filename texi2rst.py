@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
 import io
+import mmap
 import os
 import re
 import sys
 import xml.dom.minidom
+import xml.parsers.expat
+import xml.sax.saxutils
 from collections import OrderedDict
 
-from node import Comment, Element, NoopVisitor, Text, Visitor
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+from node import Comment, Element, KindSet, NoopVisitor, Text, Visitor, diff_trees, memory_usage, rst_kinds_changed
 
 """
 gcc.xml created from a gcc build/gcc tree using:
@@ -69,53 +78,490 @@ def convert_from_xml(xmlnode):
     return new_node
 
 
-def from_xml_string(xml_src):
-    # Hack: not sure how to correctly handle entities using
-    # xml.dom.minidom (if it is indeed possible), so do a textual
-    # substitution first:
-    # FIXME: use correct unicode chars for the results
-    xml_src = xml_src.replace('&arobase;', '@')
-    xml_src = xml_src.replace('&bullet;', '*')
-    xml_src = xml_src.replace('&copyright;', '(C)')
-    xml_src = xml_src.replace('&dots;', '...')
-    xml_src = xml_src.replace('&enddots;', '…')
-    xml_src = xml_src.replace('&eosperiod;', '.')
-    xml_src = xml_src.replace('&comma;', ',')
-    xml_src = xml_src.replace('&equiv;', '==')
-    xml_src = xml_src.replace('&lbrace;', '{')
-    xml_src = xml_src.replace('&linebreak;', '\n')
-    xml_src = xml_src.replace('&rbrace;', '}')
-    xml_src = xml_src.replace('&slashbreak;', '')
-    xml_src = xml_src.replace('&minus;', '-')
-    xml_src = xml_src.replace('&nbsp;', ' |nbsp| ')
-    xml_src = xml_src.replace('&noeos;', '')
-    xml_src = xml_src.replace('&tex;', 'Tex')
-    xml_src = xml_src.replace('&textmdash;', '---')
-    xml_src = xml_src.replace('&textndash;', '--')
-    xml_src = xml_src.replace('&textldquo;', "'")
-    xml_src = xml_src.replace('&textrdquo;', "'")
-    xml_src = xml_src.replace('&textlsquo;', "'")
-    xml_src = xml_src.replace('&textrsquo;', "'")
-    xml_src = xml_src.replace('&eosquest;', '?')
-    xml_src = xml_src.replace('&expansion;', '→')
-    xml_src = xml_src.replace('&result;', '⇒')
-    xml_src = xml_src.replace('&errorglyph;', 'error')
-    xml_src = xml_src.replace('\\u2018', '‘')
-    xml_src = xml_src.replace('\\u2019', '’')
-
+# The texinfo entities, and what they are replaced by; manuals using
+# others can add to it with --entity
+# FIXME: use correct unicode chars for the results
+ENTITIES = OrderedDict([
+    ('arobase', '@'),
+    ('bullet', '*'),
+    ('copyright', '(C)'),
+    ('dots', '...'),
+    ('enddots', '…'),
+    ('eosperiod', '.'),
+    ('comma', ','),
+    ('equiv', '=='),
+    ('lbrace', '{'),
+    ('linebreak', '\n'),
+    ('rbrace', '}'),
+    ('slashbreak', ''),
+    ('minus', '-'),
+    ('nbsp', ' |nbsp| '),
+    ('noeos', ''),
+    ('tex', 'Tex'),
+    ('textmdash', '---'),
+    ('textndash', '--'),
+    ('textldquo', "'"),
+    ('textrdquo', "'"),
+    ('textlsquo', "'"),
+    ('textrsquo', "'"),
+    ('eosquest', '?'),
+    ('expansion', '→'),
+    ('result', '⇒'),
+    ('errorglyph', 'error'),
+])
+
+
+BUILTIN_XML_ENTITIES = ('quot', 'amp', 'apos', 'lt', 'gt')
+
+ENTITY_RE = re.compile('&([a-zA-Z][a-zA-Z0-9]*);')
+
+
+def translate_entities(data, entities=ENTITIES):
+    """
+    Replace the entities in data from the given table, in one pass,
+    leaving those built into XML alone and complaining about any others.
+    """
+    def replace(m):
+        name = m.group(1)
+        replacement = entities.get(name)
+        if replacement is not None:
+            return replacement
+        if name in BUILTIN_XML_ENTITIES:
+            return m.group(0)
+        raise ValueError('Unhandled entity: %r' % m.group(0))
+    return ENTITY_RE.sub(replace, data)
+
+
+# Escapes that makeinfo leaves in text, and what they are replaced by
+ESCAPES = {
+    '\\u2018': '‘',
+    '\\u2019': '’',
     # It is used in manual pages
-    xml_src = xml_src.replace('@dots{}', '...')
+    '@dots{}': '...',
+}
 
-    # Complain about any entities still present
-    for m in re.finditer('(&[a-z]+;)', xml_src):
-        BUILTIN_XML_ENTITIES = ('&quot;', '&amp;', '&apos;', '&lt;', '&gt;')
-        if m.group(1) not in BUILTIN_XML_ENTITIES:
-            raise ValueError('Unhandled entity: %r' % m.group(1))
+ESCAPE_RE = re.compile('|'.join(re.escape(escape) for escape in ESCAPES))
+
+
+def fixup_strings(data):
+    """
+    Replace the escapes that makeinfo leaves in text, once its entities
+    have been replaced.
+    """
+    if '\\' not in data and '@' not in data:
+        return data
+    return ESCAPE_RE.sub(lambda m: ESCAPES[m.group(0)], data)
+
+
+# Number of bytes from_xml_file reads at a time
+XML_READ_SIZE = 1 << 16
+
+
+def open_xml_file(path):
+    """
+    Open the file at path for from_xml_file or convert_chapters to read:
+    memory-mapped where possible, so that the parser is fed the bytes
+    of the mapping itself (see read_xml), or else (if it is empty, or a
+    pipe, say) as a binary file.  Either can be used in a with statement.
+    """
+    with open(path, 'rb') as f_in:
+        try:
+            return mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+    return open(path, 'rb')
 
-    dom = xml.dom.minidom.parseString(xml_src)
-    tree = convert_from_xml(dom)
-    tree = fixup_whitespace(tree)
-    return tree
+
+def read_xml(f_in):
+    """
+    Yield what is left of the binary file f_in, XML_READ_SIZE bytes at a
+    time, for a parser to be fed.  From an mmap, the chunks are views of
+    the mapping rather than copies, each released when the next is asked
+    for, or when the generator is closed (as it should be, to let the
+    mapping be closed).
+    """
+    if not isinstance(f_in, mmap.mmap):
+        while True:
+            data = f_in.read(XML_READ_SIZE)
+            if not data:
+                return
+            yield data
+    with memoryview(f_in) as view:
+        while f_in.tell() < len(view):
+            start = f_in.tell()
+            f_in.seek(min(start + XML_READ_SIZE, len(view)))
+            data = view[start:f_in.tell()]
+            try:
+                yield data
+            finally:
+                data.release()
+
+
+def entities_dtd(entities):
+    """
+    Get a DTD declaring the given entities (a mapping from names to
+    replacements), for the parser to replace them as it parses.  It is
+    all ASCII, to suit any encoding of the document.
+    """
+    decls = []
+    for name, replacement in entities.items():
+        # The replacement is parsed as markup, so its special characters
+        # need escaping twice
+        replacement = re.sub('[&<%"]|[^\\x00-\\x7f]', lambda m: '&#38;#%i;' % ord(m.group(0)), replacement)
+        decls.append('<!ENTITY %s "%s">\n' % (name, replacement))
+    return ''.join(decls)
+
+
+XML_NAMESPACE = '{http://www.w3.org/XML/1998/namespace}'
+
+
+class XmlTreeBuilder:
+    """
+    Build a tree from the events of an XML parser, giving the same tree
+    as convert_from_xml does from a DOM, with the whitespace already
+    fixed up as by fixup_whitespace.
+
+    It is a parser target as lxml defines them, which ExpatXmlParser
+    also feeds from the callbacks of expat.  The entities table (by
+    default ENTITIES) is used for any entities within comments, which
+    parsers leave alone.
+
+    With part_kind (e.g. 'chapter'), the document is built in parts:
+    each time an element of that kind ends as a grandchild of the root,
+    what has been built since the previous part is taken out of the
+    tree as a part of its own (see take_part), and added to self.parts.
+    """
+    def __init__(self, entities=ENTITIES, part_kind=None):
+        self.entities = entities
+        self.root = Element('document', OrderedDict())
+        # (element, children, pieces of text not yet in a Text node)
+        # for each element being built
+        self.stack = [(self.root, [], [])]
+        self.in_cdata = False
+        self.part_kind = part_kind
+        self.parts = []
+
+    def close(self):
+        # Parsers complain about unclosed elements themselves, although
+        # lxml calls this after other errors too
+        while self.stack:
+            self.end(None)
+        return self.root
+
+    def flush_text(self):
+        _, children, pieces = self.stack[-1]
+        if pieces:
+            data = fixup_strings(''.join(pieces))
+            pieces.clear()
+            if data:
+                children.append(Text(data))
+
+    def start(self, tag, attrib):
+        self.flush_text()
+        attrs = OrderedDict()
+        for name, value in attrib.items():
+            if name.startswith(XML_NAMESPACE):
+                # As lxml gives it
+                name = 'xml:' + name[len(XML_NAMESPACE):]
+            attrs[name] = fixup_strings(value)
+        element = Element(tag, attrs)
+        self.stack[-1][1].append(element)
+        self.stack.append((element, [], []))
+
+    def end(self, tag):
+        self.flush_text()
+        element, children, _ = self.stack.pop()
+        element.children = strip_whitespace(element.kind, children)
+        if element.kind == self.part_kind and len(self.stack) == 2:
+            self.parts.append(self.take_part())
+
+    def take_part(self):
+        """
+        Take what has been built since the previous part out of the
+        tree, as a tree of its own: copies of the elements still being
+        built (the root and the element holding the parts, typically
+        <texinfo>), holding the children they have had since then.
+        """
+        part = None
+        for element, children, _ in reversed(self.stack):
+            copy = Element(element.kind, element.attrs)
+            if part is None:
+                copy.children = strip_whitespace(element.kind, children[:])
+                children.clear()
+            else:
+                # The last child is the element still being built
+                copy.children = strip_whitespace(element.kind, children[:-1]) + [part]
+                del children[:-1]
+            part = copy
+        return part
+
+    def data(self, data):
+        # CDATA sections are dropped, as by convert_from_xml
+        if not self.in_cdata:
+            self.stack[-1][2].append(data)
+
+    def comment(self, text):
+        self.flush_text()
+        text = fixup_strings(translate_entities(text, self.entities))
+        self.stack[-1][1].append(Comment(text.rstrip()))
+
+    def start_cdata(self):
+        self.flush_text()
+        self.in_cdata = True
+
+    def end_cdata(self):
+        self.in_cdata = False
+
+    def pi(self, target, data):
+        raise ValueError()
+
+
+class ExpatXmlParser:
+    """
+    Parse XML with expat, building a tree as it goes with an
+    XmlTreeBuilder.
+
+    The entities are replaced by expat itself, from a DTD made from the
+    entities table that stands in for the one named by the document.
+    """
+    def __init__(self, entities=ENTITIES):
+        self.entities = entities
+        self.builder = XmlTreeBuilder(entities)
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.UseForeignDTD(True)
+        self.parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+        self.parser.ExternalEntityRefHandler = self.external_entity_ref
+        self.parser.SkippedEntityHandler = self.skipped_entity
+        self.parser.StartElementHandler = self.builder.start
+        self.parser.EndElementHandler = self.builder.end
+        self.parser.CharacterDataHandler = self.builder.data
+        self.parser.CommentHandler = self.builder.comment
+        self.parser.StartCdataSectionHandler = self.builder.start_cdata
+        self.parser.EndCdataSectionHandler = self.builder.end_cdata
+        self.parser.ProcessingInstructionHandler = self.builder.pi
+
+    def feed(self, data):
+        self.parser.Parse(data, False)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        return self.builder.close()
+
+    def external_entity_ref(self, context, base, system_id, public_id):
+        dtd_parser = self.parser.ExternalEntityParserCreate(context)
+        dtd_parser.Parse(entities_dtd(self.entities), True)
+        return 1
+
+    def skipped_entity(self, name, is_parameter_entity):
+        raise ValueError('Unhandled entity: %r' % ('&%s;' % name))
+
+
+# A comment, or an entity as ENTITY_RE matches them
+COMMENT_OR_ENTITY_RE = re.compile('<!--.*?-->|' + ENTITY_RE.pattern, re.S)
+
+
+class MinidomXmlParser:
+    """
+    Parse XML with xml.dom.minidom, converting the DOM to a tree with
+    convert_from_xml, as texi2rst used to.  The whole document is held
+    in memory, and its entities are replaced textually, as minidom
+    can't be told what they are.
+    """
+    def __init__(self, entities=ENTITIES):
+        self.entities = entities
+        # Outside comments, the replacements are parsed as markup
+        self.escaped_entities = OrderedDict((name, xml.sax.saxutils.escape(replacement, {'"': '&quot;'}))
+                                            for name, replacement in entities.items())
+        self.chunks = []
+
+    def feed(self, data):
+        # Decoded all at once, as a character may be split between chunks
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.chunks.append(bytes(data))
+
+    def close(self):
+        def replace(m):
+            if m.group(1) is None:
+                return translate_entities(m.group(0), self.entities)
+            return translate_entities(m.group(0), self.escaped_entities)
+        xml_src = b''.join(self.chunks).decode('utf-8')
+        self.chunks = []
+        xml_src = fixup_strings(COMMENT_OR_ENTITY_RE.sub(replace, xml_src))
+        dom = xml.dom.minidom.parseString(xml_src)
+        tree = convert_from_xml(dom)
+        tree = fixup_whitespace(tree)
+        return tree
+
+
+# The start of an XML document, up to the name of its root element
+XML_PROLOG_RE = re.compile(rb"""
+    ((?:<\?xml.*?\?>)?(?:\s+|<!--.*?-->|<\?.*?\?>)*)
+    (?:<!DOCTYPE\s+[^\s\[>]+
+       (?:\s+(?:SYSTEM|PUBLIC\s+(?:"[^"]*"|'[^']*'))\s*(?:"[^"]*"|'[^']*'))?
+       \s*(?:\[(.*?)\])?\s*>
+       ((?:\s+|<!--.*?-->|<\?.*?\?>)*))?
+    <([^\s/>!?]+)
+""", re.S | re.X)
+
+# The longest prolog LxmlXmlParser looks through
+XML_PROLOG_LIMIT = 1 << 20
+
+
+class LxmlXmlParser:
+    """
+    Parse XML with lxml, if it is installed, building a tree as it goes
+    with an XmlTreeBuilder as the target of the parser.
+
+    lxml doesn't let a DTD stand in for the one named by the document,
+    as ExpatXmlParser does, so the entities are declared by rewriting
+    the document's prolog to have an internal DTD subset of them (and
+    not name any other DTD).  lxml reports CDATA sections as text, so
+    they are rejected rather than dropped; makeinfo doesn't write them.
+    """
+    def __init__(self, entities=ENTITIES):
+        self.entities = entities
+        self.builder = XmlTreeBuilder(entities)
+        self.parser = lxml_etree.XMLParser(target=self.builder, huge_tree=True, no_network=True)
+        # The start of the document, until the prolog has been rewritten
+        self.prolog = b''
+        # The end of the data fed so far, to find CDATA sections split
+        # between feeds
+        self.tail = b''
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        else:
+            data = bytes(data)
+        if b'<![CDATA[' in self.tail + data[:8] or b'<![CDATA[' in data:
+            raise ValueError('CDATA sections are not supported with lxml')
+        self.tail = data[-8:]
+        if self.prolog is None:
+            self.parse(data)
+            return
+        self.prolog += data
+        m = XML_PROLOG_RE.match(self.prolog)
+        if m:
+            head, subset, misc, name = m.groups()
+            dtd = (subset or b'') + entities_dtd(self.entities).encode('ascii')
+            doctype = b'<!DOCTYPE ' + name + b' [' + dtd + b']>'
+            prolog, self.prolog = self.prolog, None
+            self.parse(head + doctype + (misc or b'') + prolog[m.start(4) - 1:])
+        elif len(self.prolog) > XML_PROLOG_LIMIT:
+            # Leave it to lxml to complain
+            prolog, self.prolog = self.prolog, None
+            self.parse(prolog)
+
+    def close(self):
+        if self.prolog is not None:
+            prolog, self.prolog = self.prolog, None
+            self.parse(prolog)
+        try:
+            return self.parser.close()
+        except lxml_etree.XMLSyntaxError as e:
+            raise self.convert_error(e)
+
+    def parse(self, data):
+        try:
+            self.parser.feed(data)
+        except lxml_etree.XMLSyntaxError as e:
+            raise self.convert_error(e)
+
+    def convert_error(self, error):
+        m = re.match("Entity '(.+)' not defined", error.msg)
+        if m:
+            return ValueError('Unhandled entity: %r' % ('&%s;' % m.group(1)))
+        return error
+
+
+XML_BACKENDS = OrderedDict([
+    ('expat', ExpatXmlParser),
+    ('minidom', MinidomXmlParser),
+    ('lxml', LxmlXmlParser),
+])
+
+
+def make_xml_parser(backend='expat', entities=ENTITIES):
+    """
+    Get a parser for one of XML_BACKENDS, with feed and close methods,
+    close returning the tree.
+
+    The 'auto' backend is the fastest available.  That is expat, even
+    where lxml is installed, as most of the time goes on building the
+    tree (see scripts/bench-xml-backends.py).  The 'lxml' backend falls
+    back to expat where lxml isn't installed.
+    """
+    if backend == 'auto' or (backend == 'lxml' and lxml_etree is None):
+        backend = 'expat'
+    return XML_BACKENDS[backend](entities)
+
+
+def from_xml_file(f_in, entities=ENTITIES, backend='expat'):
+    """
+    Parse the XML read from the binary file f_in, a chunk at a time
+    (see read_xml), into a tree, as from_xml_string does with a string.
+    """
+    parser = make_xml_parser(backend, entities)
+    with contextlib.closing(read_xml(f_in)) as chunks:
+        for data in chunks:
+            parser.feed(data)
+    return parser.close()
+
+
+def from_xml_string(xml_src, entities=ENTITIES, backend='expat'):
+    parser = make_xml_parser(backend, entities)
+    parser.feed(xml_src)
+    return parser.close()
+
+
+def iter_chapters(f_in, entities=ENTITIES, backend='expat'):
+    """
+    Parse the XML read from the binary file f_in a chunk at a time, as
+    from_xml_file does, but rather than building one tree, yield a tree
+    for each top-level <chapter> as soon as it has been parsed (see
+    XmlTreeBuilder), then one of whatever follows the last.  Each tree
+    holds what came before its chapter since the previous one, such as
+    its <node>, within copies of the elements enclosing it.
+
+    Only one chapter is held at a time, as long as the caller drops
+    each tree before asking for the next.
+    """
+    parser = make_xml_parser(backend, entities)
+    builder = getattr(parser, 'builder', None)
+    if builder is None:
+        raise ValueError('The %s backend cannot parse a chapter at a time' % backend)
+    builder.part_kind = 'chapter'
+    with contextlib.closing(read_xml(f_in)) as chunks:
+        for data in chunks:
+            parser.feed(data)
+            while builder.parts:
+                yield builder.parts.pop(0)
+    tree = parser.close()
+    while builder.parts:
+        yield builder.parts.pop(0)
+    yield tree
+
+
+def strip_whitespace(kind, children):
+    """
+    Strip redundant Text nodes from the children of an element of the
+    given kind, returning the children to keep.
+    """
+    if kind in ('pre', 'definitionterm'):
+        return children
+
+    if kind == 'para':
+        # Strip trailing whitespace within <para>
+        if len(children) == 1 and isinstance(children[0], Text):
+            children[0].data = children[0].data.rstrip()
+        return children
+
+    # Within other kinds of element, fully strip
+    # pure-whitespace text nodes.
+    return [child for child in children
+            if not (isinstance(child, Text) and child.data.isspace())]
 
 
 def fixup_whitespace(tree):
@@ -124,25 +570,9 @@ def fixup_whitespace(tree):
         Strip redundant Text nodes
         """
         def previsit_element(self, element, parents):
-            if element.kind in ('pre', 'definitionterm'):
-                return
-
-            if element.kind == 'para':
-                # Strip trailing whitespace within <para>
-                text = element.get_sole_text()
-                if text:
-                    text.data = text.data.rstrip()
-                return
-
-            # Within other kinds of element, fully strip
-            # pure-whitespace text nodes.
-            new_children = []
-            for child in element.children:
-                if isinstance(child, Text):
-                    if child.data.isspace():
-                        continue
-                new_children.append(child)
-            element.children = new_children
+            children = strip_whitespace(element.kind, element.children)
+            if children is not element.children:
+                element.children = children
 
         def visit_comment(self, comment):
             comment.data = comment.data.rstrip()
@@ -202,6 +632,16 @@ def fixup_comments(tree):
     return tree
 
 
+# Elements dropped by prune
+PRUNED_KINDS = KindSet(('filename', 'preamble', 'setfilename', 'clear',
+                        'dircategory', 'direntry', 'vskip',
+                        'titlepage',
+                        'set', 'macro', 'settitle',
+                        'defcodeindex', 'syncodeindex',
+                        'paragraphindent',
+                        'nodenext', 'nodeprev', 'nodeup'))
+
+
 def prune(tree):
     class Pruner(NoopVisitor):
         def previsit_element(self, element, parents):
@@ -213,18 +653,7 @@ def prune(tree):
             element.children = new_children
 
         def should_strip(self, child):
-            if not isinstance(child, Element):
-                return False
-            if child.kind in ('filename', 'preamble', 'setfilename', 'clear',
-                              'dircategory', 'direntry', 'vskip',
-                              'titlepage',
-                              'set', 'macro', 'settitle',
-                              'defcodeindex', 'syncodeindex',
-                              'paragraphindent',
-                              'nodenext', 'nodeprev', 'nodeup'):
-                return True
-            else:
-                return False
+            return child.kind_in(PRUNED_KINDS)
 
     Pruner().visit(tree)
     return tree
@@ -244,8 +673,11 @@ def is_directive(element, name):
     return isinstance(element.rst_kind, Directive) and element.rst_kind.name == name
 
 
+INDEX_KINDS = KindSet(('cindex', 'findex', 'vindex', 'kindex', 'indexcommand'))
+
+
 def is_movable_index(element):
-    return (element.kind in ('cindex', 'findex', 'vindex', 'kindex', 'indexcommand')
+    return (element.kind_in(INDEX_KINDS)
             and len(element.children) == 1 and is_directive(element.children[0], 'index'))
 
 
@@ -266,93 +698,106 @@ def fixup_menus(tree):
         be rendered using the given descriptions.
     """
     class MenuFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            if element.kind == 'menu':
-                element.rst_kind = Directive('toctree')
-
-            if element.kind == 'menuentry':
-                menunode = element.first_element_named('menunode')
-                menudescription = element.first_element_named('menudescription')
-                if menunode and menudescription:
-                    # Prune the menuentry, giving it an explicit title.
-                    element.rst_kind = ToctreeEntry()
-                    element.children = menudescription.children
-                    # FIXME: express this cross-reference at the Node level:
-                    data = menunode.get_all_text()
-                    label = convert_text_to_label(data)
-                    element.children = [Text(label)]
+        def previsit_menu(self, element, parents):
+            element.rst_kind = Directive('toctree')
+
+        def previsit_menuentry(self, element, parents):
+            menunode = element.first_element_named('menunode')
+            menudescription = element.first_element_named('menudescription')
+            if menunode and menudescription:
+                # Prune the menuentry, giving it an explicit title.
+                element.rst_kind = ToctreeEntry()
+                element.children = menudescription.children
+                # FIXME: express this cross-reference at the Node level:
+                data = menunode.get_all_text()
+                label = convert_text_to_label(data)
+                element.children = [Text(label)]
 
     MenuFixer().visit(tree)
     return tree
 
 
-def split(tree):
-    class Splitter(NoopVisitor):
-        MAPPING = {
-                'target-description-macros-and-functions': 'target-macros',
-                'built-in-functions-specific-to-particular-target-machines': 'target-builtins',
-                'runtime-influencing-runtime-behavior-with-environment-variables': 'runtime'
-        }
+class Splitter:
+    MAPPING = {
+            'target-description-macros-and-functions': 'target-macros',
+            'built-in-functions-specific-to-particular-target-machines': 'target-builtins',
+            'runtime-influencing-runtime-behavior-with-environment-variables': 'runtime'
+    }
 
-        def __init__(self):
-            self.split_kinds = ('chapter', 'section', )
-
-        @classmethod
-        def _prune_filename(cls, text):
-            if '--' in text:
-                text = text.split('--')[0]
-            text = text.lower()
-            for c in ' /':
-                text = text.replace(c, '-')
-            for c in "()?',.:_":
-                text = text.replace(c, '')
-            text = text.strip('+').strip('-')
-            text = text.replace('[no-changes]-', '')
-            text = text.replace('[new]-', '')
-            text = text.replace('#', '')
-            text = re.sub(r'-+', '-', text)
-
-            if text in cls.MAPPING:
-                return cls.MAPPING[text]
-
-            return text
-
-        def should_split(self, element, text, parent_text):
-            if element.kind in self.split_kinds:
-                return True
-            # split '$target Option' subsections
-            elif (args and 'gcc.xml' in args.xml_file and element.kind == 'subsection'
-                    and (text.endswith('Options')
-                         or text.endswith('Function Attributes')
-                         or text == 'Options for System V'
-                         or parent_text == 'Built-in Functions Specific to Particular Target Machines')):
-                return True
-            elif (args and 'gccint.xml' in args.xml_file and element.kind == 'subsection'
-                    and parent_text in ('The gcc Subdirectory', 'Directives used within DejaGnu tests',
-                                        'Tuple specific accessors', 'Defining the Output Assembler Language',
-                                        'Stack Layout and Calling Conventions')):
-                return True
-            elif text == 'Contributors to GCC':
-                return True
-            elif (args and 'gm2.xml' in args.xml_file and element.kind == 'subsection'):
-                return True
-            else:
-                return False
+    def __init__(self):
+        self.split_kinds = ('chapter', 'section', )
+
+    @classmethod
+    def _prune_filename(cls, text):
+        if '--' in text:
+            text = text.split('--')[0]
+        text = text.lower()
+        for c in ' /':
+            text = text.replace(c, '-')
+        for c in "()?',.:_":
+            text = text.replace(c, '')
+        text = text.strip('+').strip('-')
+        text = text.replace('[no-changes]-', '')
+        text = text.replace('[new]-', '')
+        text = text.replace('#', '')
+        text = re.sub(r'-+', '-', text)
+
+        if text in cls.MAPPING:
+            return cls.MAPPING[text]
+
+        return text
+
+    def should_split(self, element, text, parent_text):
+        if element.kind in self.split_kinds:
+            return True
+        # split '$target Option' subsections
+        elif (args and 'gcc.xml' in args.xml_file and element.kind == 'subsection'
+                and (text.endswith('Options')
+                     or text.endswith('Function Attributes')
+                     or text == 'Options for System V'
+                     or parent_text == 'Built-in Functions Specific to Particular Target Machines')):
+            return True
+        elif (args and 'gccint.xml' in args.xml_file and element.kind == 'subsection'
+                and parent_text in ('The gcc Subdirectory', 'Directives used within DejaGnu tests',
+                                    'Tuple specific accessors', 'Defining the Output Assembler Language',
+                                    'Stack Layout and Calling Conventions')):
+            return True
+        elif text == 'Contributors to GCC':
+            return True
+        elif (args and 'gm2.xml' in args.xml_file and element.kind == 'subsection'):
+            return True
+        else:
+            return False
 
-        def previsit_element(self, element, parents):
-            sectiontitle = element.first_element_named('sectiontitle')
-            text = sectiontitle.get_all_text() if sectiontitle else None
-            psectiontitle = parents[-1].first_element_named('sectiontitle') if parents else None
+    def split(self, tree):
+        # Only elements with titles get split, so look for those
+        split = set()
+        for sectiontitle, parents in list(tree.select('* > sectiontitle')):
+            element = parents[-1]
+            if element in split:
+                continue
+            split.add(element)
+            text = sectiontitle.get_all_text()
+            psectiontitle = parents[-2].first_element_named('sectiontitle') if len(parents) > 1 else None
             parent_text = psectiontitle.get_all_text() if psectiontitle else None
             if self.should_split(element, text, parent_text):
                 if text:
                     element.rst_kind = OutputFile(self._prune_filename(text))
 
+
+def split(tree, state=None):
     class ToctreeAdder(NoopVisitor):
         """
         Add toctree directives referencing the split content
         """
+        def __init__(self, state):
+            self.state = state
+
         def previsit_element(self, element, parents):
+            # Converting a chapter at a time, the top-level files are
+            # noted, and the first one's toctree gets those of every
+            # chapter from the pre-scan
+            top_level = self.state is not None and len(parents) == 1
             new_children = []
             toctree = None
             for child in element.children:
@@ -360,19 +805,25 @@ def split(tree):
                     if is_directive(child, 'toctree'):
                         toctree = child
                     if isinstance(child.rst_kind, OutputFile):
-                        toctree_element = Element('toctree-element', {})
-                        toctree_element.rst_kind = ToctreeEntry()
-                        toctree_element.children = [Text(child.rst_kind.name)]
-                        # Try to consolidate all toctree entries into one
-                        # toctree:
-                        if toctree:
-                            if not self.contains_toc_element(toctree, toctree_element.get_all_text()):
-                                toctree.children.append(toctree_element)
-                        else:
-                            toctree = Element('toctree', {})
-                            toctree.rst_kind = Directive('toctree')
-                            toctree.children = [toctree_element]
-                            new_children.append(toctree)
+                        names = [child.rst_kind.name]
+                        if top_level:
+                            if self.state.scan is not None and not self.state.output_files:
+                                names = self.state.scan.output_files
+                            self.state.output_files.append(child.rst_kind.name)
+                        for name in names:
+                            toctree_element = Element('toctree-element', {})
+                            toctree_element.rst_kind = ToctreeEntry()
+                            toctree_element.children = [Text(name)]
+                            # Try to consolidate all toctree entries into one
+                            # toctree:
+                            if toctree:
+                                if not self.contains_toc_element(toctree, name):
+                                    toctree.children.append(toctree_element)
+                            else:
+                                toctree = Element('toctree', {})
+                                toctree.rst_kind = Directive('toctree')
+                                toctree.children = [toctree_element]
+                                new_children.append(toctree)
 
                 new_children.append(child)
             element.children = new_children
@@ -384,12 +835,12 @@ def split(tree):
                     return True
             return False
 
-    Splitter().visit(tree)
-    ToctreeAdder().visit(tree)
+    Splitter().split(tree)
+    ToctreeAdder(state).visit(tree)
     return tree
 
 
-def fixup_merge_toctree(tree):
+def fixup_merge_toctree(tree, state=None):
     class MergeToctreeFixer(NoopVisitor):
         def __init__(self):
             self.seen_toctree_entries = set()
@@ -398,7 +849,7 @@ def fixup_merge_toctree(tree):
             if isinstance(element.rst_kind, ToctreeEntry):
                 name = element.get_all_text()
                 if name in self.seen_toctree_entries:
-                    parents[-1].children.remove(element)
+                    self.journal.delete(element)
                 else:
                     self.seen_toctree_entries.add(name)
 
@@ -406,7 +857,7 @@ def fixup_merge_toctree(tree):
         def previsit_element(self, element, parents):
             if is_directive(element, 'toctree'):
                 if not element.children:
-                    parents[-1].children.remove(element)
+                    self.journal.delete(element)
 
     class ToctreeFolderVisitor(NoopVisitor):
         def __init__(self):
@@ -442,16 +893,16 @@ def fixup_merge_toctree(tree):
                             text.data = parent.rst_kind.name + '/' + text.data
                         break
 
-    MergeToctreeFixer().visit(tree)
+    reuse(state, MergeToctreeFixer).visit(tree)
     MergeTreeRootFixer().visit(tree)
 
-    foldercreator = ToctreeFolderVisitor()
+    foldercreator = reuse(state, ToctreeFolderVisitor)
     foldercreator.visit(tree)
     ToctreeFolderCreator(foldercreator.mapping).visit(tree)
     return tree
 
 
-def fixup_nodes(tree, ctxt):
+def fixup_nodes(tree, ctxt, state=None):
     """
     Given:
       <node name="C-Implementation" spaces=" ">
@@ -507,48 +958,55 @@ def fixup_nodes(tree, ctxt):
       Element
         <anchor>
         ...content...
+
+    When converting a chapter at a time (with a ConversionState), a
+    <node> or <anchor> at the very end of a chapter is held back, to be
+    moved into the start of the next one.
     """
     class NodeFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            if element.kind == 'node':
-                nodename = element.first_element_named('nodename')
-                text = nodename.get_sole_text()
-                if nodename and text:
-                    element.children = []
-                    label = convert_text_to_label(text.data)
-                    element.rst_kind = Label(label)
+        def previsit_node(self, element, parents):
+            nodename = element.first_element_named('nodename')
+            text = nodename.get_sole_text()
+            if nodename and text:
+                element.children = []
+                label = convert_text_to_label(text.data)
+                element.rst_kind = Label(label)
 
-            if element.kind == 'anchor':
-                text = element.get_sole_text()
-                if text:
-                    element.children = []
-                    label = convert_text_to_label(text.data)
-                    element.rst_kind = Label(label)
+        def previsit_anchor(self, element, parents):
+            text = element.get_sole_text()
+            if text:
+                element.children = []
+                label = convert_text_to_label(text.data)
+                element.rst_kind = Label(label)
 
     def move_nodes(tree):
-        # Gather a list of (parent, child) pairs
+        # Gather the elements in depth-first order, before moving any
         if ctxt.debug:
             for node in tree.iter_depth_first():
                 print(node)
 
-        edges = list(tree.iter_depth_first_edges())
-        for i, (parent, child) in enumerate(edges):
+        elements = [element for _, _, element in tree.iter_elements()]
+        if state is not None:
+            # Those held back go after the <texinfo>, where they would
+            # be were this part of the whole tree
+            elements[1:1] = state.trailing_nodes
+        for i, child in enumerate(elements[:-1]):
             if ctxt.debug:
-                print(i, parent, child)
-            if child.is_element('node') or child.is_element('anchor'):
-
-                def get_next_child_element():
-                    for _, cand_child in edges[i + 1:]:  # noqa: B023
-                        if isinstance(cand_child, Element):
-                            return cand_child
-
-                next_parent = get_next_child_element()
-                if next_parent:
-                    if ctxt.debug:
-                        print('\nMOVING %r from %r to %r\n'
-                              % (child, parent, next_parent))
-                    parent.children.remove(child)
-                    next_parent.children.insert(0, child)
+                print(i, child.parent, child)
+            if child.kind in ('node', 'anchor'):
+                next_parent = elements[i + 1]
+                if ctxt.debug:
+                    print('\nMOVING %r from %r to %r\n'
+                          % (child, child.parent, next_parent))
+                if child.parent is not None:
+                    child.detach()
+                next_parent.children.insert(0, child)
+        if state is not None:
+            state.trailing_nodes = []
+            if elements and elements[-1].kind in ('node', 'anchor'):
+                if elements[-1].parent is not None:
+                    elements[-1].detach()
+                state.trailing_nodes.append(elements[-1])
 
     NodeFixer().visit(tree)
 
@@ -572,12 +1030,11 @@ def fixup_option_refs(tree):
         # have a leading dash.
         # Conditionally retain options (or else they will be
         # stripped at output)
-        def previsit_element(self, element, parents):
-            if element.kind == 'option':
-                firstchild = element.children[0]
-                if isinstance(firstchild, Text):
-                    if firstchild.data.startswith('-'):
-                        element.rst_kind = InlineMarkup('option')
+        def previsit_option(self, element, parents):
+            firstchild = element.children[0]
+            if isinstance(firstchild, Text):
+                if firstchild.data.startswith('-'):
+                    element.rst_kind = InlineMarkup('option')
 
     OptionRefFixer().visit(tree)
     return tree
@@ -593,7 +1050,7 @@ def fixup_empty_texts(tree):
     return tree
 
 
-def fixup_ignored_strings(tree):
+def fixup_ignored_strings(tree, state=None):
     class IgnoredTextFixer(NoopVisitor):
         IGNORED = ('Keyword Index', 'Concept Index', 'Index of Directives', 'Library Index')
 
@@ -604,24 +1061,25 @@ def fixup_ignored_strings(tree):
             # Remove all <itemprepend>&bullet;</itemprepend>
             if (element.kind == 'itemprepend'
                     or (element.kind == 'sectiontitle' and element.get_all_text() in self.IGNORED)):
-                parents[-1].children.remove(element)
+                self.journal.delete(element)
             elif element.kind == 'sectiontitle':
                 self.first_section_seen = True
 
             if not self.first_section_seen and element.kind == 'para' and args:
-                parents[-1].children.remove(element)
+                self.journal.delete(element)
 
-    IgnoredTextFixer().visit(tree)
+    reuse(state, IgnoredTextFixer).visit(tree)
     return tree
 
 
 def fixup_vars_in_samps(tree):
     class VarsInSampsFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            if element.kind in ('samp', 'file'):
-                for i, child in enumerate(element.children):
-                    if isinstance(child, Element) and child.kind == 'var':
-                        element.children[i] = Text(child.get_all_text())
+        def previsit_samp(self, element, parents):
+            for i, child in enumerate(element.children):
+                if isinstance(child, Element) and child.kind == 'var':
+                    element.children[i] = Text(child.get_all_text())
+
+        previsit_file = previsit_samp
 
     VarsInSampsFixer().visit(tree)
     return tree
@@ -637,30 +1095,29 @@ def fixup_element_spacing(tree):
             return element.is_element('r') or (isinstance(element, Element) and element.kind == 'code')
 
         # Wrap option and var elements with a space character
-        def postvisit_element(self, element, parents):
-            if element.kind in ('option', 'var', 'code'):
-                parent = parents[-1]
-                i = parent.children.index(element)
-                if i + 1 < len(parent.children):
-                    rsibling = parent.children[i + 1]
-                    if isinstance(rsibling, Text):
-                        if not rsibling.data[0] in self.ALLOWED_CHARS_AFTER:
-                            rsibling.data = ' ' + rsibling.data
-                    elif self.element_needs_space_p(rsibling):
-                        parent.children.insert(i + 1, Text(' '))
-                if i > 0:
-                    lsibling = parent.children[i - 1]
-                    if isinstance(lsibling, Text):
-                        if not lsibling.data[-1] in self.ALLOWED_CHARS_BEFORE:
-                            lsibling.data += ' '
-                    elif self.element_needs_space_p(lsibling):
-                        parent.children.insert(i - 1, Text(' '))
+        def postvisit_option(self, element, parents):
+            rsibling = element.next_sibling
+            if rsibling is not None:
+                if isinstance(rsibling, Text):
+                    if not rsibling.data[0] in self.ALLOWED_CHARS_AFTER:
+                        rsibling.data = ' ' + rsibling.data
+                elif self.element_needs_space_p(rsibling):
+                    element.insert_after(Text(' '))
+            lsibling = element.prev_sibling
+            if lsibling is not None:
+                if isinstance(lsibling, Text):
+                    if not lsibling.data[-1] in self.ALLOWED_CHARS_BEFORE:
+                        lsibling.data += ' '
+                elif self.element_needs_space_p(lsibling):
+                    lsibling.insert_before(Text(' '))
+
+        postvisit_var = postvisit_code = postvisit_option
 
     ElementSpacingFixer().visit(tree)
     return tree
 
 
-def fixup_machine_dependant_options(tree):
+def fixup_machine_dependant_options(tree, state=None):
     class MachineDependantOptionFixer(NoopVisitor):
         def __init__(self):
             self.parent_seen = False
@@ -680,21 +1137,21 @@ def fixup_machine_dependant_options(tree):
                     program.rst_kind = Directive('program', name)
                     element.children.insert(0, program)
 
-        def postvisit_element(self, element, parents):
+        def postvisit_emph(self, element, parents):
             # add newline before all Machine-Dependent Options subsections
             text = element.get_all_text()
-            if element.kind == 'emph' and text.endswith('Options'):
+            if text.endswith('Options'):
                 parent = parents[-1]
                 if text == 'Machine-Dependent Options':
                     self.parent_seen = True
                 elif self.parent_seen:
-                    parent.children.insert(parent.children.index(element) - 2, Text('\n'))
+                    parent.children.insert(element.position - 2, Text('\n'))
 
-    MachineDependantOptionFixer().visit(tree)
+    reuse(state, MachineDependantOptionFixer).visit(tree)
     return tree
 
 
-def fixup_params(tree):
+def fixup_params(tree, state=None):
     class ParamFixer(NoopVisitor):
         def __init__(self):
             self.in_param_option = False
@@ -709,7 +1166,7 @@ def fixup_params(tree):
                 element.rst_kind = Directive('gcc-param', element.get_all_text())
                 element.children = []
 
-    ParamFixer().visit(tree)
+    reuse(state, ParamFixer).visit(tree)
     return tree
 
 
@@ -730,19 +1187,12 @@ def fixup_text_variables(tree):
 
 
 def fixup_fortran_functions(tree):
-    class FortranFunctionFixer(NoopVisitor):
-        def _convert_section(self, element, parents):
-            NEEDLES = ('Function ABI Documentation', 'Intrinsic Procedures', 'Non-Fortran Main Program')
-            if parents:
-                sectiontitle = parents[-1].first_element_named('sectiontitle')
-                if (sectiontitle
-                        and sectiontitle.get_all_text() in NEEDLES
-                        and element.kind in ('section', 'subsection')):
-                    return True
-            return False
+    class FortranFunctionFixer:
+        TITLE = 'sectiontitle:text("Function ABI Documentation", "Intrinsic Procedures", "Non-Fortran Main Program")'
+        SECTIONS = f':has(> {TITLE}) > section, :has(> {TITLE}) > subsection'
 
-        def previsit_element(self, element, parents):
-            if self._convert_section(element, parents):
+        def fix(self, tree):
+            for element, _ in list(tree.select(self.SECTIONS)):
                 stitle = element.first_element_named('sectiontitle').get_all_text()
                 if '---' in stitle:
                     tableentry = element.first_element_named('table')
@@ -818,40 +1268,37 @@ def fixup_fortran_functions(tree):
 
                     tableentry.children = newchildren + newchildren2
 
-    class OpenMPFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            if parents:
-                sectiontitle = parents[-1].first_element_named('sectiontitle')
-                if (sectiontitle and sectiontitle.get_all_text() == 'OpenMP Modules OMP_LIB and OMP_LIB_KINDS'):
-                    if element.kind == 'table':
-                        text = '\n'.join(x.get_all_text() for x in element.get_all_elements('asis'))
-                        code_block = Element('cb')
-                        code_block.rst_kind = Directive('code-block')
-                        code_block.children = [Text(text)]
-                        element.children = [code_block]
-
-    FortranFunctionFixer().visit(tree)
-    OpenMPFixer().visit(tree)
+    class OpenMPFixer:
+        TABLES = ':has(> sectiontitle:text("OpenMP Modules OMP_LIB and OMP_LIB_KINDS")) > table'
+
+        def fix(self, tree):
+            for element, _ in list(tree.select(self.TABLES)):
+                text = '\n'.join(x.get_all_text() for x in element.get_all_elements('asis'))
+                code_block = Element('cb')
+                code_block.rst_kind = Directive('code-block')
+                code_block.children = [Text(text)]
+                element.children = [code_block]
+
+    FortranFunctionFixer().fix(tree)
+    OpenMPFixer().fix(tree)
     return tree
 
 
 def fixup_libquadmath(tree):
-    class LibQuadMathFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            NEEDLES = ('Typedef and constants', 'Math Library Routines')
-            if parents:
-                sectiontitle = parents[-1].first_element_named('sectiontitle')
-                if sectiontitle and sectiontitle.get_all_text() in NEEDLES:
-                    if element.kind == 'table':
-                        for item in element.get_all_elements('item'):
-                            parts = item.get_all_text().split(':')
-                            assert len(parts) == 2
-                            samp = Element('samp')
-                            samp.rst_kind = InlineMarkup('samp')
-                            samp.children = [Text(parts[0])]
-                            item.children = [Text('* '), samp, Text(f': {parts[1]}\n')]
-
-    LibQuadMathFixer().visit(tree)
+    class LibQuadMathFixer:
+        TABLES = ':has(> sectiontitle:text("Typedef and constants", "Math Library Routines")) > table'
+
+        def fix(self, tree):
+            for element, _ in list(tree.select(self.TABLES)):
+                for item in element.get_all_elements('item'):
+                    parts = item.get_all_text().split(':')
+                    assert len(parts) == 2
+                    samp = Element('samp')
+                    samp.rst_kind = InlineMarkup('samp')
+                    samp.children = [Text(parts[0])]
+                    item.children = [Text('* '), samp, Text(f': {parts[1]}\n')]
+
+    LibQuadMathFixer().fix(tree)
     return tree
 
 
@@ -859,10 +1306,8 @@ def fixup_merge_functions(tree):
     class MergeFunctionFixer(NoopVisitor):
         def previsit_element(self, element, parents):
             if is_directive(element, 'function') and not element.children:
-                children = parents[-1].children
-                i = children.index(element)
-                if i + 1 < len(children):
-                    sibling = children[i + 1]
+                sibling = element.next_sibling
+                if sibling is not None:
                     if is_directive(sibling, 'function'):
                         spaces = len(sibling.rst_kind.name) + 6
                         sibling.rst_kind.args = element.rst_kind.args + f'\n{" " * spaces}' + sibling.rst_kind.args
@@ -872,7 +1317,7 @@ def fixup_merge_functions(tree):
     return tree
 
 
-def fixup_option_listing(tree):
+def fixup_option_listing(tree, state=None):
     class OptionListingFixer(NoopVisitor):
         def __init__(self):
             self.seen = False
@@ -885,39 +1330,39 @@ def fixup_option_listing(tree):
                     if child.kind == 'para':
                         target = child.get_all_text().strip()
                         target = target.replace(' Options', '').replace('Options for ', '')
-                        i = element.children.index(child)
                         program = Element('program')
                         program.rst_kind = Directive('program', target)
-                        element.children.insert(i + 1, program)
+                        child.insert_after(program)
 
                 program = Element('program')
                 program.rst_kind = Directive('program', 'None')
                 element.children.append(program)
 
-    OptionListingFixer().visit(tree)
+    reuse(state, OptionListingFixer).visit(tree)
     return tree
 
 
 def fixup_licenses(tree):
     class LicenseFixer(NoopVisitor):
-        def previsit_element(self, element, parents):
-            # skip ignores with License description
-            if element.kind == 'ignore':
-                text = element.get_all_text()
-                if ('@settitle GNU Free Documentation License' in text
-                        or '@settitle GNU General Public License' in text):
+        # skip ignores with License description
+        def previsit_ignore(self, element, parents):
+            text = element.get_all_text()
+            if ('@settitle GNU Free Documentation License' in text
+                    or '@settitle GNU General Public License' in text):
+                element.children = []
+
+        def previsit_unnumbered(self, element, parents):
+            sectiontitle = element.first_element_named('sectiontitle')
+            if sectiontitle:
+                section = sectiontitle.get_all_text()
+                if (section == 'GNU Free Documentation License'
+                        or section == 'GNU General Public License'
+                        or section == 'Funding Free Software'):
                     element.children = []
-            elif element.kind == 'unnumbered':
-                sectiontitle = element.first_element_named('sectiontitle')
-                if sectiontitle:
-                    section = sectiontitle.get_all_text()
-                    if (section == 'GNU Free Documentation License'
-                            or section == 'GNU General Public License'
-                            or section == 'Funding Free Software'):
-                        element.children = []
 
+        def previsit_element(self, element, parents):
             # Rename license files
-            elif isinstance(element.rst_kind, ToctreeEntry):
+            if isinstance(element.rst_kind, ToctreeEntry):
                 name = element.get_all_text()
                 if name == 'copying':
                     element.children = [Text('general-public-license-3')]
@@ -954,26 +1399,45 @@ def fixup_wrapped_options(tree):
 
 def fixup_inline_option(tree):
     class InlineOptionFixer(NoopVisitor):
-        def postvisit_element(self, element, parents):
-            if element.kind == 'option':
-                parent = parents[-1]
-                i = parent.children.index(element)
-                if i == len(parent.children) - 1:
-                    return
-                sib = parent.children[i + 1]
-                if not isinstance(sib, Text) and isinstance(sib.rst_kind, InlineMarkup):
-                    text = sib.get_all_text()
-                    # TODO: a bit hack
-                    if text[0] == '{' and text[-1] == '}':
-                        text = text[1:-1]
-                    element.children += [Text(text)]
-                    parent.children.remove(sib)
+        def postvisit_option(self, element, parents):
+            sib = element.next_sibling
+            if sib is None:
+                return
+            if not isinstance(sib, Text) and isinstance(sib.rst_kind, InlineMarkup):
+                text = sib.get_all_text()
+                # TODO: a bit hack
+                if text[0] == '{' and text[-1] == '}':
+                    text = text[1:-1]
+                element.children += [Text(text)]
+                sib.detach()
 
     InlineOptionFixer().visit(tree)
     return tree
 
 
-def fixup_table_entry(tree):
+def table_option_directive(text, parents):
+    """
+    The directive for a table entry describing text which is neither an
+    option with index entries nor an environment variable (see
+    fixup_table_entry), given its ancestors, or None.
+    """
+    section = parents[-2].first_element_named('sectiontitle')
+    if section:
+        section_name = section.get_all_text()
+        for needle in ('Function Attributes', 'Variable Attributes', 'Type Attributes'):
+            if section_name.endswith(needle):
+                return 'gcc-attr'
+
+    for parent in parents[1:]:
+        section = parent.first_element_named('sectiontitle')
+        if section:
+            section_name = section.get_all_text()
+            if text.startswith('--') and section_name == 'Configuration':
+                return 'option'
+    return None
+
+
+def fixup_table_entry(tree, state=None):
     """
     Fixup <tableentry> elements.
 
@@ -1019,6 +1483,9 @@ def fixup_table_entry(tree):
     Transform this to a definition list.
     """
     class TableEntryFixer(NoopVisitor):
+        def __init__(self, option_directives):
+            self.option_directives = option_directives
+
         def previsit_element(self, element, parents):
             # Convert:
             #   <itemformat command="COMMAND">TEXT</itemformat>
@@ -1077,57 +1544,38 @@ def fixup_table_entry(tree):
             if element.kind == 'tableentry':
                 tableterm = element.first_element_named('tableterm')
                 tableitem = element.first_element_named('tableitem')
-                if tableterm and tableitem:
-                    item = tableterm.first_element_named('item')
-                    if item:
-                        itemformat = item.first_element_named('itemformat')
-                        if itemformat:
-                            itemformats = tableterm.get_all_elements('itemformat')
-                            # Detect:
-                            #   <itemformat>
-                            #     TEXT
-                            #     <r>TEXT</r>
-                            #   </itemformat>
-                            # and move the <r>TEXT</r> to be a ".. note::"
-                            # within the <tableitem>
-                            if len(itemformat.children) == 2:
-                                if itemformat.children[1].is_element('r'):
-                                    r = itemformat.children[1]
-                                    itemformat.children = \
-                                        itemformat.children[:-1]
-                                    note = Element('note', {})
-                                    note.rst_kind = Directive('note')
-                                    note.children = [r]
-                                    rtext = r.children[0]
-                                    if rtext.data.startswith('(') and rtext.data.endswith(')'):
-                                        rtext.data = rtext.data[1:-1]
-
-                                    tableitem.children = \
-                                        [note] + tableitem.children
-
-                            if self.convert_to_option(element, tableitem,
-                                                      itemformats, parents):
-                                return
-                            else:
-                                self.convert_to_definition_list(tableterm,
-                                                                tableitem)
-
-        @staticmethod
-        def handle_as_option(text, parents):
-            section = parents[-2].first_element_named('sectiontitle')
-            if section:
-                section_name = section.get_all_text()
-                for needle in ('Function Attributes', 'Variable Attributes', 'Type Attributes'):
-                    if section_name.endswith(needle):
-                        return 'gcc-attr'
-
-            for parent in parents[1:]:
-                section = parent.first_element_named('sectiontitle')
-                if section:
-                    section_name = section.get_all_text()
-                    if text.startswith('--') and section_name == 'Configuration':
-                        return 'option'
-            return None
+                item = tableterm.first_element_named('item') if tableterm else None
+                itemformat = item.first_element_named('itemformat') if item else None
+                if itemformat and tableitem:
+                    itemformats = tableterm.get_all_elements('itemformat')
+                    # Detect:
+                    #   <itemformat>
+                    #     TEXT
+                    #     <r>TEXT</r>
+                    #   </itemformat>
+                    # and move the <r>TEXT</r> to be a ".. note::"
+                    # within the <tableitem>
+                    if len(itemformat.children) == 2:
+                        if itemformat.children[1].is_element('r'):
+                            r = itemformat.children[1]
+                            itemformat.children = \
+                                itemformat.children[:-1]
+                            note = Element('note', {})
+                            note.rst_kind = Directive('note')
+                            note.children = [r]
+                            rtext = r.children[0]
+                            if rtext.data.startswith('(') and rtext.data.endswith(')'):
+                                rtext.data = rtext.data[1:-1]
+
+                            tableitem.children = \
+                                [note] + tableitem.children
+
+                    if self.convert_to_option(element, tableitem,
+                                              itemformats, parents):
+                        return
+                    else:
+                        self.convert_to_definition_list(tableterm,
+                                                        tableitem)
 
         @classmethod
         def get_opposite_option(cls, option):
@@ -1206,16 +1654,14 @@ def fixup_table_entry(tree):
             if found_indexcommand:
                 # Add negative form as a new option entry:
                 if len(default_options) == 1:
-                    parent = parents[-1]
-                    assert tableentry in parent.children
-                    index = parent.children.index(tableentry)
+                    assert tableentry.parent is parents[-1]
                     negative = Element('negative-option')
                     negative.rst_kind = Directive('option', default_options[0])
                     nopt = Element('opt')
                     nopt.rst_kind = InlineMarkup('option')
                     nopt.children = [Text(self.get_opposite_option(default_options[-1]))]
                     negative.children = [Text('Default setting; overrides '), nopt, Text('.')]
-                    parent.children.insert(index + 1, negative)
+                    self.journal.insert_after(tableentry, negative)
                 else:
                     # FIXME: handle it
                     options += default_options
@@ -1239,11 +1685,11 @@ def fixup_table_entry(tree):
                 tableentry.delete_children_named('findex')
                 return True
             else:
-                directive = self.handle_as_option(text, parents)
+                directive = table_option_directive(text, parents)
                 if directive:
                     # For now skip 'vector' and 'const' attributes that are also keywords
                     if text not in ('vector', 'const'):
-                        detected_option_directives[text] = directive
+                        self.option_directives[text] = directive
                     if directive == 'gcc-attr':
                         text = ', '.join(options)
                     tableentry.rst_kind = Directive(directive, text)
@@ -1263,7 +1709,7 @@ def fixup_table_entry(tree):
                 new_children.append(child)
             tableterm.children = new_children
 
-    TableEntryFixer().visit(tree)
+    TableEntryFixer(detected_option_directives if state is None else state.option_directives).visit(tree)
     return tree
 
 
@@ -1333,20 +1779,18 @@ def fixup_multitables(tree, ctxt):
     """
     class MultitableFixer(NoopVisitor):
         def previsit_element(self, element, parents):
-            if element.kind == 'multitable':
-                element.rst_kind = Table(element, ctxt)
+            element.rst_kind = Table(element, ctxt)
             element.delete_children_named('columnprototypes')
 
         def postvisit_element(self, element, parents):
             if ctxt.debug:
-                if element.kind == 'multitable':
-                    element.dump(sys.stdout)
+                element.dump(sys.stdout)
 
-    MultitableFixer().visit(tree)
+    MultitableFixer().visit_kinds(tree, ('multitable', ))
     return tree
 
 
-def fixup_examples(tree):
+def fixup_examples(tree, ctxt=None):
     """
     Handle:
       <example>
@@ -1369,6 +1813,8 @@ def fixup_examples(tree):
     class ExampleFixer(NoopVisitor):
         def __init__(self):
             self.default_lang_stack = [args.default_language if args else 'c++']
+            # The elements which pushed the languages above the first
+            self.default_lang_elements = []
 
         @staticmethod
         def is_an_option(text):
@@ -1384,8 +1830,10 @@ def fixup_examples(tree):
                 return False
 
         def previsit_element(self, element, parents):
-            if hasattr(element, 'default_language'):
-                self.default_lang_stack.append(element.default_language)
+            lang = ctxt.default_language(element) if ctxt else None
+            if lang:
+                self.default_lang_stack.append(lang)
+                self.default_lang_elements.append(element)
 
             if element.kind in ('example', 'smallexample'):
                 example = element
@@ -1415,8 +1863,9 @@ def fixup_examples(tree):
                         example.rst_kind = Directive('code-block', lang)
 
         def postvisit_element(self, element, parents):
-            if hasattr(element, 'default_language'):
+            if self.default_lang_elements and self.default_lang_elements[-1] is element:
                 self.default_lang_stack.pop()
+                self.default_lang_elements.pop()
 
         def guess_language(self, data):
             if 'DO ' in data:
@@ -1467,7 +1916,7 @@ def fixup_examples(tree):
     return tree
 
 
-def fixup_titles(tree):
+def fixup_titles(tree, state=None):
     class TitleFixer(NoopVisitor):
         def __init__(self):
             self.cur_section_level = None
@@ -1499,7 +1948,7 @@ def fixup_titles(tree):
 
             element.collapse_to_text()
 
-    TitleFixer().visit(tree)
+    reuse(state, TitleFixer).visit(tree)
     return tree
 
 
@@ -1508,34 +1957,35 @@ def fixup_index(tree):
         """
         Look for <cindex><indexterm>TEXT</indexterm></cindex>
         """
-        def previsit_element(self, element, parents):
-            if isinstance(element, Element):
-                if element.kind == 'indexterm':
-                    text = element.get_all_text()
-                    if text:
-                        element.rst_kind = Directive('index', text)
-                        element.children = []
+        def previsit_indexterm(self, element, parents):
+            text = element.get_all_text()
+            if text:
+                element.rst_kind = Directive('index', text)
+                element.children = []
 
     class MoveIndicesFixer(NoopVisitor):
         def previsit_element(self, element, parents):
-            if not parents:
-                return
-
-            parent = parents[-1]
-            if is_movable_index(element):
-                i = parent.children.index(element)
-
-                # Move before parent if it is a Directive
-                if isinstance(parent.rst_kind, Directive) and i == 0:
-                    i2 = parents[-2].children.index(parent)
-                    parent.children = parent.children[1:]
-                    parents[-2].children.insert(i2, element)
-                # Move before a Title if it is our sibling
-                elif i > 0:
-                    prev = parent.children[i - 1]
-                    if isinstance(prev, Element) and isinstance(prev.rst_kind, Title):
-                        parent.children[i] = prev
-                        parent.children[i - 1] = element
+            children = element.children
+            start = 0
+            # Move leading indices before element if it is a Directive
+            if isinstance(element.rst_kind, Directive) and parents:
+                while (start < len(children) and isinstance(children[start], Element)
+                       and is_movable_index(children[start])):
+                    self.journal.move(children[start], before=element)
+                    start += 1
+
+            # Move indices before a Title if it is their sibling
+            title = None
+            for child in children[start:]:
+                if not isinstance(child, Element):
+                    title = None
+                elif is_movable_index(child):
+                    if title is not None:
+                        self.journal.move(child, before=title)
+                elif isinstance(child.rst_kind, Title):
+                    title = child
+                else:
+                    title = None
 
     IndexFixer().visit(tree)
     MoveIndicesFixer().visit(tree)
@@ -1545,16 +1995,15 @@ def fixup_index(tree):
 def fixup_urefs(tree):
     class URefFixer(NoopVisitor):
         def previsit_element(self, element, parents):
-            if element.kind in ('uref', 'url'):
-                url = element.first_element_named('urefurl')
-                title = element.first_element_named('urefreplacement')
-                if not title:
-                    title = element.first_element_named('urefdesc')
-                if title and url.get_all_text().startswith('http'):
-                    element.rst_kind = EmbeddedUrl(title.get_all_text(), url.get_all_text())
-                    element.children = []
+            url = element.first_element_named('urefurl')
+            title = element.first_element_named('urefreplacement')
+            if not title:
+                title = element.first_element_named('urefdesc')
+            if title and url.get_all_text().startswith('http'):
+                element.rst_kind = EmbeddedUrl(title.get_all_text(), url.get_all_text())
+                element.children = []
 
-    URefFixer().visit(tree)
+    URefFixer().visit_kinds(tree, ('uref', 'url'))
     return tree
 
 
@@ -1622,37 +2071,35 @@ def fixup_lists(tree):
              ...ELEMENTS...
           </listitem>
         """
-        def previsit_element(self, element, parents):
-            if element.kind == 'listitem':
-                new_children = []
-                indices = []
-                element.rst_kind = ListItem('*')
-                skip_ws = True
-                for child in element.children:
-                    if isinstance(child, Element):
-                        if child.kind == 'prepend':
-                            continue
-                        elif child.kind == 'cindex' and not new_children:
-                            indices.append(child)
+        def previsit_listitem(self, element, parents):
+            new_children = []
+            indices = []
+            element.rst_kind = ListItem('*')
+            skip_ws = True
+            for child in element.children:
+                if isinstance(child, Element):
+                    if child.kind == 'prepend':
+                        continue
+                    elif child.kind == 'cindex' and not new_children:
+                        indices.append(child)
+                        continue
+                elif isinstance(child, Text):
+                    if child.data.isspace():
+                        if skip_ws:
                             continue
-                    elif isinstance(child, Text):
-                        if child.data.isspace():
-                            if skip_ws:
-                                continue
 
-                    skip_ws = False
-                    new_children.append(child)
-                element.children = new_children
+                skip_ws = False
+                new_children.append(child)
+            element.children = new_children
 
-                parent = parents[-1]
-                index = parent.children.index(element)
-                parent.children = parent.children[:index] + indices + parent.children[index:]
+            if indices:
+                self.journal.insert_before(element, *indices)
 
     ListFixer().visit(tree)
     return tree
 
 
-def fixup_inline_markup(tree):
+def fixup_inline_markup(tree, state=None):
     class InlineMarkupFixer(NoopVisitor):
         """
         Inline markup conversions:
@@ -1669,39 +2116,54 @@ def fixup_inline_markup(tree):
         <samp>TEXT</samp>          :samp:`TEXT`
         =========================  ==================
         """
-        def previsit_element(self, element, parents):
+        def __init__(self, option_directives):
+            self.option_directives = option_directives
+
+        def previsit_command(self, element, parents):
+            element.rst_kind = InlineMarkup('command')
+
+        def previsit_var(self, element, parents):
             parent = parents[-1] if parents else None
-            if element.kind == 'command':
-                element.rst_kind = InlineMarkup('command')
-            elif element.kind == 'var':
-                element.rst_kind = InlineMarkup('samp')
-                if isinstance(parent.rst_kind, InlineMarkup) and parent.kind == 'option':
-                    pass
-                else:
-                    # wrap the variable in braces
-                    element.prepend_text('{')
-                    element.add_text('}')
-            elif element.kind in ('t', 'code'):
-                # we cannot support e.g. <var> in a <code> element
-                element.collapse_to_text()
-                text = element.get_all_text()
-                if element.kind == 'code' and text in detected_option_directives:
-                    element.rst_kind = InlineMarkup(detected_option_directives[text])
-                else:
-                    element.rst_kind = MatchedInlineMarkup('``')
-            elif element.kind == 'dfn':
-                element.rst_kind = InlineMarkup('dfn')
-            elif element.kind == 'env':
-                element.rst_kind = InlineMarkup('envvar')
-            elif element.kind == 'emph':
-                element.rst_kind = MatchedInlineMarkup('*')
-            elif element.kind == 'strong':
-                element.rst_kind = MatchedInlineMarkup('**')
-            elif element.kind in ('samp', 'file'):
-                element.rst_kind = InlineMarkup('samp')
-            elif element.kind == 'verbatim':
-                element.rst_kind = Directive('code-block', 'c++')
+            element.rst_kind = InlineMarkup('samp')
+            if isinstance(parent.rst_kind, InlineMarkup) and parent.kind == 'option':
+                pass
+            else:
+                # wrap the variable in braces
+                element.prepend_text('{')
+                element.add_text('}')
 
+        def previsit_code(self, element, parents):
+            # we cannot support e.g. <var> in a <code> element
+            element.collapse_to_text()
+            text = element.get_all_text()
+            if element.kind == 'code' and text in self.option_directives:
+                element.rst_kind = InlineMarkup(self.option_directives[text])
+            else:
+                element.rst_kind = MatchedInlineMarkup('``')
+
+        previsit_t = previsit_code
+
+        def previsit_dfn(self, element, parents):
+            element.rst_kind = InlineMarkup('dfn')
+
+        def previsit_env(self, element, parents):
+            element.rst_kind = InlineMarkup('envvar')
+
+        def previsit_emph(self, element, parents):
+            element.rst_kind = MatchedInlineMarkup('*')
+
+        def previsit_strong(self, element, parents):
+            element.rst_kind = MatchedInlineMarkup('**')
+
+        def previsit_samp(self, element, parents):
+            element.rst_kind = InlineMarkup('samp')
+
+        previsit_file = previsit_samp
+
+        def previsit_verbatim(self, element, parents):
+            element.rst_kind = Directive('code-block', 'c++')
+
+        def previsit_element(self, element, parents):
             new_children = []
             for child in element.children:
                 if child.is_element('accent'):
@@ -1723,7 +2185,11 @@ def fixup_inline_markup(tree):
                 new_children.append(child)
             element.children = new_children
 
-    InlineMarkupFixer().visit(tree)
+    if state is None:
+        option_directives = detected_option_directives
+    else:
+        option_directives = (state.scan or state).option_directives
+    InlineMarkupFixer(option_directives).visit(tree)
     return tree
 
 
@@ -1756,72 +2222,236 @@ def fixup_deftype(tree):
         Look for <deftypefn> elements..
         """
         def previsit_element(self, element, parents):
-            if isinstance(element, Element):
-                declaration = self._parse_element(element)
-                lastfn = None
-                if declaration:
-                    definitionitem = element.first_element_named('definitionitem')
-                    lastfn = element
-                    element.rst_kind = Directive(self.MAPPING[element.kind], declaration.strip())
-
-                    # process deftypefnx and defmacx elements
-                    for fn in (element.get_all_elements('deftypefnx') + element.get_all_elements('defmacx')
-                               + element.get_all_elements('deftypevrx')):
-                        declaration = self._parse_element(fn)
-                        subelement = Element(fn.kind)
-                        subelement.rst_kind = Directive(self.MAPPING[subelement.kind], declaration.strip())
-                        i = parents[-1].children.index(lastfn)
-                        parents[-1].children.insert(i + 1, subelement)
-                        lastfn = subelement
+            declaration = self._parse_element(element)
+            lastfn = None
+            if declaration:
+                definitionitem = element.first_element_named('definitionitem')
+                lastfn = element
+                element.rst_kind = Directive(self.MAPPING[element.kind], declaration.strip())
+
+                # process deftypefnx and defmacx elements
+                for fn in (element.get_all_elements('deftypefnx') + element.get_all_elements('defmacx')
+                           + element.get_all_elements('deftypevrx')):
+                    declaration = self._parse_element(fn)
+                    subelement = Element(fn.kind)
+                    subelement.rst_kind = Directive(self.MAPPING[subelement.kind], declaration.strip())
+                    self.journal.insert_after(element, subelement)
+                    lastfn = subelement
 
-                    element.children = []
-                    if definitionitem:
-                        lastfn.children = [definitionitem]
+                element.children = []
+                if definitionitem:
+                    lastfn.children = [definitionitem]
 
-    DefTypeFixup().visit(tree)
+    DefTypeFixup().visit_kinds(tree, DefTypeFixup.MAPPING)
     return tree
 
 
 # Top-level conversion routine
-def convert_to_rst(tree, ctxt):
+class ConversionState:
+    """
+    What convert_to_rst carries from one chapter to the next when a
+    document is converted a chapter at a time (see convert_chapters).
+
+    The visitors whose state flows forward through the document are
+    kept, by name, to be used for every chapter (see reuse).  What the
+    passes would need to know of the chapters still to come (the names
+    of the top-level output files, and the option directives described
+    in tables) is gathered first by a pre-scan of the whole document
+    (see scan_chapter), into a ConversionState of its own, given here
+    as "scan".
+    """
+    def __init__(self, scan=None):
+        self.scan = scan
+        self.visitors = {}
+        # Found so far: the names of the top-level output files, and the
+        # option directives (see fixup_table_entry)
+        self.output_files = []
+        self.option_directives = {}
+        # A <node> or <anchor> left at the end of the last chapter, to
+        # go into the next (see fixup_nodes)
+        self.trailing_nodes = []
+
+
+def reuse(state, visitor_class, *args):
+    """
+    Get a new visitor_class(*args), or converting a chapter at a time,
+    the one made for the first chapter, to keep its state.
+    """
+    if state is None:
+        return visitor_class(*args)
+    name = visitor_class.__qualname__
+    if name not in state.visitors:
+        state.visitors[name] = visitor_class(*args)
+    return state.visitors[name]
+
+
+def scan_chapter(tree, scan):
+    """
+    Note in the ConversionState scan the names of the top-level output
+    files (see split) and the option directives (see fixup_table_entry)
+    which the parsed tree of a chapter will give, from the titles and
+    table terms in it, without converting it.
+    """
+    splitter = Splitter()
+    for top in tree.children:
+        if not isinstance(top, Element):
+            continue
+        ptitle = top.first_element_named('sectiontitle')
+        parent_text = ptitle.get_all_text() if ptitle else None
+        for element in top.children:
+            if isinstance(element, Element):
+                sectiontitle = element.first_element_named('sectiontitle')
+                if sectiontitle:
+                    text = sectiontitle.get_all_text()
+                    if text and splitter.should_split(element, text, parent_text):
+                        scan.output_files.append(splitter._prune_filename(text))
+
+    for tableentry, parents in tree.select('tableentry'):
+        # As TableEntryFixer.convert_to_option finds them
+        tableterm = tableentry.first_element_named('tableterm')
+        tableitem = tableentry.first_element_named('tableitem')
+        item = tableterm.first_element_named('item') if tableterm else None
+        itemformat = item.first_element_named('itemformat') if item else None
+        if not itemformat or not tableitem:
+            continue
+        if any(child.is_element('indexcommand') for child in tableitem.children):
+            continue
+        first = tableterm.get_all_elements('itemformat')[0]
+        children = first.children
+        if first is itemformat and len(children) == 2 and children[1].is_element('r'):
+            # Moved into a note
+            children = children[:1]
+        parts = []
+        for child in children:
+            if isinstance(child, Text):
+                parts.append(child.data)
+            elif isinstance(child, Element) and child.kind != 'indexterm':
+                parts.append(child.get_all_text())
+        text = ''.join(parts)
+        if text and len(text) > 3 and re.match('^[A-Z][_A-Z]+$', text):
+            continue
+        directive = table_option_directive(text, parents)
+        if directive and text not in ('vector', 'const'):
+            scan.option_directives[text] = directive
+
+
+def convert_to_rst(tree, ctxt, state=None):
     tree = ctxt.preprocess(tree)
     tree = fixup_comments(tree)
     tree = prune(tree)
-    tree = fixup_nodes(tree, ctxt)
+    tree = fixup_nodes(tree, ctxt, state)
     tree = fixup_menus(tree)
-    tree = split(tree)
-    tree = fixup_merge_toctree(tree)
+    tree = split(tree, state)
+    tree = fixup_merge_toctree(tree, state)
     tree = fixup_option_refs(tree)
-    tree = fixup_table_entry(tree)
+    tree = fixup_table_entry(tree, state)
     tree = fixup_multitables(tree, ctxt)
-    tree = fixup_examples(tree)
-    tree = fixup_titles(tree)
+    tree = fixup_examples(tree, ctxt)
+    tree = fixup_titles(tree, state)
     tree = fixup_index(tree)
     tree = fixup_urefs(tree)
     tree = fixup_xrefs(tree)
     tree = fixup_deftype(tree)
     tree = fixup_lists(tree)
-    tree = fixup_inline_markup(tree)
+    tree = fixup_inline_markup(tree, state)
     tree = fixup_empty_texts(tree)
-    tree = fixup_ignored_strings(tree)
+    tree = fixup_ignored_strings(tree, state)
     tree = fixup_vars_in_samps(tree)
     tree = fixup_wrapped_options(tree)
     tree = fixup_inline_option(tree)
     tree = fixup_element_spacing(tree)
-    tree = fixup_machine_dependant_options(tree)
-    tree = fixup_params(tree)
+    tree = fixup_machine_dependant_options(tree, state)
+    tree = fixup_params(tree, state)
     tree = fixup_text_variables(tree)
     tree = fixup_quoting(tree)
     tree = fixup_fortran_functions(tree)
     tree = fixup_libquadmath(tree)
     tree = fixup_merge_functions(tree)
-    tree = fixup_option_listing(tree)
+    tree = fixup_option_listing(tree, state)
     tree = fixup_licenses(tree)
     return tree
 
 
+def convert_chapters(f_in, ctxt, entities=ENTITIES, backend='expat'):
+    """
+    Convert the XML read from the seekable binary file f_in as
+    convert_to_rst would, but a chapter at a time, yielding the
+    converted tree of each top-level chapter (see iter_chapters) for
+    them all to be written, in turn, by one RstWriter.
+
+    The file is read twice: first for a pre-scan of each chapter (see
+    scan_chapter), and then for the conversion itself.  Either way, only
+    one chapter is held at a time, as long as the caller drops each
+    tree before asking for the next.
+    """
+    scan = ConversionState()
+    for tree in iter_chapters(f_in, entities, backend):
+        scan_chapter(tree, scan)
+        tree.dispose()
+        del tree
+    f_in.seek(0)
+    state = ConversionState(scan)
+    for tree in iter_chapters(f_in, entities, backend):
+        yield convert_to_rst(tree, ctxt, state)
+        del tree
+    if state.trailing_nodes:
+        # Nothing followed them: rather than at the end of the last
+        # chapter, they end up at the end of the top-level file
+        tree = Element('document', {})
+        tree.children = state.trailing_nodes
+        yield tree
+
+
+def diff_conversions(old, new):
+    """
+    Compare two trees converted by convert_to_rst, grouping the
+    differences between them (see diff_trees) by where they appear in
+    the output: a dict from (path of output file, label) to a list of
+    TreeEdit, in document order.
+
+    The label is that of the nearest node or anchor before the change;
+    either can be None.
+    """
+    grouped = OrderedDict()
+    for edit in diff_trees(old, new):
+        node = edit.new if edit.new is not None else edit.old
+        key = (get_output_path(edit.parents, node), get_label(edit.parents, node))
+        grouped.setdefault(key, []).append(edit)
+    return grouped
+
+
+def get_output_path(parents, node):
+    for element in reversed(parents + (node, )):
+        if isinstance(element, Element) and isinstance(element.rst_kind, OutputFile):
+            return os.path.join(*element.rst_kind.path_components, element.rst_kind.name + '.rst')
+    return None
+
+
+def get_label(parents, node):
+    candidates = [node]
+    if isinstance(node, Element):
+        # fixup_nodes makes labels the first children of what they label
+        candidates += node.children[:1]
+    for element in candidates:
+        if isinstance(element, Element) and isinstance(element.rst_kind, Label):
+            return element.rst_kind.title
+    for parent, child in reversed(list(zip(parents, parents[1:] + (node, )))):
+        for sibling in reversed(parent.children[:child.position]):
+            if isinstance(sibling, Element) and isinstance(sibling.rst_kind, Label):
+                return sibling.rst_kind.title
+    return None
+
+
 # Policies for converting elements to rst (element.rst_kind):
 class RstKind:
+    def __setattr__(self, name, value):
+        # Let structural hashes see changes made to rst_kinds in place;
+        # rst_kinds set all their attributes in __init__, so only those
+        # replacing an attribute can be such changes
+        if name in self.__dict__:
+            rst_kinds_changed()
+        object.__setattr__(self, name, value)
+
     def before(self, w):
         pass
 
@@ -1923,6 +2553,9 @@ class FnDirective(RstKind):
     def __init__(self, name):
         self.name = name
 
+    def __repr__(self):
+        return 'FnDirective(%r)' % self.name
+
     def before(self, w):
         w.write('\n:%s:' % (self.name))
         w.indent += 1
@@ -1982,6 +2615,9 @@ class ToctreeEntry(RstKind):
     def __init__(self):
         pass
 
+    def __repr__(self):
+        return 'ToctreeEntry()'
+
     def after(self, w):
         w.write('\n')
 
@@ -2042,62 +2678,70 @@ class TableLayout:
 
         self.needs_grid_table = False
 
+        # Per-component and per-row layout data, keyed by element
+        self.rows = {}
+        self.entries = {}
+        self.columns = {}
+        self.height_needed_for_y = {}
+
         for comp in self.components:
-            comp.rows = []
+            rows = self.rows[comp] = []
             for child in comp.children:
                 if child.is_element('row'):
-                    comp.rows.append(child)
+                    rows.append(child)
             if debug:
-                print('comp.rows: %r' % (comp.rows, ))
+                print('rows: %r' % (rows, ))
 
-            for row in comp.rows:
-                row.entries = []
+            for row in rows:
+                entries = self.entries[row] = []
                 for child in row.children:
                     if child.is_element('entry'):
-                        row.entries.append(child)
+                        entries.append(child)
                     if self._entry_needs_grid_table(child):
                         self.needs_grid_table = True
                 if debug:
-                    print('row.entries: %r' % (row.entries, ))
+                    print('entries: %r' % (entries, ))
 
-        self.num_columns = len(self.components[0].rows[0].entries)
+        self.num_columns = len(self.entries[self.rows[self.components[0]][0]])
         if debug:
             print('self.num_columns: %r' % self.num_columns)
         for comp in self.components:
-            comp.columns = []
+            columns = self.columns[comp] = []
             for idx in range(self.num_columns):
                 column = []
-                for row in comp.rows:
-                    if idx < len(row.entries):
-                        column.append(row.entries[idx])
+                for row in self.rows[comp]:
+                    entries = self.entries[row]
+                    if idx < len(entries):
+                        column.append(entries[idx])
                 if debug:
                     print('column: %r' % (column, ))
-                comp.columns.append(column)
+                columns.append(column)
             if debug:
-                print('comp.columns: %r' % (comp.columns, ))
+                print('columns: %r' % (columns, ))
 
         # Requisition:
         self.width_needed_for_x = {}
         for x in range(self.num_columns):
             for comp in self.components:
-                for entry in comp.columns[x]:
+                for entry in self.columns[comp][x]:
                     w, h = self._get_requisition(entry)
                     if w > self.width_needed_for_x.get(x, 0):
                         self.width_needed_for_x[x] = w
 
         for comp in self.components:
-            comp.height_needed_for_y = {}
+            height_needed_for_y = self.height_needed_for_y[comp] = {}
             for x in range(self.num_columns):
-                for y, entry in enumerate(comp.columns[x]):
+                for y, entry in enumerate(self.columns[comp][x]):
                     w, h = self._get_requisition(entry)
-                    if h > comp.height_needed_for_y.get(y, 0):
-                        comp.height_needed_for_y[y] = h
+                    if h > height_needed_for_y.get(y, 0):
+                        height_needed_for_y[y] = h
 
     def _entry_needs_grid_table(self, entry):
-        for desc in entry.iter_depth_first():
-            if isinstance(desc, Element):
-                if isinstance(desc.rst_kind, Directive):
-                    return True
+        if isinstance(entry.rst_kind, Directive):
+            return True
+        for _, _, desc in entry.iter_elements():
+            if isinstance(desc.rst_kind, Directive):
+                return True
         return False
 
     def _get_requisition(self, entry):
@@ -2130,16 +2774,16 @@ class TableLayout:
     def render_grid_table(self, w):
         self.draw_grid_table_border(w, '-')
         for comp_idx, comp in enumerate(self.components):
-            for y, row in enumerate(comp.rows):
+            for y, row in enumerate(self.rows[comp]):
                 # Cope with newlines in "text":
                 lines_at_x = {}
-                for x, entry in enumerate(row.entries):
+                for x, entry in enumerate(self.entries[row]):
                     lines_at_x[x] = (
                         self._render_entry(entry).splitlines())
 
-                for line_idx in range(comp.height_needed_for_y[y]):
+                for line_idx in range(self.height_needed_for_y[comp][y]):
                     w.write('|')
-                    for x, _ in enumerate(row.entries):
+                    for x, _ in enumerate(self.entries[row]):
                         lines = lines_at_x[x]
                         if line_idx < len(lines):
                             text = lines[line_idx]
@@ -2168,9 +2812,9 @@ class TableLayout:
             w.write('   :header-rows: 1\n')
         w.write('\n')
         for comp in self.components:
-            for row in comp.rows:
+            for row in self.rows[comp]:
                 values = []
-                for entry in row.entries:
+                for entry in self.entries[row]:
                     texts = [x.strip() for x in self._render_entry(entry).splitlines()]
                     values.append(' '.join(texts))
                 for _ in range(len(values), self.num_columns):
@@ -2198,6 +2842,11 @@ class Table(RstKind):
         self.element = element
         self.ctxt = ctxt
 
+    def __repr__(self):
+        # The table is rendered from the element, which has its own
+        # hash, so its kind identifies it here
+        return 'Table(<%s>, debug=%r)' % (self.element.kind, self.ctxt.debug)
+
     def before(self, w):
         table_layout = TableLayout(self.element, self.ctxt.debug)
         table_layout.render(w)
@@ -2299,6 +2948,13 @@ class Context:
     def preprocess(self, tree):
         return tree
 
+    def default_language(self, element):
+        """
+        The language of the code examples within element, if it differs
+        from that of its parent (see fixup_examples), or None.
+        """
+        return None
+
 
 class FileOpener(RstOpener):
     def __init__(self, output_dir):
@@ -2325,13 +2981,6 @@ class GccContext(Context):
     def preprocess(self, tree):
         class GccVisitor(NoopVisitor):
             def previsit_element(self, element, parents):
-                if element.kind == 'chapter':
-                    for child in element.children:
-                        if child.is_element('sectiontitle'):
-                            text = child.get_sole_text()
-                            if text:
-                                if text.data == 'GNU Objective-C Features':
-                                    element.default_language = 'objective-c'
                 # Fixups for issue #1:
                 if element.kind == 'option':
                     all_text = element.get_all_text()
@@ -2342,28 +2991,88 @@ class GccContext(Context):
         GccVisitor().visit(tree)
         return tree
 
+    def default_language(self, element):
+        if element.kind == 'chapter':
+            for child in element.children:
+                if child.is_element('sectiontitle'):
+                    text = child.get_sole_text()
+                    if text:
+                        if text.data == 'GNU Objective-C Features':
+                            return 'objective-c'
+        return None
+
+
+def entity_arg(arg):
+    name, sep, replacement = arg.partition('=')
+    if not sep or not ENTITY_RE.fullmatch('&%s;' % name) or name in BUILTIN_XML_ENTITIES:
+        raise argparse.ArgumentTypeError('expected NAME=TEXT, not %r' % arg)
+    return name, replacement
+
 
 parser = argparse.ArgumentParser(description='Convert TEXINFO xml file into RST files')
 parser.add_argument('xml_file', help='Input XML file')
 parser.add_argument('--output', '-o', default='output', help='Output directory')
 parser.add_argument('--default-language', default='c++', help='Default language for code blocks')
+parser.add_argument('--entity', action='append', type=entity_arg, default=[], metavar='NAME=TEXT',
+                    help='Replace the entity &NAME; with TEXT, as well as the usual ones (can be repeated)')
+parser.add_argument('--xml-backend', choices=['auto'] + list(XML_BACKENDS), default='auto',
+                    help='How to parse the XML: auto uses the fastest, expat')
+parser.add_argument('--memory-usage', action='store_true',
+                    help='Report the memory used by the tree, after parsing and after conversion, on stderr')
+parser.add_argument('--streaming', action='store_true',
+                    help='Parse, convert and write one chapter at a time, to bound the memory used')
 
 # Entrypoint
 if __name__ == '__main__':
     args = parser.parse_args()
     base, _ = os.path.splitext(os.path.basename(args.xml_file))
-    with open(args.xml_file) as f_in:
-        xml_src = f_in.read()
-        tree = from_xml_string(xml_src)
-    tree = convert_to_rst(tree, GccContext())
-    if 1:
+    entities = OrderedDict(ENTITIES)
+    entities.update(args.entity)
+    if args.xml_backend == 'lxml' and lxml_etree is None:
+        print('lxml is not installed; using expat instead', file=sys.stderr)
+    if args.streaming:
+        if args.xml_backend == 'minidom':
+            parser.error('--streaming needs the expat or lxml backend')
         if not os.path.exists(args.output):
             os.mkdir(args.output)
-        with open(os.path.join(args.output, base + '.rst'), 'w') as f_out:
+        largest_bytes = -1
+        with open_xml_file(args.xml_file) as f_in, open(os.path.join(args.output, base + '.rst'), 'w') as f_out:
             print('Creating files:', end='')
             w = RstWriter(f_out, FileOpener(args.output))
-            w.visit(tree)
+            for tree in convert_chapters(f_in, GccContext(), entities, args.xml_backend):
+                w.visit(tree)
+                if args.memory_usage:
+                    usage = memory_usage(tree)
+                    if usage.total_bytes > largest_bytes:
+                        # The report refers to the tree, so write it now
+                        largest_bytes = usage.total_bytes
+                        report = io.StringIO()
+                        usage.write(report)
+                    del usage
+                tree.dispose()
+                del tree
             print()
+        if args.memory_usage:
+            print('Memory usage of the largest chapter, after conversion:', file=sys.stderr)
+            sys.stderr.write(report.getvalue())
     else:
-        w = RstWriter(sys.stdout)
-        w.visit(tree)
+        with open_xml_file(args.xml_file) as f_in:
+            tree = from_xml_file(f_in, entities, args.xml_backend)
+        if args.memory_usage:
+            print('Memory usage after parsing:', file=sys.stderr)
+            memory_usage(tree).write(sys.stderr)
+        tree = convert_to_rst(tree, GccContext())
+        if args.memory_usage:
+            print('Memory usage after conversion:', file=sys.stderr)
+            memory_usage(tree).write(sys.stderr)
+        if 1:
+            if not os.path.exists(args.output):
+                os.mkdir(args.output)
+            with open(os.path.join(args.output, base + '.rst'), 'w') as f_out:
+                print('Creating files:', end='')
+                w = RstWriter(f_out, FileOpener(args.output))
+                w.visit(tree)
+                print()
+        else:
+            w = RstWriter(sys.stdout)
+            w.visit(tree)
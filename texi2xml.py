@@ -847,3 +847,21 @@ class Parser:
 
         v = ConditionalFixer()
         v.visit(self.texinfo)
+
+if __name__ == '__main__':
+    import argparse
+
+    argparser = argparse.ArgumentParser(description='Convert a TEXINFO file into XML')
+    argparser.add_argument('texi_file', help='Input TEXINFO file')
+    argparser.add_argument('--output', '-o', help='Output XML file (default: stdout)')
+    argparser.add_argument('-I', dest='include_paths', action='append', default=[],
+                           help='Directory to search for @include files')
+    args = argparser.parse_args()
+    p = Parser(os.path.dirname(args.texi_file), args.include_paths,
+               with_dtd=1, filename=os.path.basename(args.texi_file))
+    tree = p.parse_file(args.texi_file)
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            tree.write_xml(f_out, DTD_LINE)
+    else:
+        tree.write_xml(sys.stdout, DTD_LINE)